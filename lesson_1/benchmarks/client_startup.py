@@ -0,0 +1,145 @@
+"""
+Бенчмарк запуска клиента: время до первой отрисовки главного окна.
+
+Запускает сервер в отдельном процессе (как benchmarks.swarm) с заданным
+числом зарегистрированных пользователей и сравнивает два порядка запуска
+клиента после ввода имени и пароля:
+
+* blocking - прежний: загрузка или генерация ключей, подключение,
+  авторизация и обновление списков, и только затем создание окна;
+* staged - окно создаётся сразу по данным базы клиента, ключи,
+  подключение и списки - в потоке транспорта.
+
+Для каждого варианта замеряется время до первой отрисовки окна и время
+до готовности (транспорт подключён, списки обновлены), с файлом ключей
+и без него (генерация новой пары RSA). Выводятся медианы по --repeat
+запускам. Окно рисуется без экрана (QT_QPA_PLATFORM=offscreen).
+
+Запуск из каталога lesson_1:
+    python -m benchmarks.client_startup --users 1000 --repeat 5
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from PyQt5.QtCore import QObject, QEvent
+from PyQt5.QtWidgets import QApplication
+
+from benchmarks.swarm import SWARM_PASSWORD, provision, wait_port
+from client.crypto import load_keys
+from client.database import ClientDatabase
+from client.main_window import ClientMainWindow
+from client.transport import ClientTransport
+
+# Наибольшее время одного запуска клиента (секунд).
+RUN_TIMEOUT = 60
+
+
+class PaintWatcher(QObject):
+    """Фильтр событий приложения, запоминающий время первой отрисовки."""
+
+    def __init__(self):
+        super().__init__()
+        self.painted = None
+
+    def eventFilter(self, obj, event):
+        if self.painted is None and event.type() == QEvent.Paint:
+            self.painted = time.perf_counter()
+        return False
+
+
+def run_client(app, watcher, args, name, staged):
+    """
+    Функция одного запуска клиента, возвращает время до первой
+    отрисовки окна и до готовности транспорта (мс).
+    """
+    key_file = f'{name}.key'
+    ready = []
+    watcher.painted = None
+    start = time.perf_counter()
+    database = ClientDatabase(name)
+    if staged:
+        transport = ClientTransport(args.port, args.address, database, name,
+                                    SWARM_PASSWORD, key_file=key_file)
+    else:
+        transport = ClientTransport(args.port, args.address, database, name,
+                                    SWARM_PASSWORD, load_keys(key_file))
+        transport.startup()
+        ready.append(time.perf_counter())
+    window = ClientMainWindow(database, transport)
+    window.make_connection(transport)
+    transport.connected.connect(lambda: ready.append(time.perf_counter()))
+    transport.daemon = True
+    transport.start()
+    deadline = time.monotonic() + RUN_TIMEOUT
+    while (watcher.painted is None or not ready) and time.monotonic() < deadline:
+        app.processEvents()
+        if not transport.is_alive() and not ready:
+            raise RuntimeError('Клиент не подключился к серверу.')
+        time.sleep(0.001)
+    if not ready:
+        raise RuntimeError('Превышено время запуска клиента.')
+    transport.transport_shutdown()
+    transport.join()
+    window.pipeline.close()
+    window.close()
+    database.database_engine.dispose()
+    return (watcher.painted - start) * 1000, (ready[0] - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк запуска клиента')
+    parser.add_argument('--users', default=1000, type=int)
+    parser.add_argument('--repeat', default=5, type=int)
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--port', default=7781, type=int)
+    args = parser.parse_args()
+
+    app = QApplication(sys.argv[:1])
+    watcher = PaintWatcher()
+    app.installEventFilter(watcher)
+
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        db = os.path.join(directory, 'server.db3')
+        provision(db, args.users)
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'benchmarks.swarm', '--serve', '--db', db,
+             '--address', args.address, '--port', str(args.port)],
+            cwd=root, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        os.chdir(directory)
+        try:
+            wait_port(args.address, args.port, server)
+            print(f'Пользователей на сервере: {args.users}')
+            print(f'{"запуск":<10}{"ключи":<12}{"отрисовка, мс":>16}{"готовность, мс":>18}')
+            for staged in (False, True):
+                for new_keys in (False, True):
+                    results = []
+                    for number in range(args.repeat):
+                        name = f'swarm{number}'
+                        if not new_keys:
+                            load_keys(f'{name}.key')
+                        elif os.path.exists(f'{name}.key'):
+                            os.remove(f'{name}.key')
+                        results.append(run_client(app, watcher, args, name, staged))
+                    paint = statistics.median(item[0] for item in results)
+                    ready = statistics.median(item[1] for item in results)
+                    print(f'{"staged" if staged else "blocking":<10}'
+                          f'{"генерация" if new_keys else "из файла":<12}'
+                          f'{paint:>16.0f}{ready:>18.0f}')
+        finally:
+            os.chdir(cwd)
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
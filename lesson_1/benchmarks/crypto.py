@@ -0,0 +1,85 @@
+"""
+Бенчмарк шифрования сообщений клиента.
+
+Сравнивает прежнюю схему - каждое сообщение шифруется RSA-OAEP открытым
+ключом получателя (2048 бит) - с гибридной схемой SessionCipher, где
+сообщения шифруются сеансовым ключом AES-GCM, а RSA используется только
+при смене ключа. Для каждой схемы измеряется время шифрования
+у отправителя и расшифровки у получателя на одно сообщение.
+RSA-OAEP не может зашифровать больше 190 байт, поэтому для длинных
+сообщений замеряется только гибридная схема.
+
+Запуск из каталога lesson_1:
+    python -m benchmarks.crypto --messages 500
+"""
+
+import argparse
+import base64
+import os
+import sys
+import time
+
+from Cryptodome.Cipher import PKCS1_OAEP
+from Cryptodome.PublicKey import RSA
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from client.crypto import SessionCipher, PublicKey
+
+# Размер RSA-OAEP блока для 2048 битного ключа за вычетом дополнения SHA-1.
+RSA_LIMIT = 2048 // 8 - 2 * 20 - 2
+
+
+def timed(func, messages):
+    """Функция замера среднего времени вызова (мкс) и списка результатов."""
+    results = []
+    start = time.perf_counter()
+    for _ in range(messages):
+        results.append(func())
+    return (time.perf_counter() - start) / messages * 1000000, results
+
+
+def rsa_scheme(sender_keys, recipient_keys, text, messages):
+    """Прежняя схема: RSA-OAEP и base64 на каждое сообщение."""
+    encryptor = PKCS1_OAEP.new(RSA.import_key(recipient_keys.publickey().export_key()))
+    decrypter = PKCS1_OAEP.new(recipient_keys)
+    encrypt_time, payloads = timed(
+        lambda: base64.b64encode(encryptor.encrypt(text.encode('utf8'))).decode('ascii'), messages)
+    payloads = iter(payloads)
+    decrypt_time, _ = timed(
+        lambda: decrypter.decrypt(base64.b64decode(next(payloads))).decode('utf8'), messages)
+    return encrypt_time, decrypt_time
+
+
+def session_scheme(sender_keys, recipient_keys, text, messages):
+    """Гибридная схема: сеансовый ключ AES-GCM, RSA при смене ключа."""
+    public_key = PublicKey(recipient_keys.publickey().export_key().decode('ascii'))
+    sender = SessionCipher(sender_keys)
+    recipient = SessionCipher(recipient_keys)
+    encrypt_time, payloads = timed(
+        lambda: sender.encrypt('user1', 'user2', public_key, text), messages)
+    payloads = iter(payloads)
+    decrypt_time, _ = timed(
+        lambda: recipient.decrypt('user1', 'user2', next(payloads)), messages)
+    return encrypt_time, decrypt_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк шифрования сообщений')
+    parser.add_argument('--messages', default=500, type=int)
+    args = parser.parse_args()
+
+    sender_keys = RSA.generate(2048, os.urandom)
+    recipient_keys = RSA.generate(2048, os.urandom)
+    print(f'{"схема":<12}{"размер, байт":>14}{"шифрование, мкс":>18}{"расшифровка, мкс":>19}')
+    for size in (100, RSA_LIMIT, 4096, 65536):
+        text = 'x' * size
+        rows = [('AES-GCM', session_scheme)]
+        if size <= RSA_LIMIT:
+            rows.insert(0, ('RSA-OAEP', rsa_scheme))
+        for title, scheme in rows:
+            encrypt_time, decrypt_time = scheme(sender_keys, recipient_keys, text, args.messages)
+            print(f'{title:<12}{size:>14}{encrypt_time:>18.1f}{decrypt_time:>19.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""
+Бенчмарк запросов базы данных сервера до и после создания индексов.
+
+Создаёт временную базу с заданным количеством пользователей, контактов
+и записей истории входов, удаляет из неё индексы (схема старой версии),
+замеряет время запросов списка контактов, проверки дубля контакта и
+истории входов пользователя, затем выполняет миграцию ServerStorage.migrate
+и повторяет замеры. Для каждого запроса выводится план SQLite.
+
+Запуск из каталога lesson_1:
+    python -m benchmarks.db_indexes --users 100000 --history 10000000
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from server.database import ServerStorage
+
+# Запросы, эквивалентные формируемым ServerStorage, для вывода плана.
+QUERIES = {
+    'get_contacts': 'SELECT Users.name FROM Contacts JOIN Users ON Contacts.contact = Users.id '
+                    'WHERE Contacts.user = ?',
+    'add_contact': 'SELECT count(*) FROM Contacts WHERE Contacts.user = ? AND Contacts.contact = ?',
+    'login_history': 'SELECT Users.name, Login_history.date_time, Login_history.ip, Login_history.port '
+                     'FROM Login_history JOIN Users ON Users.id = Login_history.name WHERE Users.name = ?',
+}
+CHUNK = 100000
+
+
+def fill_database(path, users, contacts, history):
+    """Функция заполнения базы тестовыми данными."""
+    connection = sqlite3.connect(path)
+    connection.executemany(
+        'INSERT INTO Users (id, name, passwd_hash) VALUES (?, ?, ?)',
+        ((i, f'user{i}', 'hash') for i in range(1, users + 1)))
+    connection.executemany(
+        'INSERT INTO History (user, sent, accepted) VALUES (?, 0, 0)',
+        ((i,) for i in range(1, users + 1)))
+    connection.executemany(
+        'INSERT INTO Contacts (user, contact) VALUES (?, ?)',
+        ((i, (i + step) % users + 1) for i in range(1, users + 1) for step in range(contacts)))
+    for start in range(0, history, CHUNK):
+        connection.executemany(
+            'INSERT INTO Login_history (name, date_time, ip, port) VALUES (?, ?, ?, ?)',
+            ((random.randint(1, users), '2023-01-01 00:00:00.000000', '127.0.0.1', '7777')
+             for _ in range(min(CHUNK, history - start))))
+        connection.commit()
+    connection.commit()
+    connection.close()
+
+
+def drop_indexes(storage):
+    """Функция удаления индексов, объявленных в описании таблиц."""
+    with storage.database_engine.begin() as connection:
+        for table in storage.Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.drop(connection, checkfirst=True)
+
+
+def measure(storage, names, samples):
+    """Функция замера среднего времени запросов (в миллисекундах)."""
+    results = {}
+    checks = {
+        'get_contacts': lambda name: storage.get_contacts(name),
+        'add_contact': lambda name: storage.add_contact(name, storage.get_contacts(name)[0]),
+        'login_history': lambda name: storage.login_history(name),
+    }
+    for title, check in checks.items():
+        total = 0
+        for name in names[:samples]:
+            # Кэш справочника сбрасывается, чтобы замерять обращения к базе.
+            storage.users_cache.clear()
+            start = time.perf_counter()
+            check(name)
+            total += time.perf_counter() - start
+        results[title] = total / samples * 1000
+    return results
+
+
+def explain(path):
+    """Функция вывода планов запросов."""
+    connection = sqlite3.connect(path)
+    for title, query in QUERIES.items():
+        params = ('user1',) if title == 'login_history' else (1, 2)[:query.count('?')]
+        plan = connection.execute(f'EXPLAIN QUERY PLAN {query}', params).fetchall()
+        print(f'  {title}: ' + '; '.join(row[-1] for row in plan))
+    connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк индексов базы сервера')
+    parser.add_argument('--users', default=100000, type=int)
+    parser.add_argument('--contacts', default=10, type=int)
+    parser.add_argument('--history', default=10000000, type=int)
+    parser.add_argument('--samples', default=20, type=int)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.db3')
+        storage = ServerStorage(path)
+        drop_indexes(storage)
+        start = time.perf_counter()
+        fill_database(path, args.users, args.contacts, args.history)
+        print(f'Заполнение базы: {time.perf_counter() - start:.1f} с')
+
+        names = [f'user{random.randint(1, args.users)}' for _ in range(args.samples)]
+        before = measure(storage, names, args.samples)
+        print('Без индексов:')
+        explain(path)
+
+        start = time.perf_counter()
+        storage.migrate()
+        print(f'Миграция: {time.perf_counter() - start:.1f} с')
+        after = measure(storage, names, args.samples)
+        print('С индексами:')
+        explain(path)
+
+        print(f'{"запрос":<16}{"до, мс":>12}{"после, мс":>12}')
+        for title in before:
+            print(f'{title:<16}{before[title]:>12.3f}{after[title]:>12.3f}')
+        storage.sessions.remove()
+        storage.readers.remove()
+        storage.database_engine.dispose()
+        storage.reader_engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
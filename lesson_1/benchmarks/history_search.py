@@ -0,0 +1,102 @@
+"""
+Бенчмарк полнотекстового поиска по истории сообщений клиента.
+
+Создаёт во временном каталоге базу клиента и заполняет её сообщениями
+из случайных слов (частоты слов убывают по закону Ципфа, как в живом
+тексте), записывая их пачками через save_messages - так же, как поток
+записи истории. Затем замеряет время search_history для редкого и
+частого слова, начал слов, двух слов и поиска в переписке с одним
+собеседником.
+
+Запуск из каталога lesson_1:
+    python -m benchmarks.history_search --messages 1000000
+"""
+
+import argparse
+import datetime
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from client.database import ClientDatabase
+
+# Число собеседников и размер словаря.
+CONTACTS = 50
+VOCABULARY = 20000
+
+
+def make_words(count, rng):
+    """Функция генерации словаря из случайных слов длиной 3-10 букв."""
+    letters = 'абвгдеёжзийклмнопрстуфхцчшщъыьэюя'
+    return [''.join(rng.choice(letters) for _ in range(rng.randint(3, 10)))
+            for _ in range(count)]
+
+
+def fill(database, messages, batch, rng):
+    """Функция заполнения истории, возвращает скорость записи (сообщений/с)."""
+    words = make_words(VOCABULARY, rng)
+    weights = list(itertools.accumulate(1 / rank for rank in range(1, VOCABULARY + 1)))
+    start_date = datetime.datetime.now() - datetime.timedelta(seconds=messages)
+    elapsed = 0.0
+    for offset in range(0, messages, batch):
+        rows = []
+        for number in range(offset, min(offset + batch, messages)):
+            text = ' '.join(rng.choices(words, cum_weights=weights, k=rng.randint(3, 20)))
+            rows.append((f'user{number % CONTACTS}', rng.choice(('in', 'out')), text,
+                         start_date + datetime.timedelta(seconds=number)))
+        start = time.perf_counter()
+        database.save_messages(rows)
+        elapsed += time.perf_counter() - start
+    return messages / elapsed, words
+
+
+def timed_search(database, phrase, repeat, contact=None):
+    """Функция замера среднего времени поиска (мс) и числа результатов."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        found = database.search_history(phrase, contact)
+    return (time.perf_counter() - start) / repeat * 1000, len(found)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк поиска по истории сообщений')
+    parser.add_argument('--messages', default=100000, type=int)
+    parser.add_argument('--batch', default=1000, type=int)
+    parser.add_argument('--repeat', default=20, type=int)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            database = ClientDatabase('benchmark')
+            rate, words = fill(database, args.messages, args.batch, rng)
+            print(f'Записано сообщений: {args.messages}, {rate:.0f} сообщений/с '
+                  f'с обновлением индекса')
+            # Самое частое слово длиной не меньше 8 букв.
+            long_word = next(word for word in words if len(word) >= 8)
+            cases = [
+                ('частое слово', words[0], None),
+                ('редкое слово', words[-1], None),
+                ('префикс 3 буквы', words[1][:3], None),
+                ('префикс 4 буквы', words[0][:4], None),
+                ('префикс 6 букв', long_word[:6], None),
+                ('два слова', f'{words[2]} {words[3]}', None),
+                ('слово у собеседника', words[5], 'user7'),
+            ]
+            print(f'{"запрос":<22}{"найдено":>10}{"время, мс":>12}')
+            for title, phrase, contact in cases:
+                elapsed, found = timed_search(database, phrase, args.repeat, contact)
+                print(f'{title:<22}{found:>10}{elapsed:>12.2f}')
+            database.database_engine.dispose()
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == '__main__':
+    main()
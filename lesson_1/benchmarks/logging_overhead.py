@@ -0,0 +1,127 @@
+"""
+Бенчмарк накладных расходов логирования на одно сообщение.
+
+Каждое сообщение проходит путь отправки и приёма: функция send_message
+(обёрнута декоратором @log) отправляет его в пару сокетов, MessageDecoder
+разбирает принятые байты, после чего выполняется отладочная запись, как
+при разборе сообщения сервером. Сравниваются варианты:
+
+* без логирования - send_message без декоратора;
+* прежний декоратор с f-строкой при выключенном уровне debug;
+* ленивый декоратор при выключенном уровне debug;
+* уровень debug, синхронная запись в файл из рабочего потока;
+* уровень debug, запись через QueueHandler / QueueListener.
+
+Запуск из каталога lesson_1:
+    python -m benchmarks.logging_overhead --messages 20000
+"""
+
+import argparse
+import logging
+import os
+import queue
+import socket
+import sys
+import tempfile
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common import decor
+from common.variables import *
+from common.utils import send_message, MessageDecoder
+
+
+def eager_log(func_to_log):
+    """Прежний вариант декоратора: строка формируется при каждом вызове."""
+    def log_saver(*args, **kwargs):
+        decor.logger.debug(
+            f'Была вызвана функция {func_to_log.__name__} c параметрами {args} , {kwargs}. '
+            f'Вызов из модуля {func_to_log.__module__}')
+        return func_to_log(*args, **kwargs)
+    return log_saver
+
+
+def run(messages, send, eager):
+    """
+    Функция прогона сообщений, возвращает среднее время на одно сообщение
+    и 99-й перцентиль (мкс).
+    """
+    logger = decor.logger
+    writer, reader = socket.socketpair()
+    decoder = MessageDecoder(framed=True)
+    message = {
+        ACTION: MESSAGE,
+        SENDER: 'user1',
+        DESTINATION: 'user2',
+        TIME: time.time(),
+        MESSAGE_TEXT: 'x' * 100
+    }
+    timings = []
+    for _ in range(messages):
+        start = time.perf_counter()
+        send(writer, message, True)
+        for received in decoder.feed(reader.recv(RECV_BUFFER_LENGTH)):
+            if eager:
+                logger.debug(f'Разбор сообщения от клиента : {received}')
+            else:
+                logger.debug('Разбор сообщения от клиента : %s', received)
+        timings.append(time.perf_counter() - start)
+    writer.close()
+    reader.close()
+    timings.sort()
+    return sum(timings) / messages * 1000000, timings[int(messages * 0.99)] * 1000000
+
+
+def configure(level, handler=None):
+    """Функция настройки регистратора декоратора для очередного варианта."""
+    logger = decor.logger
+    for old in list(logger.handlers):
+        logger.removeHandler(old)
+    if handler is not None:
+        logger.addHandler(handler)
+    logger.setLevel(level)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк накладных расходов логирования')
+    parser.add_argument('--messages', default=20000, type=int)
+    args = parser.parse_args()
+
+    saved = decor.logger.handlers[:], decor.logger.level
+    formatter = logging.Formatter('%(asctime)s %(levelname)s %(module)s %(message)s')
+    plain_send = send_message.__wrapped__
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        configure(logging.INFO)
+        results.append(('без логирования', run(args.messages, plain_send, False)))
+        results.append(('f-строки, debug выключен', run(args.messages, eager_log(plain_send), True)))
+        results.append(('ленивый, debug выключен', run(args.messages, send_message, False)))
+
+        file_handler = logging.FileHandler(os.path.join(directory, 'sync.log'), encoding=ENCODING)
+        file_handler.setFormatter(formatter)
+        configure(logging.DEBUG, file_handler)
+        results.append(('debug, запись в файл', run(args.messages, send_message, False)))
+        file_handler.close()
+
+        file_handler = logging.FileHandler(os.path.join(directory, 'queue.log'), encoding=ENCODING)
+        file_handler.setFormatter(formatter)
+        log_queue = queue.SimpleQueue()
+        listener = QueueListener(log_queue, file_handler)
+        listener.start()
+        configure(logging.DEBUG, QueueHandler(log_queue))
+        results.append(('debug, через очередь', run(args.messages, send_message, False)))
+        listener.stop()
+        file_handler.close()
+
+    decor.logger.handlers[:], level = saved
+    decor.logger.setLevel(level)
+
+    baseline = results[0][1][0]
+    print(f'{"вариант":<28}{"среднее, мкс":>14}{"накладные, мкс":>16}{"p99, мкс":>12}')
+    for title, (value, p99) in results:
+        print(f'{title:<28}{value:>14.2f}{value - baseline:>16.2f}{p99:>12.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Профиль времени импорта при запуске сервера (python -X importtime).
+
+Загружает модуль server.py в отдельном интерпретаторе без вызова main(),
+выводит суммарное время импорта и самые медленные модули верхнего уровня.
+Завершается с ошибкой, если загружен PyQt5 (режим без GUI не должен его
+импортировать) или суммарное время превышает заданный бюджет.
+
+Запуск из каталога lesson_1:
+    python -m benchmarks.startup_imports --budget 1500
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+# Модули, которые не должны загружаться в режиме без GUI.
+FORBIDDEN = ('PyQt5',)
+# Загрузка server.py без запуска сервера.
+LOAD_SERVER = "import runpy; runpy.run_path('server.py', run_name='server_startup')"
+
+
+def import_profile(code=LOAD_SERVER):
+    """
+    Функция получения профиля импорта: список кортежей
+    (собственное время, суммарное время в мкс, уровень вложенности, модуль).
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            cwd=ROOT, capture_output=True, text=True)
+    if result.returncode:
+        raise RuntimeError(result.stderr)
+    profile = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        profile.append((int(own), int(cumulative), depth, name.strip()))
+    return profile
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Профиль импорта сервера')
+    parser.add_argument('--budget', default=None, type=float, help='Допустимое время импорта, мс')
+    parser.add_argument('--top', default=15, type=int)
+    args = parser.parse_args()
+
+    profile = import_profile()
+    total = sum(own for own, _, _, _ in profile) / 1000
+    top_level = sorted((item for item in profile if item[2] == 0), key=lambda item: -item[1])
+    print(f'Загружено модулей: {len(profile)}, время импорта: {total:.1f} мс')
+    for own, cumulative, _, name in top_level[:args.top]:
+        print(f'{cumulative / 1000:>10.1f} мс  {name}')
+
+    failed = False
+    loaded = [name for _, _, _, name in profile if name.split('.')[0] in FORBIDDEN]
+    if loaded:
+        print(f'Ошибка: при запуске загружены модули GUI: {", ".join(loaded[:5])}')
+        failed = True
+    if args.budget is not None and total > args.budget:
+        print(f'Ошибка: время импорта {total:.1f} мс превышает бюджет {args.budget} мс')
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
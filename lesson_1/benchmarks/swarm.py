@@ -0,0 +1,379 @@
+"""
+Нагрузочный генератор для сервера мессенджера без графического интерфейса.
+
+Регистрирует N пользователей непосредственно в базе сервера (ServerStorage),
+запускает сервер выбранного движка в отдельном процессе, подключает клиентов
+с полной авторизацией PRESENCE / 511 HMAC и выполняет заданную смесь
+запросов. По окончании выводит скорость подключения, число сообщений
+в секунду, перцентили p50/p95/p99 доставки сообщений и времени ответа
+на запросы, а также потребление памяти процессом сервера (RSS).
+
+Запуск из каталога lesson_1:
+    python -m benchmarks.swarm --clients 200 --messages 200 --engine asyncio
+    python -m benchmarks.swarm --mix message=80,get_contacts=10,get_users=10 --window 4
+"""
+
+import argparse
+import asyncio
+import binascii
+import hashlib
+import hmac
+import itertools
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.variables import *
+from common.utils import encode_message, MessageDecoder
+from common.errors import ServerError
+
+# Пароль всех пользователей нагрузочного теста.
+SWARM_PASSWORD = 'swarm'
+# Время ожидания доставки последних сообщений после отправки (секунд).
+DRAIN_TIMEOUT = 30
+
+
+def password_hash(name):
+    """Функция получения хэша пароля пользователя так же, как это делает клиент."""
+    passwd_hash = hashlib.pbkdf2_hmac(
+        'sha512', SWARM_PASSWORD.encode('utf-8'), name.lower().encode('utf-8'), 10000)
+    return binascii.hexlify(passwd_hash)
+
+
+def percentile(values, rank):
+    """Функция вычисления перцентиля по отсортированному списку значений."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * rank / 100))]
+
+
+def parse_mix(text):
+    """Функция разбора смеси запросов вида message=80,get_contacts=10."""
+    mix = {}
+    for item in text.split(','):
+        action, weight = item.split('=')
+        if action not in (MESSAGE, GET_CONTACTS, USERS_REQUEST):
+            raise argparse.ArgumentTypeError(f'Неизвестное действие: {action}')
+        mix[action] = int(weight)
+    return mix
+
+
+def process_rss(pid):
+    """Функция чтения текущей и пиковой памяти процесса (Кб) из /proc."""
+    values = {}
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith(('VmRSS', 'VmHWM')):
+                    key, value = line.split(':')
+                    values[key] = int(value.split()[0])
+    except OSError:
+        pass
+    return values.get('VmRSS', 0), values.get('VmHWM', 0)
+
+
+def provision(path, count):
+    """Функция регистрации пользователей теста в базе сервера."""
+    from server.database import ServerStorage
+    storage = ServerStorage(path)
+    names = [f'swarm{number}' for number in range(count)]
+    hashes = {}
+    for name in names:
+        hashes[name] = password_hash(name)
+        if not storage.check_user(name):
+            storage.add_user(name, hashes[name])
+    storage.sessions.remove()
+    storage.readers.remove()
+    storage.database_engine.dispose()
+    storage.reader_engine.dispose()
+    return hashes
+
+
+def serve(args):
+    """Функция запуска сервера в отдельном процессе до получения SIGTERM."""
+    import logging
+    from server.database import ServerStorage
+    from server.core import MessageProcessor
+    from server.async_core import AsyncMessageProcessor
+    if args.log_level:
+        logging.getLogger('server').setLevel(args.log_level)
+    database = ServerStorage(args.db)
+    engine = AsyncMessageProcessor if args.engine == 'asyncio' else MessageProcessor
+    server = engine(args.address, args.port, database)
+    server.daemon = True
+    server.start()
+
+    def stop(signum, frame):
+        server.running = False
+
+    signal.signal(signal.SIGTERM, stop)
+    while server.is_alive():
+        server.join(0.5)
+
+
+class SwarmStats:
+    """Класс - накопитель результатов нагрузочного теста."""
+
+    def __init__(self):
+        self.connect = []
+        self.latency = []
+        self.rtt = {}
+        self.sent = 0
+        self.received = 0
+        self.errors = 0
+
+
+class SwarmClient:
+    """
+    Класс - клиент нагрузочного теста.
+    Реализует авторизацию и протокол клиента поверх asyncio-потоков,
+    ответы сервера сопоставляются с запросами по идентификатору.
+    """
+
+    def __init__(self, name, passwd_hash, stats):
+        self.name = name
+        self.passwd_hash = passwd_hash
+        self.stats = stats
+        self.reader = None
+        self.writer = None
+        self.decoder = MessageDecoder()
+        self.received = []
+        self.pending = {}
+        self.request_ids = itertools.count(1)
+        self.reader_task = None
+
+    def write(self, message):
+        self.writer.write(encode_message(message, self.decoder.framed))
+
+    async def read(self):
+        """Метод чтения очередного сообщения во время авторизации."""
+        while not self.received:
+            data = await self.reader.read(RECV_BUFFER_LENGTH)
+            if not data:
+                raise ConnectionResetError('Сервер закрыл соединение.')
+            self.received.extend(self.decoder.feed(data))
+        return self.received.pop(0)
+
+    async def connect(self, address, port):
+        """Метод подключения и авторизации на сервере."""
+        start = time.perf_counter()
+        self.reader, self.writer = await asyncio.open_connection(address, port)
+        self.write({
+            ACTION: PRESENCE,
+            TIME: time.time(),
+            USER: {ACCOUNT_NAME: self.name, PUBLIC_KEY: 'swarm'},
+            FRAMING: FRAMING_LENGTH_PREFIX,
+            DIRECTORY: DIRECTORY_DELTA
+        })
+        ans = await self.read()
+        if ans.get(RESPONSE) != 511:
+            raise ServerError(ans.get(ERROR))
+        if ans.get(FRAMING) == FRAMING_LENGTH_PREFIX:
+            self.decoder.switch_to_framed()
+        digest = hmac.new(self.passwd_hash, ans[DATA].encode('utf-8'), 'MD5').digest()
+        self.write({RESPONSE: 511, DATA: binascii.b2a_base64(digest).decode('ascii')})
+        ans = await self.read()
+        if ans.get(RESPONSE) != 200:
+            raise ServerError(ans.get(ERROR))
+        self.stats.connect.append(time.perf_counter() - start)
+        self.reader_task = asyncio.create_task(self.read_loop())
+
+    async def read_loop(self):
+        """Метод разбора сообщений сервера после авторизации."""
+        while True:
+            for message in self.received:
+                self.handle(message)
+            self.received = []
+            data = await self.reader.read(RECV_BUFFER_LENGTH)
+            if not data:
+                break
+            self.received = self.decoder.feed(data)
+
+    def handle(self, message):
+        """Метод учёта принятого сообщения."""
+        now = time.perf_counter()
+        if REQUEST_ID in message:
+            future, action, start = self.pending.pop(message[REQUEST_ID])
+            self.stats.rtt.setdefault(action, []).append(now - start)
+            if message.get(RESPONSE) == 400:
+                self.stats.errors += 1
+            elif action == MESSAGE:
+                self.stats.sent += 1
+            future.set_result(message)
+        elif message.get(ACTION) == MESSAGE:
+            self.stats.latency.append(time.time() - message[TIME])
+            self.stats.received += 1
+
+    async def request(self, action, peers, size):
+        """Метод отправки запроса, возвращает Future ответа."""
+        if action == MESSAGE:
+            message = {
+                ACTION: MESSAGE,
+                SENDER: self.name,
+                DESTINATION: random.choice(peers),
+                TIME: time.time(),
+                MESSAGE_TEXT: 'x' * size
+            }
+        elif action == GET_CONTACTS:
+            message = {ACTION: GET_CONTACTS, TIME: time.time(), USER: self.name}
+        else:
+            message = {ACTION: USERS_REQUEST, TIME: time.time(), ACCOUNT_NAME: self.name}
+        request_id = next(self.request_ids)
+        message[REQUEST_ID] = request_id
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = (future, action, time.perf_counter())
+        self.write(message)
+        await self.writer.drain()
+        return future
+
+    async def drive(self, actions, peers, size, window):
+        """Метод выполнения списка запросов, не более window одновременно."""
+        in_flight = asyncio.Semaphore(window)
+        futures = []
+        for action in actions:
+            await in_flight.acquire()
+            future = await self.request(action, peers, size)
+            future.add_done_callback(lambda done: in_flight.release())
+            futures.append(future)
+        await asyncio.gather(*futures)
+
+    async def close(self):
+        """Метод завершения работы клиента."""
+        self.write({ACTION: EXIT, TIME: time.time(), ACCOUNT_NAME: self.name})
+        await self.writer.drain()
+        self.writer.close()
+        if self.reader_task:
+            self.reader_task.cancel()
+
+
+async def swarm(args, hashes, server_pid):
+    """Функция выполнения нагрузочного теста."""
+    stats = SwarmStats()
+    names = list(hashes)
+    clients = [SwarmClient(name, hashes[name], stats) for name in names]
+    limit = asyncio.Semaphore(args.connect_concurrency)
+
+    async def connect(client):
+        async with limit:
+            await client.connect(args.address, args.port)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(connect(client) for client in clients))
+    connect_time = time.perf_counter() - start
+    connected_rss = process_rss(server_pid)[0]
+
+    actions = list(args.mix)
+    weights = [args.mix[action] for action in actions]
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        client.drive(random.choices(actions, weights, k=args.messages),
+                     [name for name in names if name != client.name], args.size, args.window)
+        for client in clients))
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    while stats.received < stats.sent and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+    duration = time.perf_counter() - start
+    rss, peak = process_rss(server_pid)
+    for client in clients:
+        await client.close()
+
+    stats.connect.sort()
+    stats.latency.sort()
+    print(f'Клиентов: {len(clients)}, подключение {connect_time:.2f} с, '
+          f'{len(clients) / connect_time:.0f} подключений/с')
+    print(f'Авторизация, мс: p50 {percentile(stats.connect, 50) * 1000:.1f}  '
+          f'p95 {percentile(stats.connect, 95) * 1000:.1f}  p99 {percentile(stats.connect, 99) * 1000:.1f}')
+    print(f'Сообщений отправлено {stats.sent}, доставлено {stats.received}, ошибок {stats.errors}, '
+          f'{stats.received / duration:.0f} сообщений/с за {duration:.2f} с')
+    print(f'Доставка, мс: p50 {percentile(stats.latency, 50) * 1000:.1f}  '
+          f'p95 {percentile(stats.latency, 95) * 1000:.1f}  p99 {percentile(stats.latency, 99) * 1000:.1f}')
+    for action, values in sorted(stats.rtt.items()):
+        values.sort()
+        print(f'Ответ на {action}, мс: p50 {percentile(values, 50) * 1000:.1f}  '
+              f'p95 {percentile(values, 95) * 1000:.1f}  p99 {percentile(values, 99) * 1000:.1f}')
+    if server_pid:
+        print(f'RSS сервера: после подключения {connected_rss / 1024:.1f} Мб, '
+              f'в конце {rss / 1024:.1f} Мб, пик {peak / 1024:.1f} Мб')
+
+
+def wait_port(address, port, server=None, timeout=10):
+    """Функция ожидания готовности сервера принимать подключения."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server is not None and server.poll() is not None:
+            raise ServerError('Процесс сервера завершился при запуске (порт занят?).')
+        try:
+            socket.create_connection((address, port), 1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise ServerError('Сервер не запустился.')
+
+
+def raise_file_limit():
+    """Функция увеличения лимита открытых файлов до максимально разрешённого."""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест сервера мессенджера')
+    parser.add_argument('--clients', default=100, type=int)
+    parser.add_argument('--messages', default=100, type=int, help='Запросов на одного клиента')
+    parser.add_argument('--mix', default='message=1', type=parse_mix,
+                        help='Смесь запросов: message=80,get_contacts=10,get_users=10')
+    parser.add_argument('--size', default=100, type=int, help='Длина текста сообщения')
+    parser.add_argument('--window', default=1, type=int, help='Запросов клиента без ожидания ответа')
+    parser.add_argument('--connect-concurrency', default=100, type=int)
+    parser.add_argument('--engine', default='select', choices=['select', 'asyncio'])
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--port', default=7780, type=int)
+    parser.add_argument('--db', default=None, help='Файл базы сервера (по умолчанию временный)')
+    parser.add_argument('--external', action='store_true',
+                        help='Сервер уже запущен с базой --db, не запускать его')
+    parser.add_argument('--log-level', default=None, help='Уровень логирования сервера')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+
+    raise_file_limit()
+    directory = tempfile.TemporaryDirectory()
+    if args.db is None:
+        args.db = os.path.join(directory.name, 'swarm.db3')
+    start = time.perf_counter()
+    hashes = provision(args.db, args.clients)
+    print(f'Регистрация пользователей: {time.perf_counter() - start:.1f} с')
+
+    server = None
+    if not args.external:
+        command = [sys.executable, '-m', 'benchmarks.swarm', '--serve', '--db', args.db,
+                   '--engine', args.engine, '--address', args.address, '--port', str(args.port)]
+        if args.log_level:
+            command += ['--log-level', args.log_level]
+        server = subprocess.Popen(command, cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'),
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_port(args.address, args.port, server)
+        asyncio.run(swarm(args, hashes, server.pid if server else None))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+        directory.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -4,11 +4,9 @@ import os
 import logs.config_client_log
 import argparse
 import sys
-from Cryptodome.PublicKey import RSA
-from PyQt5.QtWidgets import QApplication, QMessageBox
+from PyQt5.QtWidgets import QApplication
 
 from common.variables import *
-from common.errors import ServerError
 from common.decor import log
 from client.database import ClientDatabase
 from client.transport import ClientTransport
@@ -76,45 +74,31 @@ if __name__ == '__main__':
                 f'порт: {server_port}, '
                 f'имя пользователя: {client_name}')
 
-    # Загружаю ключи из файла, если же файла нет, то генерирую новую пару.
-    dir_path = os.getcwd()
-    key_file = os.path.join(dir_path, f'{client_name}.key')
-    if not os.path.exists(key_file):
-        keys = RSA.generate(2048, os.urandom)
-        with open(key_file, 'wb') as key:
-            key.write(keys.export_key())
-    else:
-        with open(key_file, 'rb') as key:
-            keys = RSA.import_key(key.read())
-
-    # !!!keys.publickey().export_key()
-    logger.debug("Keys successfully loaded.")
+    # Ключи загружаются из файла, а если файла нет, то генерируется новая
+    # пара - в потоке транспорта, вместе с подключением к серверу.
+    key_file = os.path.join(os.getcwd(), f'{client_name}.key')
 
     # Создаю объект клиентской базы данных.
     database = ClientDatabase(client_name)
-    # Создаём объект - транспорт и запускаем транспортный поток
-    try:
-        transport = ClientTransport(
-            server_port, server_address,
-            database,
-            client_name, client_passwd, keys)
-        logger.debug("Транспорт готов.")
-
-    except ServerError as error:
-        message = QMessageBox()
-        message.critical(start_dialog, 'Ошибка сервера', error.text)
-        exit(1)
+    # Создаём объект - транспорт, соединение он устанавливает в своём потоке.
+    transport = ClientTransport(
+        server_port, server_address,
+        database,
+        client_name, client_passwd, key_file=key_file)
     transport.setDaemon(True)
-    transport.start()
 
     del start_dialog
 
-    # Создаю GUI.
-    main_window = ClientMainWindow(database, transport, keys)
+    # Создаю GUI. Окно показывается сразу по данным базы клиента,
+    # ход подключения отображается в строке состояния.
+    main_window = ClientMainWindow(database, transport)
     main_window.make_connection(transport)
     main_window.setWindowTitle(f'Чат-программа L6 release- {client_name}')
+    transport.start()
     client_app.exec_()
 
     # Раз графическая оболочка закрылась, закрываем транспорт
     transport.transport_shutdown()
     transport.join()
+    # Дописываем в историю сообщения, оставшиеся в конвейере.
+    main_window.pipeline.close()
@@ -0,0 +1,233 @@
+import base64
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from Cryptodome.Cipher import AES, PKCS1_OAEP
+from Cryptodome.PublicKey import RSA
+
+from common.variables import SESSION_PREFIX, SESSION_KEY_MESSAGES, \
+    SESSION_KEY_LIFETIME, SESSION_KEY_CACHE
+from common.utils import key_fingerprint
+
+logger = logging.getLogger('client')
+
+# Длины сеансового ключа, одноразового номера и тега AES-GCM (байт).
+KEY_SIZE = 32
+NONCE_SIZE = 12
+TAG_SIZE = 16
+
+
+def load_keys(key_file):
+    """
+    Функция загрузки ключей пользователя из файла,
+    если же файла нет, то генерирует и сохраняет новую пару.
+    """
+    if os.path.exists(key_file):
+        with open(key_file, 'rb') as key:
+            return RSA.import_key(key.read())
+    keys = RSA.generate(2048, os.urandom)
+    with open(key_file, 'wb') as key:
+        key.write(keys.export_key())
+    return keys
+
+
+class PublicKey:
+    """
+    Класс - открытый ключ собеседника: PEM строка, её отпечаток и
+    объект шифрования RSA-OAEP. Ключ разбирается один раз, при
+    неверном ключе выбрасывается ValueError.
+    """
+    __slots__ = ('pem', 'fingerprint', 'encrypter')
+
+    def __init__(self, pem, fingerprint=None):
+        self.pem = pem
+        self.fingerprint = fingerprint or key_fingerprint(pem)
+        self.encrypter = PKCS1_OAEP.new(RSA.import_key(pem))
+
+
+class PublicKeyCache:
+    """
+    Класс - кэш открытых ключей собеседников.
+    Ключи сохраняются в базе клиента вместе с отпечатками, а разобранные
+    объекты PublicKey хранятся в памяти. Действующие отпечатки присылает
+    сервер в списке пользователей и в изменениях справочника: ключ
+    с другим отпечатком считается устаревшим и запрашивается функцией
+    fetch заново. Если отпечаток пользователя неизвестен (сервер их
+    не присылает), ключ запрашивается при каждом обращении.
+    """
+
+    def __init__(self, database, fetch):
+        self.database = database
+        self.fetch = fetch
+        self.fingerprints = {}
+        self.keys = {}
+        # Отпечатки обновляет поток транспорта, ключи читает окно.
+        self.lock = threading.Lock()
+
+    def update(self, fingerprints, removed=(), replace=False):
+        """
+        Метод применения отпечатков ключей, присланных сервером.
+        При replace fingerprints - полный список отпечатков.
+        """
+        with self.lock:
+            if replace:
+                self.fingerprints = dict(fingerprints)
+            else:
+                self.fingerprints.update(fingerprints)
+                for user in removed:
+                    self.fingerprints.pop(user, None)
+            for user in [user for user, key in self.keys.items()
+                         if self.fingerprints.get(user) != key.fingerprint]:
+                del self.keys[user]
+        if fingerprints or replace:
+            self.database.prune_pubkeys(fingerprints, replace)
+
+    def get(self, user):
+        """
+        Метод получения открытого ключа пользователя: из памяти, из базы
+        или, если сохранённого ключа нет или он устарел, с сервера.
+        Возвращает PublicKey или None, если ключа нет.
+        """
+        with self.lock:
+            fingerprint = self.fingerprints.get(user)
+            key = self.keys.get(user)
+        if fingerprint is not None:
+            if key is not None and key.fingerprint == fingerprint:
+                return key
+            stored = self.database.get_pubkey(user)
+            if stored and stored[0] == fingerprint:
+                key = PublicKey(stored[1], fingerprint)
+                with self.lock:
+                    self.keys[user] = key
+                return key
+        pem = self.fetch(user)
+        if not pem:
+            return None
+        key = PublicKey(pem)
+        if fingerprint is None:
+            return key
+        # Ключ мог смениться после получения отпечатков - сервер
+        # пришлёт новый отпечаток следующим изменением справочника.
+        if key.fingerprint != fingerprint:
+            logger.debug('Отпечаток ключа %s изменился', user)
+        self.database.save_pubkey(user, key.fingerprint, pem)
+        with self.lock:
+            self.fingerprints[user] = key.fingerprint
+            self.keys[user] = key
+        return key
+
+
+class OutboundKey:
+    """Класс - сеансовый ключ отправки сообщений одному собеседнику."""
+    __slots__ = ('public_key', 'key', 'wrapped', 'messages', 'created')
+
+    def __init__(self, public_key):
+        self.public_key = public_key
+        self.key = os.urandom(KEY_SIZE)
+        # Ключ шифруется открытым ключом собеседника один раз за сеанс.
+        self.wrapped = public_key.encrypter.encrypt(self.key)
+        self.messages = 0
+        self.created = time.monotonic()
+
+
+class SessionCipher:
+    """
+    Класс гибридного шифрования сообщений.
+    Для каждого собеседника создаётся сеансовый ключ AES-256-GCM,
+    зашифрованный его открытым ключом RSA-OAEP. Ключ меняется после
+    SESSION_KEY_MESSAGES сообщений, SESSION_KEY_LIFETIME секунд или
+    смены открытого ключа собеседника.
+
+    Формат сообщения: SESSION_PREFIX + base64(зашифрованный ключ |
+    одноразовый номер | тег | шифротекст). Зашифрованный ключ передаётся
+    в каждом сообщении, поэтому получатель может расшифровать любое из них,
+    а дорогая операция RSA выполняется им один раз на ключ - расшифрованные
+    ключи хранятся в LRU кэше. Имена отправителя и получателя
+    подписываются тегом GCM как дополнительные данные.
+    Сообщения без префикса расшифровываются прежним способом - RSA-OAEP.
+    Собственные ключи keys нужны только для расшифровки и могут быть
+    установлены позже методом set_keys.
+    """
+
+    def __init__(self, keys=None, max_messages=SESSION_KEY_MESSAGES,
+                 lifetime=SESSION_KEY_LIFETIME, cache_size=SESSION_KEY_CACHE):
+        self.decrypter = None
+        self.wrapped_size = None
+        if keys is not None:
+            self.set_keys(keys)
+        self.max_messages = max_messages
+        self.lifetime = lifetime
+        self.cache_size = cache_size
+        self.outbound = {}
+        # Кэш входящих ключей используется несколькими потоками расшифровки.
+        self.inbound = OrderedDict()
+        self.inbound_lock = threading.Lock()
+
+    def set_keys(self, keys):
+        """Метод установки собственных ключей пользователя."""
+        self.decrypter = PKCS1_OAEP.new(keys)
+        self.wrapped_size = keys.size_in_bytes()
+
+    @staticmethod
+    def associated_data(sender, destination):
+        return f'{sender}\n{destination}'.encode('utf-8')
+
+    def outbound_key(self, contact, public_key):
+        """Метод получения действующего сеансового ключа собеседника."""
+        session = self.outbound.get(contact)
+        if session is None or session.public_key.fingerprint != public_key.fingerprint \
+                or session.messages >= self.max_messages \
+                or time.monotonic() - session.created >= self.lifetime:
+            session = self.outbound[contact] = OutboundKey(public_key)
+        session.messages += 1
+        return session
+
+    def encrypt(self, sender, destination, public_key, text):
+        """
+        Метод шифрования сообщения для собеседника destination
+        с открытым ключом public_key (PublicKey). Возвращает строку.
+        """
+        session = self.outbound_key(destination, public_key)
+        nonce = os.urandom(NONCE_SIZE)
+        cipher = AES.new(session.key, AES.MODE_GCM, nonce=nonce)
+        cipher.update(self.associated_data(sender, destination))
+        ciphertext, tag = cipher.encrypt_and_digest(text.encode('utf-8'))
+        payload = base64.b64encode(session.wrapped + nonce + tag + ciphertext)
+        return SESSION_PREFIX + payload.decode('ascii')
+
+    def inbound_key(self, wrapped):
+        """Метод получения сеансового ключа из кэша или расшифровки RSA."""
+        with self.inbound_lock:
+            key = self.inbound.get(wrapped)
+            if key is not None:
+                self.inbound.move_to_end(wrapped)
+                return key
+        key = self.decrypter.decrypt(wrapped)
+        if len(key) != KEY_SIZE:
+            raise ValueError('Неверная длина сеансового ключа')
+        with self.inbound_lock:
+            self.inbound[wrapped] = key
+            if len(self.inbound) > self.cache_size:
+                self.inbound.popitem(last=False)
+        return key
+
+    def decrypt(self, sender, destination, text):
+        """
+        Метод расшифровки сообщения. При повреждении сообщения
+        выбрасывает ValueError.
+        """
+        if not text.startswith(SESSION_PREFIX):
+            return self.decrypter.decrypt(base64.b64decode(text)).decode('utf-8')
+        payload = base64.b64decode(text[len(SESSION_PREFIX):])
+        header = self.wrapped_size + NONCE_SIZE + TAG_SIZE
+        if len(payload) < header:
+            raise ValueError('Сообщение слишком короткое')
+        wrapped = payload[:self.wrapped_size]
+        nonce = payload[self.wrapped_size:self.wrapped_size + NONCE_SIZE]
+        tag = payload[self.wrapped_size + NONCE_SIZE:header]
+        cipher = AES.new(self.inbound_key(wrapped), AES.MODE_GCM, nonce=nonce)
+        cipher.update(self.associated_data(sender, destination))
+        return cipher.decrypt_and_verify(payload[header:], tag).decode('utf-8')
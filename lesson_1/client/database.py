@@ -1,10 +1,26 @@
 import datetime
 import os
 from common.variables import *
-from sqlalchemy import create_engine, Table, Column, Integer, String, DateTime, Text, MetaData
+from sqlalchemy import create_engine, Table, Column, Integer, String, DateTime, Text, MetaData, \
+    Index, inspect, select, func, tuple_, event, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import declarative_base, sessionmaker
 
 
+# Полнотекстовый индекс истории сообщений: таблица FTS5 с внешним
+# содержимым message_history и триггеры, поддерживающие её при записи.
+SEARCH_SCHEMA = (
+    "CREATE VIRTUAL TABLE message_search USING fts5("
+    "message, content='message_history', content_rowid='id', prefix='2 3 4')",
+    "CREATE TRIGGER message_search_insert AFTER INSERT ON message_history BEGIN "
+    "INSERT INTO message_search(rowid, message) VALUES (new.id, new.message); END",
+    "CREATE TRIGGER message_search_delete AFTER DELETE ON message_history BEGIN "
+    "INSERT INTO message_search(message_search, rowid, message) "
+    "VALUES ('delete', old.id, old.message); END",
+    "INSERT INTO message_search(message_search) VALUES ('rebuild')",
+)
+
+
 # Класс - база данных клиента.
 class ClientDatabase:
     Base = declarative_base()
@@ -14,6 +30,9 @@ class ClientDatabase:
         Класс - отображение таблицы известных пользователей.
         """
         __tablename__ = 'known_users'
+        __table_args__ = (
+            Index('ix_known_users_username', 'username', unique=True),
+        )
         id = Column(Integer, primary_key=True)
         username = Column(String)
 
@@ -26,6 +45,9 @@ class ClientDatabase:
         Класс - отображение таблицы статистики сообщений.
         """
         __tablename__ = 'message_history'
+        __table_args__ = (
+            Index('ix_message_history_contact_date', 'contact', 'date'),
+        )
         id = Column(Integer, primary_key=True)
         contact = Column(String)
         direction = Column(String)
@@ -51,6 +73,16 @@ class ClientDatabase:
             self.id = None
             self.name = contact
 
+    class PublicKeys(Base):
+        """
+        Класс - отображение таблицы сохранённых открытых ключей собеседников.
+        """
+        __tablename__ = 'public_keys'
+        id = Column(Integer, primary_key=True)
+        username = Column(String, unique=True)
+        fingerprint = Column(String)
+        pubkey = Column(Text)
+
     # Конструктор класса:
     def __init__(self, name):
         path = os.getcwd()
@@ -59,14 +91,43 @@ class ClientDatabase:
                                              echo=False,
                                              pool_recycle=7200,
                                              connect_args={'check_same_thread': False})
+        # Журнал WAL: чтение истории в GUI не ждёт записи пачек сообщений.
+        event.listen(self.database_engine, 'connect', self.set_pragmas)
 
         self.Base.metadata.create_all(self.database_engine)
+        self.migrate()
         Session = sessionmaker(bind=self.database_engine)
         self.session = Session()
 
-        # Необходимо очистить таблицу контактов, т.к. при запуске они подгружаются с сервера.
-        self.session.query(self.Contacts).delete()
-        self.session.commit()
+    @staticmethod
+    def set_pragmas(connection, record):
+        """Обработчик подключения к базе: включает журнал WAL."""
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute(f'PRAGMA synchronous={SQLITE_SYNCHRONOUS}')
+        cursor.close()
+
+    def migrate(self):
+        """
+        Метод обновления схемы существующей базы: создаёт индексы,
+        объявленные в описании таблиц, но отсутствующие в файле базы.
+        Перед созданием уникального индекса удаляются дубли строк.
+        """
+        with self.database_engine.begin() as connection:
+            inspector = inspect(connection)
+            for table in self.Base.metadata.sorted_tables:
+                existing = {index['name'] for index in inspector.get_indexes(table.name)}
+                for index in table.indexes:
+                    if index.name in existing:
+                        continue
+                    if index.unique:
+                        first_rows = select(func.min(table.c.id)).group_by(*index.columns)
+                        connection.execute(table.delete().where(table.c.id.not_in(first_rows)))
+                    index.create(connection)
+            # Полнотекстовый индекс строится по уже сохранённой истории один раз.
+            if 'message_search' not in inspector.get_table_names():
+                for statement in SEARCH_SCHEMA:
+                    connection.exec_driver_sql(statement)
 
     def add_contact(self, contact):
         """
@@ -88,25 +149,121 @@ class ClientDatabase:
         Метод удаления контакта.
         """
         self.session.query(self.Contacts).filter_by(name=contact).delete()
+        self.session.commit()
+
+    @staticmethod
+    def delete_names(connection, column, names):
+        """
+        Метод удаления строк с именами из names, списки
+        разбиваются на части из-за ограничения числа параметров SQLite.
+        """
+        names = list(names)
+        for start in range(0, len(names), SYNC_CHUNK):
+            connection.execute(column.table.delete().where(
+                column.in_(names[start:start + SYNC_CHUNK])))
+
+    def sync_names(self, column, names):
+        """
+        Метод синхронизации таблицы со списком имён с сервера: сравнивает
+        его с сохранёнными именами и одной транзакцией добавляет
+        недостающие и удаляет лишние. Возвращает кортеж (добавлено, удалено).
+        """
+        names = set(names)
+        with self.database_engine.begin() as connection:
+            current = set(connection.execute(select(column)).scalars())
+            added = names - current
+            removed = current - names
+            if added:
+                connection.execute(column.table.insert(), [{column.name: name} for name in added])
+            self.delete_names(connection, column, removed)
+        return len(added), len(removed)
+
+    def sync_contacts(self, contacts):
+        """Метод синхронизации списка контактов с ответом сервера."""
+        return self.sync_names(self.Contacts.__table__.c.name, contacts)
+
+    def sync_users(self, users):
+        """Метод синхронизации таблицы известных пользователей с ответом сервера."""
+        return self.sync_names(self.KnownUsers.__table__.c.username, users)
 
     def add_users(self, users_list):
         """
         Метод добавления известных пользователей.
-        Пользователи получаются только с сервера, поэтому при каждом обращении таблица очищается.
+        Пользователи получаются только с сервера, поэтому таблица
+        приводится к присланному списку.
         """
-        self.session.query(self.KnownUsers).delete()
-        for user in users_list:
-            user_row = self.KnownUsers(user)
-            self.session.add(user_row)
-        self.session.commit()
+        self.sync_users(users_list)
+
+    def update_users(self, added, removed):
+        """
+        Метод применения изменений справочника известных пользователей.
+        Удалённые пользователи исключаются и из списка контактов.
+        """
+        users = self.KnownUsers.__table__
+        with self.database_engine.begin() as connection:
+            if added:
+                connection.execute(sqlite_insert(users).on_conflict_do_nothing(),
+                                   [{'username': user} for user in added])
+            self.delete_names(connection, users.c.username, removed)
+            self.delete_names(connection, self.Contacts.__table__.c.name, removed)
+            self.delete_names(connection, self.PublicKeys.__table__.c.username, removed)
+
+    def get_pubkey(self, user):
+        """
+        Метод возвращающий сохранённый открытый ключ пользователя
+        кортежем (отпечаток, ключ) или None.
+        """
+        keys = self.PublicKeys.__table__
+        with self.database_engine.connect() as connection:
+            row = connection.execute(select(keys.c.fingerprint, keys.c.pubkey).where(
+                keys.c.username == user)).first()
+        return tuple(row) if row else None
+
+    def save_pubkey(self, user, fingerprint, pubkey):
+        """Метод сохранения (замены) открытого ключа пользователя."""
+        statement = sqlite_insert(self.PublicKeys.__table__).values(
+            username=user, fingerprint=fingerprint, pubkey=pubkey)
+        statement = statement.on_conflict_do_update(
+            index_elements=['username'],
+            set_={'fingerprint': statement.excluded.fingerprint,
+                  'pubkey': statement.excluded.pubkey})
+        with self.database_engine.begin() as connection:
+            connection.execute(statement)
+
+    def prune_pubkeys(self, fingerprints, replace=False):
+        """
+        Метод удаления сохранённых ключей, отпечатки которых не совпадают
+        с присланными сервером. При replace словарь fingerprints - полный
+        список отпечатков и удаляются также ключи отсутствующих в нём
+        пользователей.
+        """
+        keys = self.PublicKeys.__table__
+        with self.database_engine.begin() as connection:
+            stale = [user for user, fingerprint in connection.execute(
+                         select(keys.c.username, keys.c.fingerprint))
+                     if (replace or user in fingerprints)
+                     and fingerprints.get(user) != fingerprint]
+            self.delete_names(connection, keys.c.username, stale)
 
     def save_message(self, contact, direction, message):
         """
         Метод сохраняющий сообщения.
         """
-        message_row = self.MessageStat(contact, direction, message)
-        self.session.add(message_row)
-        self.session.commit()
+        self.save_messages([(contact, direction, message, datetime.datetime.now())])
+
+    def save_messages(self, messages):
+        """
+        Метод сохраняющий пачку сообщений одной транзакцией.
+        Принимает список кортежей (контакт, направление, текст, время).
+        Использует отдельное соединение, поэтому может вызываться
+        из потока записи истории.
+        """
+        if not messages:
+            return
+        with self.database_engine.begin() as connection:
+            connection.execute(self.MessageStat.__table__.insert(), [
+                {'contact': contact, 'direction': direction, 'message': message, 'date': date}
+                for contact, direction, message, date in messages])
 
     def get_contacts(self):
         """
@@ -146,6 +303,77 @@ class ClientDatabase:
         return [(history_row.contact, history_row.direction, history_row.message, history_row.date)
                 for history_row in query.all()]
 
+    def get_history_page(self, contact, limit=HISTORY_PAGE, before=None, after=None):
+        """
+        Метод возвращающий страницу истории переписки: не более limit
+        сообщений, предшествующих ключу before (кортеж (время, id) самого
+        старого уже загруженного сообщения) или следующих за ключом after,
+        без ключей - самые новые.
+        Сообщения упорядочены по времени, каждое - кортеж
+        (контакт, направление, текст, время, id).
+        Выборка идёт по индексу (contact, date) и не зависит от длины истории.
+        """
+        table = self.MessageStat.__table__
+        key = tuple_(table.c.date, table.c.id)
+        query = select(table.c.contact, table.c.direction, table.c.message,
+                       table.c.date, table.c.id).where(table.c.contact == contact)
+        if after is not None:
+            query = query.where(key > tuple_(*after)).order_by(
+                table.c.date, table.c.id).limit(limit)
+        else:
+            if before is not None:
+                query = query.where(key < tuple_(*before))
+            query = query.order_by(table.c.date.desc(), table.c.id.desc()).limit(limit)
+        with self.database_engine.connect() as connection:
+            rows = connection.execute(query).all()
+        if after is None:
+            rows.reverse()
+        return [tuple(row) for row in rows]
+
+    @staticmethod
+    def search_query(phrase, prefix=True):
+        """
+        Метод преобразования строки поиска в запрос FTS5: все слова
+        должны встречаться в сообщении, при prefix - как начала слов.
+        """
+        words = ''.join(char if char.isalnum() else ' ' for char in phrase).split()
+        return ' '.join(f'"{word}"*' if prefix else f'"{word}"' for word in words)
+
+    def search_history(self, phrase, contact=None, limit=SEARCH_LIMIT):
+        """
+        Метод полнотекстового поиска по истории сообщений.
+        Возвращает не более limit найденных сообщений, начиная с новых,
+        в виде кортежей (контакт, направление, фрагмент текста, время, id),
+        найденные слова во фрагменте выделены квадратными скобками.
+
+        Сначала слова ищутся целиком - такой запрос читает индекс лениво
+        и быстр даже для частых слов. Поиск по началам слов объединяет
+        списки всех подходящих слов, поэтому выполняется, только если
+        точных совпадений меньше limit.
+        """
+        if not self.search_query(phrase):
+            return []
+        sql = ("SELECT h.contact, h.direction, "
+               "snippet(message_search, 0, '[', ']', '...', 16), h.date, h.id "
+               "FROM message_search JOIN message_history AS h ON h.id = message_search.rowid "
+               "WHERE message_search MATCH :query")
+        if contact is not None:
+            sql += " AND h.contact = :contact"
+        sql += " ORDER BY message_search.rowid DESC LIMIT :limit"
+        table = self.MessageStat.__table__
+        statement = text(sql).columns(table.c.contact, table.c.direction, table.c.message,
+                                      table.c.date, table.c.id)
+        found = {}
+        with self.database_engine.connect() as connection:
+            for prefix in (False, True):
+                query = self.search_query(phrase, prefix)
+                for row in connection.execute(
+                        statement, {'query': query, 'contact': contact, 'limit': limit}):
+                    found.setdefault(row.id, tuple(row))
+                if len(found) >= limit:
+                    break
+        return [found[key] for key in sorted(found, reverse=True)[:limit]]
+
 
 # отладка
 
@@ -0,0 +1,161 @@
+from PyQt5.QtCore import QAbstractListModel, QModelIndex, Qt
+from PyQt5.QtGui import QBrush, QColor
+
+from common.variables import HISTORY_PAGE
+
+
+class HistoryModel(QAbstractListModel):
+    """
+    Класс - модель истории переписки для QListView.
+    Хранит только загруженные сообщения текущего собеседника в виде
+    кортежей (контакт, направление, текст, время, id), текст и оформление
+    строки формируются в момент запроса представлением.
+    Новые сообщения добавляются в конец методом append_records,
+    более ранние и, после перехода к найденному сообщению, более поздние
+    подгружаются страницами через canFetchMore / fetchMore.
+    """
+
+    def __init__(self, database, view=None, page_size=HISTORY_PAGE):
+        super().__init__()
+        self.database = database
+        # Представление, при прокрутке которого к началу разрешена подгрузка.
+        self.view = view
+        self.page_size = page_size
+        self.contact = None
+        self.rows = []
+        # Ключи (время, id) первого и последнего загруженных сообщений,
+        # если до или после них в базе есть ещё не загруженные.
+        self.cursor = None
+        self.newer = None
+        # Общие для всех строк кисти фона входящих и исходящих сообщений.
+        self.brushes = {'in': QBrush(QColor(255, 213, 213)), 'out': QBrush(QColor(204, 255, 204))}
+        self.alignments = {'in': int(Qt.AlignLeft | Qt.AlignVCenter),
+                           'out': int(Qt.AlignRight | Qt.AlignVCenter)}
+
+    def page_cursor(self, page, limit=None, last=False):
+        """
+        Метод возвращающий ключ (время, id) первого (last - последнего)
+        сообщения страницы page или None, если страница неполная
+        и дальше сообщений нет.
+        """
+        if not page or len(page) < (limit or self.page_size):
+            return None
+        item = page[-1] if last else page[0]
+        return item[3], item[4]
+
+    def set_contact(self, contact, around=None):
+        """
+        Метод загрузки переписки с собеседником: последней страницы
+        или, если задан ключ сообщения around (время, id), сообщений
+        вокруг него. Возвращает номер строки этого сообщения.
+        """
+        self.beginResetModel()
+        self.contact = contact
+        self.newer = None
+        if not contact:
+            self.rows = []
+            self.cursor = None
+        elif around is None:
+            self.rows = self.database.get_history_page(contact, self.page_size)
+            self.cursor = self.page_cursor(self.rows)
+        else:
+            half = self.page_size // 2
+            # Ключ (время, id + 1) включает в выборку само сообщение.
+            older = self.database.get_history_page(
+                contact, half + 1, before=(around[0], around[1] + 1))
+            newer = self.database.get_history_page(contact, half, after=around)
+            self.rows = older + newer
+            self.cursor = self.page_cursor(older, half + 1)
+            self.newer = self.page_cursor(newer, half, last=True)
+        self.endResetModel()
+        if around is not None:
+            for row, item in enumerate(self.rows):
+                if item[4] == around[1]:
+                    return row
+        return None
+
+    def clear(self):
+        """Метод очистки модели."""
+        self.set_contact(None)
+
+    def append_records(self, records):
+        """
+        Метод добавления в конец новых сообщений текущего собеседника
+        из пачки конвейера MessagePipeline. Пока загружена не последняя
+        страница, новые сообщения будут подгружены из базы вместе с ней.
+        """
+        if self.newer is not None:
+            return 0
+        rows = [(contact, direction, text, date, None)
+                for contact, direction, text, date in records
+                if contact == self.contact and text is not None]
+        if not rows:
+            return 0
+        self.beginInsertRows(QModelIndex(), len(self.rows), len(self.rows) + len(rows) - 1)
+        self.rows.extend(rows)
+        self.endInsertRows()
+        return len(rows)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        contact, direction, text, date, _ = self.rows[index.row()]
+        if role == Qt.DisplayRole:
+            title = 'Входящее' if direction == 'in' else 'Исходящее'
+            return f'{title} от {date.replace(microsecond=0)}:\n {text}'
+        if role == Qt.BackgroundRole:
+            return self.brushes.get(direction)
+        if role == Qt.TextAlignmentRole:
+            return self.alignments.get(direction)
+        return None
+
+    def flags(self, index):
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable
+
+    def fetch_direction(self):
+        """
+        Метод выбора направления подгрузки: 'older' при прокрутке
+        к началу списка, 'newer' - к концу, None - подгружать нечего.
+        Незаполненное представление догружает более ранние сообщения.
+        """
+        if self.view is None:
+            at_top = at_bottom = True
+        else:
+            scroll_bar = self.view.verticalScrollBar()
+            at_top = scroll_bar.value() == scroll_bar.minimum()
+            at_bottom = scroll_bar.value() == scroll_bar.maximum()
+        if at_top and self.cursor is not None:
+            return 'older'
+        if at_bottom and self.newer is not None:
+            return 'newer'
+        return None
+
+    def canFetchMore(self, parent=QModelIndex()):
+        """
+        Есть ли не загруженные сообщения в направлении прокрутки.
+        Представление само запрашивает подгрузку при прокрутке к концу
+        списка, к началу - обработчик прокрутки окна.
+        """
+        return not parent.isValid() and self.fetch_direction() is not None
+
+    def fetchMore(self, parent=QModelIndex()):
+        """Метод подгрузки страницы сообщений в направлении прокрутки."""
+        direction = None if parent.isValid() else self.fetch_direction()
+        if direction == 'older':
+            page = self.database.get_history_page(self.contact, self.page_size, self.cursor)
+            self.cursor = self.page_cursor(page)
+            if page:
+                self.beginInsertRows(QModelIndex(), 0, len(page) - 1)
+                self.rows[:0] = page
+                self.endInsertRows()
+        elif direction == 'newer':
+            page = self.database.get_history_page(
+                self.contact, self.page_size, after=self.newer)
+            self.newer = self.page_cursor(page, last=True)
+            if page:
+                self.beginInsertRows(QModelIndex(), len(self.rows), len(self.rows) + len(page) - 1)
+                self.rows.extend(page)
+                self.endInsertRows()
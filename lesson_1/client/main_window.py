@@ -1,16 +1,18 @@
-from PyQt5.QtWidgets import QMainWindow, qApp, QMessageBox, QApplication, QListView
-from PyQt5.QtGui import QStandardItemModel, QStandardItem, QBrush, QColor
+from PyQt5.QtWidgets import QMainWindow, qApp, QMessageBox, QApplication, QListView, \
+    QAbstractItemView, QLineEdit
+from PyQt5.QtGui import QStandardItemModel, QStandardItem
 from PyQt5.QtCore import pyqtSlot, QEvent, Qt
-from Cryptodome.Cipher import PKCS1_OAEP
-from Cryptodome.PublicKey import RSA
 import sys
 import json
 import logging
-import base64
 
 from client.main_window_conv import Ui_MainClientWindow
 from client.add_contact import AddContactDialog
 from client.del_contact import DelContactDialog
+from client.crypto import SessionCipher
+from client.pipeline import MessagePipeline
+from client.history_model import HistoryModel
+from client.search_dialog import SearchDialog
 from common.errors import ServerError
 from common.variables import *
 
@@ -26,14 +28,18 @@ class ClientMainWindow(QMainWindow):
     конвертированного файла main_window_conv.py.
     """
 
-    def __init__(self, database, transport, keys):
+    def __init__(self, database, transport, keys=None):
         super().__init__()
         # основные переменные
         self.database = database
         self.transport = transport
 
-        # объект - дешифровщик сообщений с установленным нами ключом.
-        self.decrypter = PKCS1_OAEP.new(keys)
+        # объект гибридного шифрования сообщений сеансовыми ключами AES.
+        # Ключи пользователя могут быть ещё не загружены - их передаст
+        # транспорт при запуске.
+        self.cipher = SessionCipher(keys)
+        # Конвейер расшифровки и записи истории вне потока GUI.
+        self.pipeline = MessagePipeline(database, self.cipher, transport.username)
 
         # Загружаем конфигурацию окна из дизайнера
         self.ui = Ui_MainClientWindow()
@@ -55,21 +61,52 @@ class ClientMainWindow(QMainWindow):
 
         # Дополнительные требующиеся атрибуты
         self.contacts_model = None
-        self.history_model = None
         self.messages = QMessageBox()
         self.current_chat = None
         self.current_chat_key = None
-        self.encryptor = None
         self.ui.list_messages.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
         self.ui.list_messages.setWordWrap(True)
+        # Модель истории загружает сообщения страницами, представление
+        # раскладывает строки порциями и не блокирует GUI на длинной истории.
+        self.history_model = HistoryModel(database, self.ui.list_messages)
+        self.ui.list_messages.setModel(self.history_model)
+        self.ui.list_messages.setLayoutMode(QListView.Batched)
+        self.ui.list_messages.setBatchSize(HISTORY_PAGE)
+        self.ui.list_messages.setVerticalScrollMode(QAbstractItemView.ScrollPerItem)
+        self.ui.list_messages.verticalScrollBar().valueChanged.connect(self.history_scrolled)
+        self.ui.list_messages.verticalScrollBar().rangeChanged.connect(
+            self.history_range_changed)
+        self.history_scroll_target = 0
+
+        # Строка поиска по истории сообщений рядом с заголовком истории.
+        self.ui.label_history.setGeometry(300, 0, 211, 21)
+        self.search_line = QLineEdit(self.ui.centralwidget)
+        self.search_line.setGeometry(520, 0, 221, 20)
+        self.search_line.setPlaceholderText('Поиск по истории')
+        self.search_line.returnPressed.connect(self.search_messages)
+        self.search_dialog = None
 
         # Даблклик по листу контактов отправляется в обработчик
         self.ui.list_contacts.doubleClicked.connect(self.select_active_user)
 
+        # Окно показывается сразу по данным базы клиента, действия,
+        # требующие сервера, доступны после подключения транспорта.
         self.clients_list_update()
         self.set_disabled_input()
+        self.set_online(self.transport.ready.is_set())
         self.show()
 
+    def set_online(self, online):
+        """
+        Метод активации элементов, требующих подключения к серверу:
+        добавления и удаления контактов.
+        """
+        for widget in (self.ui.btn_add_contact, self.ui.btn_remove_contact,
+                       self.ui.menu_add_contact, self.ui.menu_del_contact):
+            widget.setEnabled(online)
+        if not online:
+            self.statusBar().showMessage('Подключение к серверу...')
+
     # Деактивировать поля ввода
     def set_disabled_input(self):
         """
@@ -79,55 +116,57 @@ class ClientMainWindow(QMainWindow):
         self.ui.label_new_message.setText(
             'Для выбора получателя дважды кликните на нем в окне контактов.')
         self.ui.text_message.clear()
-        if self.history_model:
-            self.history_model.clear()
+        self.history_model.clear()
 
         # Поле ввода и кнопка отправки неактивны до выбора получателя.
         self.ui.btn_clear.setDisabled(True)
         self.ui.btn_send.setDisabled(True)
         self.ui.text_message.setDisabled(True)
 
-        self.encryptor = None
         self.current_chat = None
         self.current_chat_key = None
 
-    def history_list_update(self):
+    def history_list_update(self, around=None):
         """
         Метод заполняющий соответствующий QListView
-        историей переписки с текущим собеседником.
-        """
-        # Получаем историю, отсортированную по дате.
-        list = sorted(self.database.get_history(self.current_chat), key=lambda item: item[3])
-        # Если модель не создана, создадим.
-        if not self.history_model:
-            self.history_model = QStandardItemModel()
-            self.ui.list_messages.setModel(self.history_model)
-        # Очистим от старых записей
-        self.history_model.clear()
-        # Берём не более 20 последних записей.
-        length = len(list)
-        start_index = 0
-        if length > 20:
-            start_index = length - 20
-        # Заполнение модели записями, так-же стоит разделить входящие
-        # и исходящие выравниванием и разным фоном.
-        # Записи в обратном порядке, поэтому выбираем их с конца и не более 20
-        for i in range(start_index, length):
-            item = list[i]
-            if item[1] == 'in':
-                mess = QStandardItem(f'Входящее от {item[3].replace(microsecond=0)}:\n {item[2]}')
-                mess.setEditable(False)
-                mess.setBackground(QBrush(QColor(255, 213, 213)))
-                mess.setTextAlignment(Qt.AlignLeft)
-                self.history_model.appendRow(mess)
-            else:
-                mess = QStandardItem(
-                    f'Исходящее от {item[3].replace(microsecond=0)}:\n {item[2]}')
-                mess.setEditable(False)
-                mess.setTextAlignment(Qt.AlignRight)
-                mess.setBackground(QBrush(QColor(204, 255, 204)))
-                self.history_model.appendRow(mess)
-        self.ui.list_messages.scrollToBottom()
+        последней страницей истории переписки с текущим собеседником
+        или, если задан ключ сообщения around (время, id), сообщениями
+        вокруг него. Остальные сообщения подгружаются моделью при прокрутке.
+        """
+        self.history_scroll_target = 0
+        row = self.history_model.set_contact(self.current_chat, around)
+        if row is None:
+            self.ui.list_messages.scrollToBottom()
+            return
+        # Выделяем найденное сообщение и прокручиваем к нему
+        # после раскладки строк.
+        index = self.history_model.index(row, 0)
+        self.ui.list_messages.setCurrentIndex(index)
+        self.history_scroll_target = row
+
+    def history_scrolled(self, value):
+        """
+        Метод обработчик прокрутки истории: при достижении начала
+        списка подгружает предыдущую страницу сообщений.
+        """
+        if value != self.ui.list_messages.verticalScrollBar().minimum() \
+                or not self.history_model.canFetchMore():
+            return
+        rows = self.history_model.rowCount()
+        self.history_model.fetchMore()
+        # Оставляем на экране сообщение, бывшее первым до подгрузки,
+        # при прокрутке по строкам значение полосы - номер первой строки.
+        # Диапазон полосы обновится после отложенной раскладки новых строк.
+        self.history_scroll_target = self.history_model.rowCount() - rows
+
+    def history_range_changed(self, minimum, maximum):
+        """
+        Метод обработчик изменения диапазона полосы прокрутки истории:
+        восстанавливает позицию после подгрузки ранних сообщений.
+        """
+        if self.history_scroll_target and maximum >= self.history_scroll_target:
+            self.ui.list_messages.verticalScrollBar().setValue(self.history_scroll_target)
+            self.history_scroll_target = 0
 
     def select_active_user(self):
         """
@@ -139,28 +178,41 @@ class ClientMainWindow(QMainWindow):
         self.set_active_user()
 
     # Функция устанавливающая активного собеседника.
-    def set_active_user(self):
+    def set_active_user(self, around=None):
         """
-        Метод активации чата с собеседником.
+        Метод активации чата с собеседником. При заданном ключе
+        сообщения around история открывается на этом сообщении.
         """
-        # Запрашиваем публичный ключ пользователя и создаём объект шифрования.
+        # До подключения к серверу переписка открывается только для чтения.
+        if not self.transport.ready.is_set():
+            self.ui.label_new_message.setText(
+                f'Переписка с {self.current_chat}, ожидание подключения к серверу...')
+            self.history_list_update(around)
+            return
+        if self.activate_input():
+            # Заполняем окно историю сообщений по требуемому пользователю.
+            self.history_list_update(around)
+
+    def activate_input(self):
+        """
+        Метод получения ключа текущего собеседника и активации поля ввода.
+        Возвращает False, если ключа нет.
+        """
+        # Получаем публичный ключ пользователя из кэша, при его отсутствии
+        # или смене ключа - с сервера.
         try:
-            self.current_chat_key = self.transport.key_request(
+            self.current_chat_key = self.transport.public_keys.get(
                 self.current_chat)
             logger.debug(f'Загружен открытый ключ для {self.current_chat}')
-            if self.current_chat_key:
-                self.encryptor = PKCS1_OAEP.new(
-                    RSA.import_key(self.current_chat_key))
-        except (OSError, json.JSONDecodeError):
+        except (OSError, ValueError, json.JSONDecodeError):
             self.current_chat_key = None
-            self.encryptor = None
             logger.debug(f'Не удалось получить ключ для {self.current_chat}')
 
         # Если ключа нет - то ошибка, что не удалось начать чат с пользователем.
         if not self.current_chat_key:
             self.messages.warning(
                 self, 'Ошибка', 'Для выбранного пользователя нет ключа шифрования.')
-            return
+            return False
 
         # Ставим надпись и активируем кнопки.
         self.ui.label_new_message.setText(
@@ -168,9 +220,26 @@ class ClientMainWindow(QMainWindow):
         self.ui.btn_clear.setDisabled(False)
         self.ui.btn_send.setDisabled(False)
         self.ui.text_message.setDisabled(False)
+        return True
 
-        # Заполняем окно историю сообщений по требуемому пользователю.
-        self.history_list_update()
+    def search_messages(self):
+        """
+        Метод поиска по истории сообщений, открывает окно результатов.
+        """
+        phrase = self.search_line.text().strip()
+        if not phrase:
+            return
+        self.search_dialog = SearchDialog(self.database, phrase)
+        self.search_dialog.message_selected.connect(self.show_found_message)
+        self.search_dialog.show()
+
+    def show_found_message(self, contact, date, message_id):
+        """
+        Метод обработчик выбора результата поиска:
+        открывает переписку с контактом на найденном сообщении.
+        """
+        self.current_chat = contact
+        self.set_active_user(around=(date, message_id))
 
     def clients_list_update(self):
         """
@@ -269,13 +338,13 @@ class ClientMainWindow(QMainWindow):
         self.ui.text_message.clear()
         if not message_text:
             return
-        # Шифруем сообщение ключом получателя и упаковываем в base64.
-        message_text_encrypted = self.encryptor.encrypt(message_text.encode('utf8'))
-        message_text_encrypted_base64 = base64.b64encode(message_text_encrypted)
+        # Шифруем сообщение сеансовым ключом переписки с получателем.
+        message_text_encrypted = self.cipher.encrypt(
+            self.transport.username, self.current_chat,
+            self.current_chat_key, message_text)
         try:
             self.transport.send_message(
-                self.current_chat,
-                message_text_encrypted_base64.decode('ascii'))
+                self.current_chat, message_text_encrypted)
             pass
         except ServerError as err:
             self.messages.critical(self, 'Ошибка', err.text)
@@ -290,39 +359,35 @@ class ClientMainWindow(QMainWindow):
                 self, 'Ошибка', 'Потеряно соединение с сервером!')
             self.close()
         else:
-            self.database.save_message(self.current_chat, 'out', message_text)
-            logger.debug(
-                f'Отправлено сообщение для {self.current_chat}: {message_text}')
-            self.history_list_update()
+            # История обновится по сигналу конвейера после записи в базу.
+            self.pipeline.store(self.current_chat, 'out', message_text)
+            logger.debug('Отправлено сообщение для %s', self.current_chat)
 
-    @pyqtSlot(dict)
-    def message(self, message):
+    @pyqtSlot(list)
+    def message(self, records):
         """
-        Слот обработчик поступающих сообщений, выполняет дешифровку
-        поступающих сообщений и их сохранение в истории сообщений.
+        Слот обработчик пачки сообщений, расшифрованных и сохранённых
+        в истории конвейером MessagePipeline.
+        Добавляет в историю сообщения текущего собеседника.
         Запрашивает пользователя если пришло сообщение не от текущего
         собеседника. При необходимости меняет собеседника.
         """
-        # Получаем байт-строку.
-        encrypted_message = base64.b64decode(message[MESSAGE_TEXT])
-        # Декодируем строку, при ошибке выдаём сообщение и завершаем метод.
-        try:
-            decrypted_message = self.decrypter.decrypt(encrypted_message)
-        except (ValueError, TypeError):
+        if any(text is None for _, _, text, _ in records):
             self.messages.warning(
                 self, 'Ошибка', 'Не удалось декодировать сообщение.')
-            return
-        # Сохраняем сообщение в базу и обновляем историю сообщений
-        # или открываем новый чат.
-        self.database.save_message(
-            self.current_chat,
-            'in',
-            decrypted_message.decode('utf8'))
-
-        sender = message[SENDER]
-        if sender == self.current_chat:
-            self.history_list_update()
-        else:
+        contacts = {contact for contact, _, text, _ in records if text is not None}
+        if self.current_chat in contacts:
+            scroll_bar = self.ui.list_messages.verticalScrollBar()
+            at_bottom = scroll_bar.value() == scroll_bar.maximum()
+            self.history_model.append_records(records)
+            # Прокручиваем к новым сообщениям, если пользователь не читает старые.
+            if at_bottom:
+                self.ui.list_messages.scrollToBottom()
+        # Отправители входящих сообщений кроме текущего собеседника, без повторов.
+        senders = dict.fromkeys(
+            contact for contact, direction, text, _ in records
+            if direction == 'in' and text is not None and contact != self.current_chat)
+        for sender in senders:
             # Проверим есть ли такой пользователь у нас в контактах:
             if self.database.check_contact(sender):
                 # Если есть, запрашиваем о желании открыть с ним чат,
@@ -336,7 +401,6 @@ class ClientMainWindow(QMainWindow):
                     self.current_chat = sender
                     self.set_active_user()
             else:
-                print('NO')
                 # Если нет в контактах, запрос о добавлении юзера в контакты.
                 if self.messages.question(
                         self,
@@ -348,10 +412,6 @@ class ClientMainWindow(QMainWindow):
                         QMessageBox.No) == QMessageBox.Yes:
                     self.add_contact(sender)
                     self.current_chat = sender
-                    # Нужно заново сохранить сообщение, иначе оно будет потеряно,
-                    # т.к. на момент предыдущего вызова контакта не было.
-                    self.database.save_message(
-                        self.current_chat, 'in', decrypted_message.decode('utf8'))
                     self.set_active_user()
 
     @pyqtSlot()
@@ -363,6 +423,27 @@ class ClientMainWindow(QMainWindow):
         self.messages.warning(self, 'Сбой соединения', 'Потеряно соединение с сервером. ')
         self.close()
 
+    @pyqtSlot()
+    def transport_connected(self):
+        """
+        Слот обработчик завершения запуска транспорта: обновляет
+        список контактов и активирует ввод в открытой переписке.
+        """
+        self.statusBar().showMessage('Подключено', STATUS_TIMEOUT)
+        self.set_online(True)
+        self.clients_list_update()
+        if self.current_chat:
+            self.activate_input()
+
+    @pyqtSlot(str)
+    def startup_failed(self, text):
+        """
+        Слот обработчик ошибки подключения к серверу при запуске.
+        Выдаёт окно с ошибкой и завершает работу приложения.
+        """
+        self.messages.critical(self, 'Ошибка сервера', text)
+        self.close()
+
     @pyqtSlot()
     def sig_205(self):
         """
@@ -382,6 +463,14 @@ class ClientMainWindow(QMainWindow):
         """
         Метод обеспечивающий соединение сигналов и слотов.
         """
-        trans_obj.new_message.connect(self.message)
+        # Входящие сообщения передаются в конвейер прямо в потоке транспорта.
+        trans_obj.new_message.connect(self.pipeline.submit, Qt.DirectConnection)
+        self.pipeline.messages_ready.connect(self.message)
         trans_obj.connection_lost.connect(self.connection_lost)
         trans_obj.message_205.connect(self.sig_205)
+        # Ключи нужны конвейеру до первого входящего сообщения,
+        # поэтому устанавливаются прямо в потоке транспорта.
+        trans_obj.keys_ready.connect(self.cipher.set_keys, Qt.DirectConnection)
+        trans_obj.startup_progress.connect(self.statusBar().showMessage)
+        trans_obj.connected.connect(self.transport_connected)
+        trans_obj.startup_failed.connect(self.startup_failed)
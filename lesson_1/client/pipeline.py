@@ -0,0 +1,109 @@
+import datetime
+import logging
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from PyQt5.QtCore import pyqtSignal, QObject
+
+from common.variables import *
+
+logger = logging.getLogger('client')
+
+
+class MessagePipeline(QObject):
+    """
+    Класс - конвейер обработки сообщений вне потока GUI.
+    Входящие сообщения расшифровываются пулом потоков, поток записи
+    забирает результаты в порядке поступления, сохраняет их в историю
+    пачками по HISTORY_BATCH сообщений одной транзакцией и передаёт
+    пачку в GUI сигналом messages_ready.
+
+    Элемент пачки - кортеж (контакт, направление, текст, время),
+    текст равен None, если сообщение не удалось расшифровать.
+    """
+    messages_ready = pyqtSignal(list)
+
+    def __init__(self, database, cipher, username,
+                 workers=DECRYPT_WORKERS, batch_size=HISTORY_BATCH):
+        super().__init__()
+        self.database = database
+        self.cipher = cipher
+        self.username = username
+        self.batch_size = batch_size
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='decrypt')
+        # Очередь future в порядке поступления сообщений, None - завершение.
+        self.queue = queue.SimpleQueue()
+        self.writer = threading.Thread(target=self.run, name='history-writer', daemon=True)
+        self.writer.start()
+
+    def submit(self, message):
+        """
+        Метод постановки входящего сообщения в очередь расшифровки.
+        Вызывается из потока транспорта.
+        """
+        date = datetime.datetime.now()
+        future = self.executor.submit(self.decrypt, message, date)
+        # Отправитель и время нужны для записи, если расшифровка упала.
+        future.sender = message.get(SENDER)
+        future.date = date
+        self.queue.put(future)
+
+    def store(self, contact, direction, text):
+        """Метод постановки в очередь записи уже расшифрованного сообщения."""
+        future = Future()
+        future.set_result((contact, direction, text, datetime.datetime.now()))
+        self.queue.put(future)
+
+    def decrypt(self, message, date):
+        """Метод расшифровки сообщения, выполняется в пуле потоков."""
+        sender = message[SENDER]
+        try:
+            text = self.cipher.decrypt(sender, self.username, message[MESSAGE_TEXT])
+        except (ValueError, TypeError, KeyError):
+            logger.error('Не удалось расшифровать сообщение от %s', sender)
+            text = None
+        return sender, 'in', text, date
+
+    def run(self):
+        """Метод потока записи истории."""
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            # Забираем всё, что уже накопилось, но не больше размера пачки.
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                running = False
+                batch = batch[:batch.index(None)]
+            if not batch:
+                break
+            records = [self.result(future) for future in batch]
+            try:
+                self.database.save_messages([record for record in records
+                                             if record[2] is not None])
+            except Exception as err:
+                logger.error('Ошибка сохранения истории сообщений: %s', err)
+            self.messages_ready.emit(records)
+
+    @staticmethod
+    def result(future):
+        """
+        Метод получения записи истории из future. Непредвиденная ошибка
+        расшифровки не останавливает поток записи: сообщение сохраняется
+        как нерасшифрованное.
+        """
+        try:
+            return future.result()
+        except Exception as err:
+            logger.error('Ошибка обработки сообщения от %s: %s', future.sender, err)
+            return future.sender, 'in', None, future.date
+
+    def close(self):
+        """Метод завершения конвейера с записью накопленных сообщений."""
+        self.queue.put(None)
+        self.writer.join()
+        self.executor.shutdown()
@@ -0,0 +1,57 @@
+from PyQt5.QtGui import QStandardItemModel, QStandardItem
+from PyQt5.QtWidgets import QDialog, QLabel, QListView
+from PyQt5.QtCore import Qt, pyqtSignal
+import logging
+
+
+logger = logging.getLogger('client')
+
+
+# Диалог результатов поиска по истории сообщений
+class SearchDialog(QDialog):
+    """
+    Диалог результатов полнотекстового поиска по истории сообщений.
+    Двойной клик по результату открывает переписку на найденном
+    сообщении - испускается сигнал message_selected(контакт, время, id).
+    """
+    message_selected = pyqtSignal(str, object, int)
+
+    def __init__(self, database, phrase):
+        super().__init__()
+        self.database = database
+
+        self.setFixedSize(500, 400)
+        self.setWindowTitle('Поиск по истории сообщений')
+        self.setAttribute(Qt.WA_DeleteOnClose)
+
+        self.label = QLabel(self)
+        self.label.setFixedSize(480, 20)
+        self.label.move(10, 0)
+
+        self.results = QListView(self)
+        self.results.setFixedSize(480, 360)
+        self.results.move(10, 30)
+        self.results.setWordWrap(True)
+        self.results.setEditTriggers(QListView.NoEditTriggers)
+        self.results.doubleClicked.connect(self.select_result)
+
+        self.search(phrase)
+
+    def search(self, phrase):
+        """Метод выполнения поиска и заполнения списка результатов."""
+        found = self.database.search_history(phrase)
+        logger.debug('Поиск "%s": найдено %d сообщений', phrase, len(found))
+        self.label.setText(f'Найдено сообщений: {len(found)}. '
+                           f'Двойной клик - перейти к сообщению.')
+        model = QStandardItemModel()
+        for contact, direction, snippet, date, message_id in found:
+            arrow = 'от' if direction == 'in' else 'для'
+            item = QStandardItem(f'{date.replace(microsecond=0)} {arrow} {contact}:\n {snippet}')
+            item.setData((contact, date, message_id), Qt.UserRole)
+            model.appendRow(item)
+        self.results.setModel(model)
+
+    def select_result(self, index):
+        """Метод обработчик выбора результата поиска."""
+        contact, date, message_id = index.data(Qt.UserRole)
+        self.message_selected.emit(contact, date, message_id)
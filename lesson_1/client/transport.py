@@ -1,18 +1,23 @@
 import json
+import os
 import threading
 import time
 import socket
 import hashlib
 import hmac
 import binascii
+import itertools
+from collections import deque, OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 from PyQt5.QtCore import pyqtSignal, QObject
 
 from common.variables import *
 from common.utils import *
-from common.errors import ServerError
+from common.errors import ServerError, IncorrectDataReceivedError
+from client.crypto import PublicKeyCache, load_keys
 
 logger = logging.getLogger('client')
-# Объект блокировки сокета и работы с базой данных
+# Объект блокировки отправки в сокет и реестра запросов, ожидающих ответа.
 socket_lock = threading.Lock()
 
 
@@ -26,11 +31,23 @@ class ClientTransport(threading.Thread, QObject):
     new_message = pyqtSignal(dict)  # Новое сообщение.
     connection_lost = pyqtSignal()  # Потеря соединения.
     message_205 = pyqtSignal()  # Добавление / удаление клиента.
+    startup_progress = pyqtSignal(str)  # Очередной этап запуска.
+    keys_ready = pyqtSignal(object)  # Ключи пользователя загружены.
+    connected = pyqtSignal()  # Авторизация и обновление списков завершены.
+    startup_failed = pyqtSignal(str)  # Не удалось подключиться к серверу.
 
-    def __init__(self, port, ip_address, database, username, passwd, keys):
+    def __init__(self, port, ip_address, database, username, passwd, keys=None, key_file=None):
+        """
+        Соединение с сервером устанавливается в потоке транспорта (метод
+        startup), поэтому окно клиента может быть показано сразу.
+        Если ключи keys не переданы, они загружаются из файла key_file
+        или генерируются там же.
+        """
         # Вызываем конструкторы предков
         threading.Thread.__init__(self)
         QObject.__init__(self)
+        # Адрес сервера
+        self.address = (ip_address, port)
 
         # Класс База данных - работа с базой
         self.database = database
@@ -40,24 +57,61 @@ class ClientTransport(threading.Thread, QObject):
         self.password = passwd
         # Сокет для работы с сервером
         self.transport = None
+        # Потоковый декодер сообщений сервера и очередь уже принятых сообщений
+        self.decoder = MessageDecoder()
+        self.received = deque()
+        # Сообщения сервера, не являющиеся ответами на запросы, в порядке
+        # поступления. Обрабатываются основным циклом транспорта.
+        self.pushed = deque()
+        # Запросы, ожидающие ответа сервера, по идентификатору запроса.
+        self.pending = OrderedDict()
+        self.request_ids = itertools.count(1)
+        # Версия справочника пользователей, полученного с сервера.
+        self.directory_version = None
         # Набор ключей для шифрования
         self.keys = keys
+        self.key_file = key_file
+        # Кэш открытых ключей собеседников, сверяемый с отпечатками сервера.
+        self.public_keys = PublicKeyCache(database, self.key_request)
+        # Флаг продолжения работы транспорта.
+        self.running = True
+        # Событие завершения запуска: соединение установлено, списки обновлены.
+        self.ready = threading.Event()
+
+    def startup(self):
+        """
+        Метод запуска транспорта: загрузка или генерация ключей,
+        подключение к серверу с авторизацией и обновление таблиц
+        известных пользователей и контактов. Этапы сообщаются сигналом
+        startup_progress, при неудаче выбрасывается ServerError.
+        """
+        if self.keys is None:
+            if os.path.exists(self.key_file):
+                self.startup_progress.emit('Загрузка ключей шифрования...')
+            else:
+                self.startup_progress.emit('Генерация ключей шифрования...')
+            try:
+                self.keys = load_keys(self.key_file)
+            except (OSError, ValueError) as err:
+                logger.critical('Не удалось загрузить ключи шифрования: %s', err)
+                raise ServerError('Не удалось загрузить ключи шифрования.')
+            logger.debug('Keys successfully loaded.')
+        self.keys_ready.emit(self.keys)
         # Устанавливаем соединение:
-        self.connection_init(ip_address, port)
+        self.connection_init(*self.address)
         # Обновляю таблицы известных пользователей и контактов.
+        self.startup_progress.emit('Обновление списков контактов...')
         try:
-            self.user_list_update()
-            self.contacts_list_update()
+            self.lists_update()
         except OSError as err:
             if err.errno:
-                logger.critical(f'Потеряно соединение с сервером. Ошибка: {err}')
+                logger.critical('Потеряно соединение с сервером. Ошибка: %s', err)
                 raise ServerError('Потеряно соединение с сервером!')
             logger.error('Timeout соединения при обновлении списков пользователей.')
-        except json.JSONDecodeError as err:
-            logger.critical(f'Потеряно соединение с сервером.Ошибка: {err}')
+        except (json.JSONDecodeError, IncorrectDataReceivedError) as err:
+            logger.critical('Потеряно соединение с сервером.Ошибка: %s', err)
             raise ServerError('Потеряно соединение с сервером!')
-        # Флаг продолжения работы транспорта.
-        self.running = True
+        self.ready.set()
 
     def connection_init(self, ip, port):
         """
@@ -70,7 +124,11 @@ class ClientTransport(threading.Thread, QObject):
         # Пытаюсь соединиться с сервером. Количество попыток ATTEMPTS = 5.
         connected = False
         for i in range(ATTEMPTS):
-            logger.info(f'Попытка подключения к серверу № 0{i + 1}')
+            # Клиент могли закрыть, не дождавшись подключения.
+            if not self.running:
+                break
+            logger.info('Попытка подключения к серверу № 0%s', i + 1)
+            self.startup_progress.emit(f'Подключение к серверу, попытка {i + 1}...')
             try:
                 self.transport.connect((ip, port))
             except (OSError, ConnectionRefusedError):
@@ -87,6 +145,7 @@ class ClientTransport(threading.Thread, QObject):
             raise ServerError('Не удалось установить соединение с сервером.')
 
         logger.debug('Запуск диалога авторизации.')
+        self.startup_progress.emit('Авторизация...')
         # Запускаем процедуру авторизации.
         # Получаем хэш пароля.
         passwd_bytes = self.password.encode('utf-8')
@@ -94,7 +153,7 @@ class ClientTransport(threading.Thread, QObject):
         passwd_hash = hashlib.pbkdf2_hmac('sha512', passwd_bytes, salt, 10000)
         passwd_hash_string = binascii.hexlify(passwd_hash)
 
-        logger.debug(f'Passwd hash ready: {passwd_hash_string}')
+        logger.debug('Passwd hash ready: %s', passwd_hash_string)
 
         # Получаем публичный ключ и декодируем его из байтов.
         pubkey = self.keys.publickey().export_key().decode('ascii')
@@ -107,14 +166,16 @@ class ClientTransport(threading.Thread, QObject):
                 USER: {
                     ACCOUNT_NAME: self.username,
                     PUBLIC_KEY: pubkey
-                }
+                },
+                FRAMING: FRAMING_LENGTH_PREFIX,
+                DIRECTORY: DIRECTORY_DELTA
             }
-            logger.debug(f"Presence message = {presense}")
+            logger.debug('Presence message = %s', presense)
             # Отправляем серверу приветственное сообщение.
             try:
-                send_message(self.transport, presense)
-                ans = get_message(self.transport)
-                logger.debug(f'Server response = {ans}.')
+                self.write_message(presense)
+                ans = self.read_message()
+                logger.debug('Server response = %s.', ans)
                 # Если сервер вернул ошибку, бросаем исключение.
                 if RESPONSE in ans:
                     if ans[RESPONSE] == 400:
@@ -123,23 +184,125 @@ class ClientTransport(threading.Thread, QObject):
                         # Если всё нормально, то продолжаем процедуру
                         # авторизации.
                         ans_data = ans[DATA]
+                        # Сервер подтвердил передачу с заголовком длины -
+                        # со следующего сообщения переходим на этот формат.
+                        if ans.get(FRAMING) == FRAMING_LENGTH_PREFIX:
+                            self.decoder.switch_to_framed()
                         hash = hmac.new(
                             passwd_hash_string, ans_data.encode('utf-8'), 'MD5')
                         digest = hash.digest()
                         my_ans = RESPONSE_511
                         my_ans[DATA] = binascii.b2a_base64(
                             digest).decode('ascii')
-                        send_message(self.transport, my_ans)
-                        self.process_server_ans(get_message(self.transport))
-            except (OSError, json.JSONDecodeError) as err:
-                logger.debug(f'Connection error.', exc_info=err)
+                        self.write_message(my_ans)
+                        self.process_server_ans(self.read_message())
+            except (OSError, json.JSONDecodeError, IncorrectDataReceivedError) as err:
+                logger.debug('Connection error.', exc_info=err)
                 raise ServerError('Сбой соединения в процессе авторизации.')
 
+    def write_message(self, message):
+        """
+        Метод отправки словаря серверу в согласованном формате.
+        """
+        send_message(self.transport, message, self.decoder.framed)
+
+    def read_message(self):
+        """
+        Метод получения очередного сообщения сервера.
+        Сообщения, принятые одним чтением из сокета, возвращаются по очереди.
+        """
+        while not self.received:
+            data = self.transport.recv(RECV_BUFFER_LENGTH)
+            if not data:
+                raise ConnectionResetError('Сервер закрыл соединение.')
+            self.received.extend(self.decoder.feed(data))
+        return self.received.popleft()
+
+    def submit(self, request):
+        """
+        Метод отправки запроса серверу без ожидания ответа.
+        Запросу присваивается идентификатор, по которому ответ сервера
+        передаётся в возвращаемый объект Future. Несколько запросов
+        могут ожидать ответа одновременно.
+        """
+        future = Future()
+        with socket_lock:
+            request_id = next(self.request_ids)
+            request[REQUEST_ID] = request_id
+            future.request_id = request_id
+            self.pending[request_id] = future
+            try:
+                self.write_message(request)
+            except OSError:
+                del self.pending[request_id]
+                raise
+        return future
+
+    def wait_response(self, future):
+        """
+        Метод ожидания ответа на отправленный запрос.
+        Ответы разбирает поток транспорта, а пока он не запущен (или ответ
+        ожидается в нём самом) сообщения сервера читаются здесь же.
+        При таймауте запрос снимается с ожидания, чтобы запоздавший ответ
+        не был передан следующему запросу, и выбрасывается socket.timeout.
+        """
+        try:
+            if self.is_alive() and threading.current_thread() is not self:
+                try:
+                    return future.result(RESPONSE_TIMEOUT)
+                except FutureTimeoutError:
+                    # До Python 3.11 это не OSError - приводим к таймауту сокета.
+                    raise socket.timeout('Превышено время ожидания ответа сервера.')
+            deadline = time.monotonic() + RESPONSE_TIMEOUT
+            while not future.done():
+                try:
+                    message = self.read_message()
+                except socket.timeout:
+                    if time.monotonic() > deadline:
+                        raise
+                    continue
+                self.dispatch_message(message)
+            return future.result()
+        except socket.timeout:
+            with socket_lock:
+                self.pending.pop(future.request_id, None)
+            raise
+
+    def request(self, request):
+        """Метод отправки запроса серверу и получения ответа."""
+        return self.wait_response(self.submit(request))
+
+    def dispatch_message(self, message):
+        """
+        Метод разбора принятого сообщения: ответ передаётся ожидающему его
+        запросу, остальные сообщения (сообщения пользователей, изменения
+        справочника) откладываются для основного цикла транспорта.
+        """
+        if RESPONSE in message and message[RESPONSE] != 205:
+            with socket_lock:
+                future = self.pending.pop(message.get(REQUEST_ID), None)
+                # Сервер без поддержки идентификаторов отвечает на запросы по порядку.
+                if future is None and REQUEST_ID not in message and self.pending:
+                    future = self.pending.popitem(last=False)[1]
+            if future is None:
+                logger.error('Получен ответ на неизвестный запрос: %s', message)
+            else:
+                future.set_result(message)
+        else:
+            self.pushed.append(message)
+
+    def fail_pending(self):
+        """Метод завершения ожидающих ответа запросов при потере соединения."""
+        with socket_lock:
+            pending, self.pending = self.pending, OrderedDict()
+        for future in pending.values():
+            future.set_exception(ConnectionResetError('Потеряно соединение с сервером.'))
+
     def process_server_ans(self, message):
         """
         Метод-обработчик сообщений поступающих с сервера.
         """
-        logger.debug(f'Разбор сообщения от сервера: {message}')
+        logger.debug('Разбор сообщения от сервера: %s', message)
 
         # Если это подтверждение чего-либо
         if RESPONSE in message:
@@ -148,108 +311,142 @@ class ClientTransport(threading.Thread, QObject):
             elif message[RESPONSE] == 400:
                 raise ServerError(f'{message[ERROR]}')
             elif message[RESPONSE] == 205:
-                self.user_list_update()
-                self.contacts_list_update()
+                self.lists_update()
                 self.message_205.emit()
             else:
                 logger.error(
-                    f'Получен неизвестный код подтверждения {message[RESPONSE]}')
+                    'Получен неизвестный код подтверждения %s', message[RESPONSE])
 
         # Если это сообщение от пользователя, то добавляем его в базу,
         # даём сигнал о новом сообщении.
         elif ACTION in message and message[ACTION] == MESSAGE and SENDER in message and DESTINATION in message \
                 and MESSAGE_TEXT in message and message[DESTINATION] == self.username:
             logger.debug(
-                f'Получено сообщение от пользователя {message[SENDER]}:{message[MESSAGE_TEXT]}')
+                'Получено сообщение от пользователя %s:%s', message[SENDER], message[MESSAGE_TEXT])
             self.new_message.emit(message)
 
-    def contacts_list_update(self):
+        # Если это изменения справочника пользователей.
+        elif message.get(ACTION) == USERS_UPDATE and DIRECTORY_VERSION in message:
+            self.directory_update(message)
+            self.message_205.emit()
+
+    def directory_update(self, message):
         """
-        Метод обновляющий контакт-лист с сервера.
+        Метод применения изменений справочника пользователей.
+        Изменения применяются, если версия следует за известной клиенту,
+        уже учтённые версии пропускаются, при пропуске версий списки
+        пользователей и контактов запрашиваются с сервера целиком.
         """
-        self.database.contacts_clear()
-        logger.debug(f'Запрос контакт-листа для пользователя {self.name}')
-        req = {
+        version = message[DIRECTORY_VERSION]
+        if self.directory_version is not None and version <= self.directory_version:
+            return
+        if self.directory_version is not None and version == self.directory_version + 1:
+            logger.debug('Изменения справочника пользователей, версия %s', version)
+            self.database.update_users(message.get(USERS_ADDED, []), message.get(USERS_REMOVED, []))
+            self.public_keys.update(message.get(KEY_FINGERPRINTS, {}), message.get(USERS_REMOVED, []))
+            self.directory_version = version
+        else:
+            logger.info('Пропуск версий справочника пользователей, полное обновление.')
+            self.lists_update()
+
+    def contacts_request(self):
+        """Метод отправки запроса контакт-листа, возвращает Future ответа."""
+        logger.debug('Запрос контакт-листа для пользователя %s', self.username)
+        return self.submit({
             ACTION: GET_CONTACTS,
             TIME: time.time(),
             USER: self.username
-        }
-        logger.debug(f'Сформирован запрос {req}')
-        with socket_lock:
-            send_message(self.transport, req)
-            ans = get_message(self.transport)
-        logger.debug(f'Получен ответ {ans}')
+        })
+
+    def contacts_apply(self, ans):
+        """Метод заполнения контакт-листа из ответа сервера."""
+        logger.debug('Получен ответ %s', ans)
         if RESPONSE in ans and ans[RESPONSE] == 202:
-            for contact in ans[LIST_INFO]:
-                self.database.add_contact(contact)
+            self.database.sync_contacts(ans[LIST_INFO])
         else:
             logger.error('Не удалось обновить список контактов.')
 
-    def user_list_update(self):
+    def contacts_list_update(self):
         """
-        Метод для обновления таблицы известных пользователей.
+        Метод обновляющий контакт-лист с сервера.
         """
-        logger.debug(f'Запрос списка известных пользователей {self.username}')
-        req = {
+        self.contacts_apply(self.wait_response(self.contacts_request()))
+
+    def user_list_request(self):
+        """Метод отправки запроса известных пользователей, возвращает Future ответа."""
+        logger.debug('Запрос списка известных пользователей %s', self.username)
+        return self.submit({
             ACTION: USERS_REQUEST,
             TIME: time.time(),
             ACCOUNT_NAME: self.username
-        }
-        with socket_lock:
-            send_message(self.transport, req)
-            ans = get_message(self.transport)
+        })
+
+    def user_list_apply(self, ans):
+        """Метод заполнения таблицы известных пользователей из ответа сервера."""
         if RESPONSE in ans and ans[RESPONSE] == 202:
-            self.database.add_users(ans[LIST_INFO])
+            self.database.sync_users(ans[LIST_INFO])
+            self.public_keys.update(ans.get(KEY_FINGERPRINTS, {}), replace=True)
+            self.directory_version = ans.get(DIRECTORY_VERSION)
         else:
             logger.error('Не удалось обновить список известных пользователей.')
 
+    def user_list_update(self):
+        """
+        Метод для обновления таблицы известных пользователей.
+        """
+        self.user_list_apply(self.wait_response(self.user_list_request()))
+
+    def lists_update(self):
+        """
+        Метод обновления таблиц известных пользователей и контактов.
+        Оба запроса отправляются сразу, без ожидания ответа на первый.
+        """
+        users = self.user_list_request()
+        contacts = self.contacts_request()
+        self.user_list_apply(self.wait_response(users))
+        self.contacts_apply(self.wait_response(contacts))
+
     def key_request(self, user):
         """
         Метод запрашивающий с сервера публичный ключ пользователя.
         """
-        logger.debug(f'Запрос публичного ключа для {user}')
+        logger.debug('Запрос публичного ключа для %s', user)
         req = {
             ACTION: PUBLIC_KEY_REQUEST,
             TIME: time.time(),
             ACCOUNT_NAME: user
         }
-        with socket_lock:
-            send_message(self.transport, req)
-            ans = get_message(self.transport)
+        ans = self.request(req)
         if RESPONSE in ans and ans[RESPONSE] == 511:
             return ans[DATA]
         else:
-            logger.error(f'Не удалось получить ключ собеседника{user}.')
+            logger.error('Не удалось получить ключ собеседника%s.', user)
 
     def add_contact(self, contact):
         """
         Метод отправляющий на сервер сведения о добавлении контакта.
         """
-        logger.debug(f'Создание контакта {contact}')
+        logger.debug('Создание контакта %s', contact)
         req = {
             ACTION: ADD_CONTACT,
             TIME: time.time(),
             USER: self.username,
             ACCOUNT_NAME: contact
         }
-        with socket_lock:
-            send_message(self.transport, req)
-            self.process_server_ans(get_message(self.transport))
+        self.process_server_ans(self.request(req))
 
     def remove_contact(self, contact):
         """
         Метод отправляющий на сервер сведения об удалении контакта.
         """
-        logger.debug(f'Удаление контакта {contact}')
+        logger.debug('Удаление контакта %s', contact)
         req = {
             ACTION: REMOVE_CONTACT,
             TIME: time.time(),
             USER: self.username,
             ACCOUNT_NAME: contact
         }
-        with socket_lock:
-            send_message(self.transport, req)
-            self.process_server_ans(get_message(self.transport))
+        self.process_server_ans(self.request(req))
 
     def transport_shutdown(self):
         """
@@ -264,7 +461,8 @@ class ClientTransport(threading.Thread, QObject):
         }
         with socket_lock:
             try:
-                send_message(self.transport, message)
+                if self.ready.is_set():
+                    self.write_message(message)
             except OSError:
                 pass
         logger.debug('Транспорт завершает работу.')
@@ -281,40 +479,48 @@ class ClientTransport(threading.Thread, QObject):
             TIME: time.time(),
             MESSAGE_TEXT: message
         }
-        logger.debug(f'Сформирован словарь сообщения: {message_dict}')
+        logger.debug('Сформирован словарь сообщения: %s', message_dict)
 
-        # Необходимо дождаться освобождения сокета для отправки сообщения.
-        with socket_lock:
-            send_message(self.transport, message_dict)
-            self.process_server_ans(get_message(self.transport))
-            logger.info(f'Отправлено сообщение для пользователя {to}')
+        self.process_server_ans(self.request(message_dict))
+        logger.info('Отправлено сообщение для пользователя %s', to)
 
     def run(self):
         """
         Метод содержащий основной цикл работы транспортного потока.
+        Поток читает сообщения сервера, передаёт ответы ожидающим их
+        запросам и сразу обрабатывает остальные сообщения.
         """
+        try:
+            # Запуск мог быть выполнен до старта потока.
+            if not self.ready.is_set():
+                self.startup()
+        except ServerError as error:
+            if self.running:
+                self.running = False
+                self.startup_failed.emit(error.text)
+            if self.transport is not None:
+                self.transport.close()
+            return
+        self.connected.emit()
         logger.debug('Запущен процесс - приёмник сообщений с сервера.')
+        # Короткий таймаут нужен для проверки флага завершения работы.
+        self.transport.settimeout(0.5)
         while self.running:
-            # Остановка на секунду, после попытка захватить сокет.
-            time.sleep(1)
-            message = None
-            with socket_lock:
+            while self.pushed:
+                message = self.pushed.popleft()
+                logger.debug('Принято сообщение с сервера: %s', message)
                 try:
-                    self.transport.settimeout(0.5)
-                    message = get_message(self.transport)
-                except OSError as err:
-                    if err.errno:
-                        logger.critical(f'Потеряно соединение с сервером.')
-                        self.running = False
-                        self.connection_lost.emit()
-                # Проблемы с соединением
-                except (
-                        ConnectionError, ConnectionAbortedError, ConnectionResetError,
-                        json.JSONDecodeError, TypeError):
-                    logger.debug(f'Потеряно соединение с сервером.')
+                    self.process_server_ans(message)
+                except (OSError, ServerError) as err:
+                    logger.error('Ошибка обработки сообщения сервера: %s', err)
+            try:
+                self.dispatch_message(self.read_message())
+            except socket.timeout:
+                continue
+            # Проблемы с соединением
+            except (OSError, json.JSONDecodeError, TypeError, IncorrectDataReceivedError):
+                if self.running:
+                    logger.critical('Потеряно соединение с сервером.')
                     self.running = False
                     self.connection_lost.emit()
-                # Если сообщение получено, то вызываем функцию обработчик:
-                if message:
-                    logger.debug(f'Принято сообщение с сервера: {message}')
-                    self.process_server_ans(message)
+        self.fail_pending()
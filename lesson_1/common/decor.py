@@ -1,8 +1,8 @@
-import socket
 import logging
 import logs.config_client_log
 import logs.config_server_log
 import sys
+from functools import wraps
 
 sys.path.append('../')
 
@@ -21,52 +21,17 @@ def log(func_to_log):
     Сохраняет события типа debug, содержащие
     информацию о имени вызываемой функиции, параметры с которыми
     вызывается функция, и модуль, вызывающий функцию.
+    Строка сообщения формируется только при включённом уровне debug.
     '''
 
+    @wraps(func_to_log)
     def log_saver(*args, **kwargs):
-        logger.debug(
-            f'Была вызвана функция {func_to_log.__name__} c параметрами {args} , {kwargs}. Вызов из модуля {func_to_log.__module__}')
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                'Была вызвана функция %s c параметрами %s , %s. Вызов из модуля %s',
+                func_to_log.__name__, args, kwargs, func_to_log.__module__)
         ret = func_to_log(*args, **kwargs)
         return ret
 
     return log_saver
 
-
-def login_required(func):
-    '''
-    Декоратор, проверяющий, что клиент авторизован на сервере.
-    Проверяет, что передаваемый объект сокета находится в
-    списке авторизованных клиентов.
-    За исключением передачи словаря-запроса
-    на авторизацию. Если клиент не авторизован,
-    генерирует исключение TypeError
-    '''
-
-    def checker(*args, **kwargs):
-        # проверяем, что первый аргумент - экземпляр MessageProcessor
-        # Импортить необходимо тут, иначе ошибка рекурсивного импорта.
-        from server.core import MessageProcessor
-        from common.variables import ACTION, PRESENCE
-        if isinstance(args[0], MessageProcessor):
-            found = False
-            for arg in args:
-                if isinstance(arg, socket.socket):
-                    # Проверяем, что данный сокет есть в списке names класса
-                    # MessageProcessor
-                    for client in args[0].names:
-                        if args[0].names[client] == arg:
-                            found = True
-
-            # Теперь надо проверить, что передаваемые аргументы не presence
-            # сообщение. Если presense, то разрешаем
-            for arg in args:
-                if isinstance(arg, dict):
-                    if ACTION in arg and arg[ACTION] == PRESENCE:
-                        found = True
-            # Если не авторизован и не сообщение начала авторизации, то
-            # вызываем исключение.
-            if not found:
-                raise TypeError
-        return func(*args, **kwargs)
-
-    return checker
@@ -1,8 +1,12 @@
+import codecs
+import hashlib
 import json
+import struct
 import sys
 
 sys.path.append('../')
 from common.variables import *
+from common.errors import IncorrectDataReceivedError
 from common.decor import log
 
 
@@ -16,21 +20,156 @@ def get_message(sock):
 
     encoded_response = sock.recv(MAX_PACKAGE_LENGTH)
     if isinstance(encoded_response, bytes):
-        json_response = encoded_response.decode(ENCODING)
-        response = json.loads(json_response)
-        if isinstance(response, dict):
-            return response
-        else:
-            raise TypeError
+        return decode_message(encoded_response)
+
+
+def decode_message(encoded_message):
+    """
+    Функция декодирования принятых байтов в словарь.
+    При несоответствии данных отдает ошибку значения.
+    """
+    json_response = encoded_message.decode(ENCODING)
+    response = json.loads(json_response)
+    if isinstance(response, dict):
+        return response
+    else:
+        raise TypeError
+
+
+def encode_message(message, framed=False):
+    """
+    Функция кодирования словаря в байты для отправки.
+    При framed=True перед сообщением добавляется заголовок с его длиной.
+    """
+    if not isinstance(message, dict):
+        raise TypeError
+    encoded_message = json.dumps(message).encode(ENCODING)
+    if not framed:
+        return encoded_message
+    if len(encoded_message) > MAX_FRAME_LENGTH:
+        raise ValueError('Превышена максимальная длина сообщения.')
+    return struct.pack('>I', len(encoded_message)) + encoded_message
+
+
+def key_fingerprint(public_key):
+    """
+    Функция вычисления отпечатка открытого ключа (PEM строки) -
+    шестнадцатеричной записи его хэша SHA-256.
+    """
+    return hashlib.sha256(public_key.encode('ascii')).hexdigest()
 
 
 @log
-def send_message(sock, message):
+def send_message(sock, message, framed=False):
     """
     Функция отправки словарей через сокет.
     Функция принимает словарь, извлекает из него строку,
     строку кодирует в байты и отправляет.
+    Сообщение с заголовком длины отправляется целиком (sendall), так как
+    частичная отправка нарушит разбор последующих сообщений.
     """
-    js_message = json.dumps(message)
-    encoded_message = js_message.encode(ENCODING)
-    sock.send(encoded_message)
+    if framed:
+        sock.sendall(encode_message(message, framed))
+    else:
+        sock.send(encode_message(message, framed))
+
+
+class MessageDecoder:
+    """
+    Потоковый декодер сообщений одного соединения.
+    Принимает байты в том виде, в каком они пришли из сокета, и
+    возвращает все полностью принятые сообщения. Неполный хвост
+    сохраняется до следующего вызова feed.
+
+    Поддерживает два формата:
+    * framed=False - JSON-объекты подряд, как отправляют старые клиенты;
+    * framed=True - каждому сообщению предшествует 4-байтовая длина.
+    """
+    json_decoder = json.JSONDecoder()
+
+    def __init__(self, framed=False):
+        self.framed = framed
+        self.buffer = bytearray()
+        self.text = ''
+        self.text_decoder = codecs.getincrementaldecoder(ENCODING)()
+
+    def feed(self, data):
+        """Метод разбора очередной порции байтов, возвращает список словарей."""
+        if self.framed:
+            self.buffer.extend(data)
+            return self.read_frames()
+        self.text += self.text_decoder.decode(data)
+        return self.read_objects()
+
+    def read_frames(self):
+        """Метод выделения сообщений с заголовком длины из буфера."""
+        messages = []
+        buffer = self.buffer
+        offset = 0
+        while len(buffer) - offset >= FRAME_HEADER_LENGTH:
+            length, = struct.unpack_from('>I', buffer, offset)
+            if length > MAX_FRAME_LENGTH:
+                raise IncorrectDataReceivedError
+            end = offset + FRAME_HEADER_LENGTH + length
+            if len(buffer) < end:
+                break
+            messages.append(decode_message(bytes(buffer[offset + FRAME_HEADER_LENGTH:end])))
+            offset = end
+        del buffer[:offset]
+        return messages
+
+    def read_objects(self):
+        """Метод выделения идущих подряд JSON-объектов из буфера."""
+        messages = []
+        text = self.text.lstrip()
+        while text:
+            try:
+                message, end = self.json_decoder.raw_decode(text)
+            except json.JSONDecodeError:
+                # Объект обрывается на конце буфера - ждём продолжения.
+                if text[0] == '{' and len(text) <= MAX_FRAME_LENGTH and \
+                        self.object_end(text) is None:
+                    break
+                raise
+            if not isinstance(message, dict):
+                raise TypeError
+            messages.append(message)
+            text = text[end:].lstrip()
+        self.text = text
+        return messages
+
+    @staticmethod
+    def object_end(text):
+        """
+        Метод поиска конца первого JSON-объекта в строке.
+        Возвращает None, если объект ещё не закрыт.
+        """
+        depth = 0
+        in_string = False
+        escape = False
+        for position, char in enumerate(text):
+            if in_string:
+                if escape:
+                    escape = False
+                elif char == '\\':
+                    escape = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+            elif char in '{[':
+                depth += 1
+            elif char in '}]':
+                depth -= 1
+                if not depth:
+                    return position + 1
+        return None
+
+    def switch_to_framed(self):
+        """
+        Метод переключения соединения на формат с заголовком длины
+        после согласования в процессе авторизации.
+        """
+        if self.text:
+            raise IncorrectDataReceivedError
+        self.framed = True
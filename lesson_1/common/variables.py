@@ -1,18 +1,65 @@
 """Constants"""
 import logging
+import os
 
 # Порт по умолчанию для сетевого взаимодействия.
 DEFAULT_PORT = 7777
 # IP-адрес по умолчанию для подключения клиента.
 DEFAULT_IP_ADDRESS = '127.0.0.1'
-# Max размер очереди подключений.
-MAX_CONNECTION = 5
+# Max размер очереди подключений. Очередь должна вмещать волну
+# подключений после перезапуска сервера, иначе ядро отбрасывает SYN
+# и клиенты ждут повторной отправки.
+MAX_CONNECTION = 1024
+# Время ожидания ответа клиента на запрос авторизации, сек.
+AUTH_TIMEOUT = 5
+# Состояния авторизации соединения.
+AUTH_AWAIT_PRESENCE = 'await_presence'
+AUTH_CHALLENGE_SENT = 'challenge_sent'
+AUTH_AUTHENTICATED = 'authenticated'
+# Таймаут ожидания событий в основном цикле сервера, сек.
+SELECT_TIMEOUT = 0.5
+# Объём очереди исходящих данных клиента, при котором приём запросов
+# от него приостанавливается, и объём, при котором приём возобновляется.
+OUTBOUND_HIGH_WATERMARK = 256 * 1024
+OUTBOUND_LOW_WATERMARK = 64 * 1024
+# Max объём очереди исходящих данных, при превышении клиент отключается.
+OUTBOUND_LIMIT = 4 * 1024 * 1024
+# Max количество сообщений в очереди недоставленных одному пользователю.
+OFFLINE_QUEUE_LIMIT = 1000
+# Срок хранения недоставленного сообщения, сек.
+OFFLINE_MESSAGE_TTL = 7 * 24 * 60 * 60
+# Количество сообщений в очереди недоставленных, после которого изменения
+# фиксируются в базе, не дожидаясь конца итерации основного цикла.
+OFFLINE_COMMIT_BATCH = 100
+# Количество сообщений, выбираемых из очереди за раз при доставке.
+OFFLINE_DELIVERY_BATCH = 100
+# Количество сообщений, после которого накопленная статистика сообщений
+# записывается в базу, и max интервал между записями, сек.
+STATS_FLUSH_COUNT = 500
+STATS_FLUSH_INTERVAL = 5
+# Max количество записей в кэше справочника пользователей сервера.
+USER_CACHE_SIZE = 10000
+# Настройки SQLite базы сервера: режим синхронизации журнала WAL, размер
+# кэша страниц (отрицательное значение - в КиБ) и время ожидания
+# блокировки базы другим потоком, сек.
+SQLITE_SYNCHRONOUS = 'NORMAL'
+SQLITE_CACHE_SIZE = -16000
+SQLITE_BUSY_TIMEOUT = 5
 # Max длина сообщения в байтах.
 MAX_PACKAGE_LENGTH = 1024
+# Размер буфера чтения из сокета при потоковом разборе сообщений.
+RECV_BUFFER_LENGTH = 65536
+# Max длина сообщения в байтах при передаче с заголовком длины.
+MAX_FRAME_LENGTH = 1024 * 1024
+# Длина заголовка кадра (длина сообщения, 4 байта big-endian).
+FRAME_HEADER_LENGTH = 4
 # Используемая в проекте кодировка.
 ENCODING = 'utf-8'
-# Установка для верхнего уровня логирования.
-LOGGING_LEVEL = logging.DEBUG
+# Установка для верхнего уровня логирования, задаётся переменной
+# окружения MESSENGER_LOG_LEVEL (например, DEBUG).
+LOGGING_LEVEL = logging.getLevelName(os.environ.get('MESSENGER_LOG_LEVEL', 'INFO').upper())
+if not isinstance(LOGGING_LEVEL, int):
+    LOGGING_LEVEL = logging.INFO
 
 # Основные ключи протокола JIM.
 ACTION = 'action'
@@ -23,6 +70,13 @@ SENDER = 'from'
 DESTINATION = 'to'
 DATA = 'bin'
 PUBLIC_KEY = 'pubkey'
+FRAMING = 'framing'
+REQUEST_ID = 'req_id'
+DIRECTORY = 'directory'
+DIRECTORY_VERSION = 'dir_version'
+USERS_ADDED = 'added'
+USERS_REMOVED = 'removed'
+KEY_FINGERPRINTS = 'keys'
 
 # Прочие ключи используемые в протоколе.
 PRESENCE = 'presence'
@@ -37,6 +91,12 @@ REMOVE_CONTACT = 'remove'
 ADD_CONTACT = 'add'
 USERS_REQUEST = 'get_users'
 PUBLIC_KEY_REQUEST = 'pubkey_need'
+USERS_UPDATE = 'users_update'
+# Формат передачи: сообщения с заголовком длины.
+FRAMING_LENGTH_PREFIX = 'len32'
+# Клиент принимает изменения справочника пользователей (USERS_UPDATE)
+# вместо ответа 205.
+DIRECTORY_DELTA = 'delta'
 
 # Ответы.
 RESPONSE_200 = {RESPONSE: 200}
@@ -47,6 +107,38 @@ RESPONSE_511 = {RESPONSE: 511, DATA: None}
 
 # Количество попыток обращения к серверу.
 ATTEMPTS = 5
+# Адрес и порт HTTP сервера метрик (0 - не запускать).
+METRICS_ADDRESS = '127.0.0.1'
+METRICS_PORT = 9102
+
+# Время ожидания ответа сервера на запрос клиента (секунд).
+RESPONSE_TIMEOUT = 5
+
+# Сеансовые ключи AES-GCM переписки: префикс зашифрованного сообщения,
+# смена ключа после заданного числа сообщений или времени (секунд)
+# и размер кэша расшифрованных ключей собеседников.
+SESSION_PREFIX = 'aes:'
+SESSION_KEY_MESSAGES = 1000
+SESSION_KEY_LIFETIME = 3600
+SESSION_KEY_CACHE = 256
+
+# Число потоков расшифровки входящих сообщений клиента и наибольшее
+# число сообщений, сохраняемых в историю одной транзакцией.
+DECRYPT_WORKERS = 4
+HISTORY_BATCH = 200
+
+# Число сообщений, загружаемых в окно переписки за один раз.
+HISTORY_PAGE = 50
+
+# Время показа сообщения в строке состояния окна клиента (мс).
+STATUS_TIMEOUT = 3000
+
+# Наибольшее число результатов поиска по истории сообщений.
+SEARCH_LIMIT = 100
+
+# Наибольшее число имён в одном запросе удаления при синхронизации
+# справочников клиента (ограничение числа параметров SQLite).
+SYNC_CHUNK = 500
 
 HELP = f'Список поддерживаемых команд:\n' \
        f'-m, message - отправить сообщение. Для кого и текст сообщения - ввод в строке.\n' \
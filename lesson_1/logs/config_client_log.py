@@ -2,8 +2,11 @@
 
 import sys
 import os
+import atexit
+import queue
 sys.path.append('../')
 import logging
+from logging.handlers import QueueHandler, QueueListener
 from common.variables import LOGGING_LEVEL, ENCODING
 
 # Объект форматирования.
@@ -20,10 +23,16 @@ steam.setLevel(logging.INFO)
 log_file = logging.FileHandler(path, encoding=ENCODING)
 log_file.setFormatter(client_formatter)
 
+# Вывод в консоль и запись в файл выполняет отдельный поток, регистратор
+# только помещает записи в очередь.
+log_queue = queue.SimpleQueue()
+listener = QueueListener(log_queue, steam, log_file, respect_handler_level=True)
+listener.start()
+atexit.register(listener.stop)
+
 # Создаём регистратор и настраиваем его.
 logger = logging.getLogger('client')
-logger.addHandler(steam)
-logger.addHandler(log_file)
+logger.addHandler(QueueHandler(log_queue))
 logger.setLevel(LOGGING_LEVEL)
 
 if __name__ == '__main__':
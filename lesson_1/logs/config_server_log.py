@@ -2,10 +2,12 @@
 
 import sys
 import os
+import atexit
+import queue
 
 sys.path.append('../')
 import logging
-from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, QueueListener
 from common.variables import LOGGING_LEVEL, ENCODING
 
 # Создаём формировщик логов (formatter):
@@ -27,10 +29,16 @@ log_file = TimedRotatingFileHandler(path,
                                     utc=True)
 log_file.setFormatter(server_formatter)
 
+# Вывод в консоль и запись в файл выполняет отдельный поток, регистратор
+# только помещает записи в очередь.
+log_queue = queue.SimpleQueue()
+listener = QueueListener(log_queue, steam, log_file, respect_handler_level=True)
+listener.start()
+atexit.register(listener.stop)
+
 # создаём регистратор и настраиваем его
 logger = logging.getLogger('server')
-logger.addHandler(steam)
-logger.addHandler(log_file)
+logger.addHandler(QueueHandler(log_queue))
 logger.setLevel(LOGGING_LEVEL)
 
 if __name__ == '__main__':
@@ -1,13 +1,11 @@
 import argparse
 import configparser
 import os
-from PyQt5.QtCore import Qt
-from PyQt5.QtWidgets import QApplication
 from common.decor import log
 from common.utils import *
 from server.core import MessageProcessor
-from server.main_window import MainWindow
 from server.database import ServerStorage
+from server import metrics
 
 sys.path.append(os.path.join(os.getcwd(), '..'))
 
@@ -27,11 +25,17 @@ def arg_parser(default_port, default_address):
     parser.add_argument('-p', '--port', default=DEFAULT_PORT, type=int, help='Read port IP address', nargs='?')
     parser.add_argument('-a', '--addr', default='', help='Reading an IP address', nargs='?')
     parser.add_argument('-no_gui', action='store_true')
+    parser.add_argument('-e', '--engine', default='select', choices=['select', 'asyncio'],
+                        help='Server engine', nargs='?')
+    parser.add_argument('-m', '--metrics-port', default=METRICS_PORT, type=int,
+                        help='Metrics HTTP port, 0 - disabled', nargs='?')
     args = parser.parse_args(sys.argv[1:])
     listen_address = args.addr
     listen_port = args.port
     gui_flag = args.no_gui
-    return listen_address, listen_port, gui_flag
+    engine = args.engine
+    metrics_port = args.metrics_port
+    return listen_address, listen_port, gui_flag, engine, metrics_port
 
 
 @log
@@ -61,7 +65,7 @@ def main():
 
     # Загрузка параметров командной строки, если нет параметров, то задаём
     # значения по умолчанию.
-    listen_address, listen_port, gui_flag = arg_parser(
+    listen_address, listen_port, gui_flag, engine, metrics_port = arg_parser(
         config['SETTINGS']['Default_port'], config['SETTINGS']['Listen_Address'])
 
     # Инициализация базы данных.
@@ -71,16 +75,31 @@ def main():
             config['SETTINGS']['Database_file']))
 
     # Создание экземпляра класса - сервера и его запуск:
-    server = MessageProcessor(listen_address, listen_port, database)
+    if engine == 'asyncio':
+        from server.async_core import AsyncMessageProcessor
+        server = AsyncMessageProcessor(listen_address, listen_port, database)
+    else:
+        server = MessageProcessor(listen_address, listen_port, database)
     server.daemon = True
     server.start()
 
+    # HTTP сервер метрик в формате Prometheus.
+    if metrics_port:
+        try:
+            metrics.start_http_server(METRICS_ADDRESS, metrics_port)
+            logger.info(f'Метрики доступны по адресу http://{METRICS_ADDRESS}:{metrics_port}/metrics')
+        except OSError as err:
+            logger.error(f'Не удалось запустить сервер метрик: {err}')
+
     # Если указан параметр без GUI, то запускаем простенький обработчик
     # консольного ввода
     if gui_flag:
         while True:
-            command = input('Введите exit для завершения работы сервера.')
-            if command == 'exit':
+            command = input('Введите exit для завершения работы сервера, '
+                            'metrics - для вывода метрик.')
+            if command == 'metrics':
+                print(metrics.summary())
+            elif command == 'exit':
                 # Если выход, то завышаем основной цикл сервера.
                 server.running = False
                 server.join()
@@ -88,6 +107,12 @@ def main():
 
     # Если не указан запуск без GUI, то запускаем GUI:
     else:
+        # Графическая оболочка загружается только при её запуске, в режиме
+        # без GUI PyQt5 не импортируется.
+        from PyQt5.QtCore import Qt
+        from PyQt5.QtWidgets import QApplication
+        from server.main_window import MainWindow
+
         # Создаём графическое окружение для сервера:
         server_app = QApplication(sys.argv)
         server_app.setAttribute(Qt.AA_DisableWindowContextHelpButton)
@@ -96,8 +121,10 @@ def main():
         # Запускаем GUI
         server_app.exec_()
 
-        # По закрытию окон останавливаем обработчик сообщений.
+        # По закрытию окон останавливаем обработчик сообщений и ждём, пока
+        # он запишет накопленные данные в базу.
         server.running = False
+        server.join()
 
 
 if __name__ == '__main__':
@@ -83,8 +83,8 @@ class RegisterUser(QDialog):
                 binascii.hexlify(passwd_hash))
             self.messages.information(
                 self, 'Успех', 'Пользователь успешно зарегистрирован.')
-            # Рассылаем клиентам сообщение о необходимости обновить справичники
-            self.server.service_update_lists()
+            # Рассылаем клиентам изменения справочника пользователей
+            self.server.service_update_lists(added=[self.client_name.text()])
             self.close()
 
 
@@ -0,0 +1,242 @@
+import asyncio
+import logging
+import json
+import threading
+from common.variables import *
+from common.errors import IncorrectDataReceivedError
+from common.utils import MessageDecoder
+from server.core import MessageProcessor
+from server.session import Session
+from server import metrics
+
+# Загрузка логера
+logger = logging.getLogger('server')
+
+
+class StreamClient:
+    """
+    Класс - обёртка над asyncio-соединением клиента.
+    Предоставляет методы send, getpeername и close, как у сокета,
+    поэтому обработчики MessageProcessor работают с ним без изменений.
+    Запись безопасна для вызова из других потоков (например, из GUI).
+    """
+
+    def __init__(self, writer, loop):
+        self.writer = writer
+        self.loop = loop
+        self.peer = writer.get_extra_info('peername')
+        self.closed = False
+        # Границы буфера отправки: при превышении верхней чтение запросов
+        # клиента приостанавливается до опустошения буфера ниже нижней.
+        writer.transport.set_write_buffer_limits(
+            high=OUTBOUND_HIGH_WATERMARK, low=OUTBOUND_LOW_WATERMARK)
+
+    def in_loop(self):
+        """Метод проверяющий, что вызов выполняется в потоке цикла событий."""
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def send(self, data):
+        """Метод постановки байтов в буфер отправки транспорта."""
+        if self.closed:
+            raise ConnectionResetError('Соединение закрыто.')
+        if self.in_loop():
+            self.writer.write(data)
+        else:
+            self.loop.call_soon_threadsafe(self.writer.write, data)
+        return len(data)
+
+    # Транспорт asyncio буферизует данные сам, отправка всегда полная.
+    sendall = send
+
+    def buffered(self):
+        """Метод возвращающий объём неотправленных данных."""
+        if self.closed:
+            raise ConnectionResetError('Соединение закрыто.')
+        return self.writer.transport.get_write_buffer_size()
+
+    def getpeername(self):
+        """Метод возвращающий адрес и порт клиента."""
+        return self.peer[:2]
+
+    def close(self):
+        """Метод закрытия соединения."""
+        if self.closed:
+            return
+        self.closed = True
+        if self.in_loop():
+            self.writer.close()
+        else:
+            self.loop.call_soon_threadsafe(self.writer.close)
+
+
+class AsyncMessageProcessor(MessageProcessor):
+    """
+    Альтернативный вариант сервера на asyncio.
+    Обслуживает тот же протокол JIM, что и MessageProcessor, но вместо
+    цикла с опросом select ожидает события в цикле asyncio, поэтому в
+    простое не нагружает процессор и не задерживает новые подключения.
+    Работает в качестве отдельного потока.
+    """
+    loop = None
+    stop_event = None
+    auth_timer = None
+    commit_handle = None
+    stats_timer = None
+
+    @property
+    def running(self):
+        """Флаг продолжения работы, сброс флага останавливает цикл событий."""
+        return self._running
+
+    @running.setter
+    def running(self, value):
+        self._running = value
+        if not value and self.loop and self.stop_event:
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+
+    def run(self):
+        """Метод основной цикл потока."""
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.serve())
+        finally:
+            self.loop.close()
+
+    async def serve(self):
+        """Корутина запуска сервера и ожидания команды завершения."""
+        self.stop_event = asyncio.Event()
+        if not self.running:
+            return
+        logger.info(
+            'Запущен asyncio-сервер, порт для подключений: %s , '
+            'адрес с которого принимаются подключения: %s. '
+            'Если адрес не указан, принимаются соединения с любых адресов.', self.port, self.addr)
+        self.sock = await asyncio.start_server(
+            self.handle_connection, self.addr or None, self.port, backlog=MAX_CONNECTION)
+        self.stats_timer = self.loop.call_later(STATS_FLUSH_INTERVAL, self.on_stats_timer)
+        async with self.sock:
+            await self.stop_event.wait()
+        self.stats_timer.cancel()
+        for session in self.sessions:
+            session.sock.close()
+        # Дожидаемся завершения обработчиков закрытых соединений до
+        # закрытия цикла событий.
+        tasks = asyncio.all_tasks() - {asyncio.current_task()}
+        if tasks:
+            await asyncio.wait(tasks, timeout=SELECT_TIMEOUT)
+        self.close_database()
+
+    async def handle_connection(self, reader, writer):
+        """Корутина обслуживания одного клиента."""
+        client = StreamClient(writer, self.loop)
+        logger.info('Установлено соединение с ПК %s', client.getpeername())
+        metrics.connections.inc()
+        session = self.sessions.add(Session(client, client.peer, MessageDecoder()))
+        self.start_auth(session)
+        self.schedule_auth_expiry()
+        try:
+            while not client.closed:
+                data = await reader.read(RECV_BUFFER_LENGTH)
+                if not data:
+                    break
+                metrics.bytes_in.inc(amount=len(data))
+                for message in session.decoder.feed(data):
+                    self.handle_message(message, session)
+                    # Клиент мог быть отключён в процессе обработки.
+                    if client.closed:
+                        break
+                # Клиент не забирает ответы - не читаем его запросы, пока
+                # буфер отправки не освободится.
+                if not client.closed and client.buffered() > OUTBOUND_HIGH_WATERMARK:
+                    await writer.drain()
+        except (OSError, json.JSONDecodeError, UnicodeDecodeError, TypeError, KeyError,
+                IncorrectDataReceivedError) as err:
+            logger.debug('Getting data from client exception.', exc_info=err)
+        finally:
+            self.remove_client(client)
+
+    def schedule_auth_expiry(self):
+        """Метод планирования проверки сроков авторизации."""
+        if self.auth_timer is None and self.pending_auth:
+            deadline = next(iter(self.pending_auth.values())).deadline
+            self.auth_timer = self.loop.call_at(deadline, self.on_auth_timer)
+
+    def on_auth_timer(self):
+        """Обработчик таймера проверки сроков авторизации."""
+        self.auth_timer = None
+        deadline = self.expire_auth()
+        if deadline is not None:
+            self.auth_timer = self.loop.call_at(deadline, self.on_auth_timer)
+
+    def on_stats_timer(self):
+        """Обработчик таймера записи статистики сообщений в базу."""
+        self.database.flush_stats_if_due()
+        self.stats_timer = self.loop.call_later(STATS_FLUSH_INTERVAL, self.on_stats_timer)
+
+    def schedule_commit(self):
+        """
+        Метод планирования фиксации очереди недоставленных сообщений.
+        Сообщения, сохранённые за один проход цикла событий, фиксируются
+        одной транзакцией.
+        """
+        if self.commit_handle is None:
+            self.commit_handle = self.loop.call_soon(self.commit_offline)
+
+    def commit_offline(self):
+        """Обработчик фиксации очереди недоставленных сообщений."""
+        self.commit_handle = None
+        self.database.commit_offline()
+
+    def deliver_offline(self, session):
+        """
+        Метод доставки накопленных сообщений.
+        Выполняется задачей, ожидающей освобождения буфера отправки.
+        """
+        session.offline = True
+        self.loop.create_task(self.deliver_offline_task(session))
+
+    async def deliver_offline_task(self, session):
+        """Корутина доставки накопленных сообщений по мере отправки."""
+        super().deliver_offline(session)
+        try:
+            while session.offline and not session.sock.closed:
+                await session.sock.writer.drain()
+                super().deliver_offline(session)
+        except OSError:
+            self.remove_client(session.sock)
+
+    def outbound_size(self, session):
+        """Метод возвращающий объём неотправленных клиенту данных."""
+        return session.sock.buffered()
+
+    def call_in_loop(self, func, *args):
+        """
+        Метод выполнения func(*args) в потоке сервера, при вызове
+        из другого потока - через очередь цикла событий.
+        """
+        if threading.current_thread() is self or self.loop is None or not self.is_alive():
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def enqueue(self, session, data):
+        """Метод записи байтов в буфер транспорта клиента."""
+        session.sock.send(data)
+
+    def client_ready(self, client):
+        """Метод проверяющий, что соединение клиента не закрыто."""
+        return not client.closed
+
+    def remove_client(self, client):
+        """
+        Метод обработчик клиента с которым прервана связь.
+        При вызове из другого потока выполняется в цикле событий.
+        """
+        if not client.in_loop():
+            self.loop.call_soon_threadsafe(self.remove_client, client)
+            return
+        super().remove_client(client)
@@ -6,11 +6,18 @@ import json
 import hmac
 import binascii
 import os
+import time
+import datetime
+from collections import deque
 from common.metaclases import ServerMaker
 from common.deskriptors import PortValidator
 from common.variables import *
-from common.utils import send_message, get_message
-from common.decor import login_required
+from common.errors import IncorrectDataReceivedError
+from common.utils import encode_message, key_fingerprint, MessageDecoder
+from server.outbound import OutboundBuffer
+from server.session import Session, SessionRegistry
+from server.dispatch import ActionRegistry, ActionDispatcher
+from server import metrics
 
 # Загрузка логера
 logger = logging.getLogger('server')
@@ -24,6 +31,9 @@ class MessageProcessor(threading.Thread):
     """
     port = PortValidator()
 
+    # Реестр обрабатываемых действий протокола.
+    actions = ActionRegistry()
+
     def __init__(self, listen_address, listen_port, database):
         # Параметры подключения.
         self.addr = listen_address
@@ -35,18 +45,33 @@ class MessageProcessor(threading.Thread):
         # Сокет, через который будет осуществляться работа
         self.sock = None
 
-        # Список подключённых клиентов.
-        self.clients = []
+        # Реестр сессий подключённых клиентов (по сокету и по имени).
+        self.sessions = SessionRegistry()
 
-        # Сокеты
-        self.listen_sockets = None
-        self.error_sockets = None
+        # Пара сокетов для пробуждения основного цикла из других потоков
+        # и очередь вызовов, переданных из них в поток сервера.
+        self.wakeup_reader = None
+        self.wakeup_writer = None
+        self.calls = deque()
 
         # Флаг продолжения работы
         self.running = True
 
-        # Словарь содержащий сопоставленные имена и соответствующие им сокеты.
-        self.names = dict()
+        # Сессии, ожидающие очередного шага авторизации (в порядке
+        # истечения срока ожидания).
+        self.pending_auth = dict()
+
+        # Версия справочника пользователей, увеличивается при каждом
+        # добавлении или удалении пользователей.
+        self.directory_version = 0
+
+        # Диспетчер сообщений по действиям со счётчиками вызовов и отказов.
+        self.dispatcher = ActionDispatcher(self, self.actions)
+
+        # Показатели метрик, вычисляемые в момент запроса.
+        metrics.sessions.callback = lambda: len(self.sessions)
+        metrics.outbound_bytes.callback = lambda: sum(self.outbound_sizes())
+        metrics.outbound_max.callback = lambda: max(self.outbound_sizes(), default=0)
 
         # Конструктор предка
         super().__init__()
@@ -58,267 +83,621 @@ class MessageProcessor(threading.Thread):
 
         # Основной цикл программы сервера
         while self.running:
-            # Ждём подключения, если таймаут вышел, ловим исключение.
-            try:
-                client, client_address = self.sock.accept()
-            except OSError:
-                pass
-            else:
-                logger.info(f'Установлено соединение с ПК {client_address}')
-                client.settimeout(5)
-                self.clients.append(client)
-
+            # Ждём событий на сокетах. Читаем только у клиентов, чья очередь
+            # отправки не переполнена, пишем только тем, кому есть что отправить.
             recv_data_lst = []
             send_data_lst = []
-            err_lst = []
-            # Проверяем на наличие ждущих клиентов
+            readers = [self.sock, self.wakeup_reader]
+            writers = []
+            for session in self.sessions:
+                if not session.outbox.paused:
+                    readers.append(session.sock)
+                if session.outbox:
+                    writers.append(session.sock)
             try:
-                if self.clients:
-                    recv_data_lst, self.listen_sockets, self.error_sockets = select.select(
-                        self.clients, self.clients, [], 0)
+                recv_data_lst, send_data_lst, _ = select.select(
+                    readers, writers, [], SELECT_TIMEOUT)
             except OSError as err:
-                logger.error(f'Ошибка работы с сокетами: {err.errno}')
+                logger.error('Ошибка работы с сокетами: %s', err.errno)
 
             # принимаем сообщения и если ошибка, исключаем клиента.
-            if recv_data_lst:
-                for client_with_message in recv_data_lst:
+            for client_with_message in recv_data_lst:
+                if client_with_message is self.sock:
+                    self.accept_client()
+                elif client_with_message is self.wakeup_reader:
+                    self.clear_wakeup()
+                else:
+                    session = self.sessions.get(client_with_message)
+                    if session is None:
+                        continue
                     try:
-                        self.process_client_message(
-                            get_message(client_with_message), client_with_message)
-                    except (OSError, json.JSONDecodeError, TypeError) as err:
-                        logger.debug(f'Getting data from client exception.', exc_info=err)
+                        self.read_client(session)
+                    except (OSError, json.JSONDecodeError, UnicodeDecodeError, TypeError, KeyError,
+                            IncorrectDataReceivedError) as err:
+                        logger.debug('Getting data from client exception.', exc_info=err)
                         self.remove_client(client_with_message)
 
+            # Выполняем вызовы, переданные из других потоков.
+            self.run_calls()
+
+            # Отправляем накопленные данные готовым к записи клиентам.
+            for client in send_data_lst:
+                session = self.sessions.get(client)
+                if session is not None:
+                    self.flush_client(session)
+
+            # Отключаем клиентов, не прошедших авторизацию вовремя.
+            self.expire_auth()
+
+            # Фиксируем в базе сообщения, сохранённые за итерацию, одной
+            # транзакцией, и по таймеру записываем статистику сообщений.
+            self.database.commit_offline()
+            self.database.flush_stats_if_due()
+
+        self.close_database()
+
+    def close_database(self):
+        """Метод записи накопленных данных в базу при остановке сервера."""
+        self.database.commit_offline()
+        self.database.flush_stats()
+        logger.info('Статистика кэша пользователей: %s', self.database.users_cache.stats())
+
+    def accept_client(self):
+        """Метод приёма всех ожидающих в очереди подключений."""
+        while True:
+            try:
+                client, client_address = self.sock.accept()
+            except OSError:
+                return
+            logger.info('Установлено соединение с ПК %s', client_address)
+            metrics.connections.inc()
+            client.setblocking(False)
+            self.start_auth(self.sessions.add(
+                Session(client, client_address, MessageDecoder(), OutboundBuffer())))
+
+    def read_client(self, session):
+        """
+        Метод чтения данных из сокета клиента.
+        Обрабатывает все сообщения, полностью принятые за одно чтение.
+        """
+        data = session.sock.recv(RECV_BUFFER_LENGTH)
+        if not data:
+            raise ConnectionResetError('Клиент закрыл соединение.')
+        metrics.bytes_in.inc(amount=len(data))
+        for message in session.decoder.feed(data):
+            self.handle_message(message, session)
+            # Клиент мог быть отключён в процессе обработки.
+            if session.sock not in self.sessions:
+                break
+
+    def send(self, client, message):
+        """
+        Метод постановки словаря в очередь отправки клиенту в согласованном
+        с ним формате. Клиент, не успевающий принимать данные (очередь
+        превысила OUTBOUND_LIMIT), отключается.
+        """
+        session = self.sessions.get(client)
+        if session is None:
+            raise ConnectionResetError('Соединение закрыто.')
+        data = encode_message(message, session.decoder.framed)
+        if self.outbound_size(session) + len(data) > OUTBOUND_LIMIT:
+            logger.warning('Клиент не успевает принимать сообщения, соединение закрыто.')
+            self.remove_client(client)
+            return
+        self.enqueue(session, data)
+        metrics.bytes_out.inc(amount=len(data))
+        session.sent += 1
+
+    def outbound_size(self, session):
+        """Метод возвращающий объём неотправленных клиенту данных."""
+        return len(session.outbox)
+
+    def outbound_sizes(self):
+        """Метод возвращающий объёмы очередей отправки всех клиентов."""
+        return [self.outbound_size(session) for session in self.sessions]
+
+    def enqueue(self, session, data):
+        """
+        Метод постановки байтов в очередь отправки.
+        Если вызван не из потока сервера (например, из GUI), будит
+        основной цикл, чтобы данные ушли без ожидания таймаута select.
+        """
+        session.outbox.append(data)
+        if threading.current_thread() is not self:
+            self.wakeup()
+
+    def wakeup(self):
+        """Метод пробуждения основного цикла из другого потока."""
+        if self.wakeup_writer:
+            try:
+                self.wakeup_writer.send(b'\0')
+            except OSError:
+                pass
+
+    def call_in_loop(self, func, *args):
+        """
+        Метод выполнения func(*args) в потоке сервера. При вызове из
+        другого потока (например, из GUI) вызов ставится в очередь
+        и выполняется основным циклом на ближайшей итерации.
+        """
+        if threading.current_thread() is self or not self.is_alive():
+            func(*args)
+            return
+        self.calls.append((func, args))
+        self.wakeup()
+
+    def run_calls(self):
+        """Метод выполнения вызовов, переданных из других потоков."""
+        while self.calls:
+            func, args = self.calls.popleft()
+            func(*args)
+
+    def clear_wakeup(self):
+        """Метод очистки сокета пробуждения основного цикла."""
+        try:
+            while self.wakeup_reader.recv(RECV_BUFFER_LENGTH):
+                pass
+        except OSError:
+            pass
+
+    def flush_client(self, session):
+        """Метод отправки накопленных данных готовому к записи клиенту."""
+        try:
+            session.outbox.flush(session.sock)
+        except OSError as err:
+            logger.debug('Sending data to client exception.', exc_info=err)
+            self.remove_client(session.sock)
+            return
+        # Очередь освободилась - продолжаем доставку накопленных сообщений.
+        if session.offline and not session.outbox.paused:
+            self.deliver_offline(session)
+
+    def close_client(self, client):
+        """Метод закрытия соединения, не прошедшего авторизацию."""
+        session = self.sessions.remove(client)
+        if session is None:
+            return
+        self.pending_auth.pop(client, None)
+        # Ответ с ошибкой стараемся отправить до закрытия сокета.
+        if session.outbox:
+            try:
+                session.outbox.flush(client)
+            except OSError:
+                pass
+        client.close()
+
     def remove_client(self, client):
         """
         Метод обработчик клиента с которым прервана связь.
-        Ищет клиента и удаляет его из списков и базы:
+        Удаляет сессию клиента из реестра и отмечает выход в базе.
         """
-        logger.info(f'Клиент {client.getpeername()} отключился от сервера.')
-        for name in self.names:
-            if self.names[name] == client:
-                self.database.user_logout(name)
-                del self.names[name]
-                break
-        self.clients.remove(client)
+        session = self.sessions.remove(client)
+        if session is None:
+            return
+        logger.info('Клиент %s отключился от сервера.', session.peer)
+        if session.username is not None:
+            self.database.user_logout(session.username)
+        self.pending_auth.pop(client, None)
         client.close()
 
     def init_socket(self):
         """Метод инициализатор сокета."""
         logger.info(
-            f'Запущен сервер, порт для подключений: {self.port} , '
-            f'адрес с которого принимаются подключения: {self.addr}. '
-            f'Если адрес не указан, принимаются соединения с любых адресов.')
+            'Запущен сервер, порт для подключений: %s , '
+            'адрес с которого принимаются подключения: %s. '
+            'Если адрес не указан, принимаются соединения с любых адресов.', self.port, self.addr)
         # Готовим сокет
         transport = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         transport.bind((self.addr, self.port))
-        transport.settimeout(0.5)
+        transport.setblocking(False)
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
 
         # Начинаем слушать сокет.
         self.sock = transport
         self.sock.listen(MAX_CONNECTION)
 
+    def client_ready(self, client):
+        """Метод проверяющий, что соединение с клиентом не закрыто."""
+        return client in self.sessions
+
     def process_message(self, message):
         """
         Метод отправки сообщения клиенту.
         """
-        if message[DESTINATION] in self.names and self.names[message[DESTINATION]
-        ] in self.listen_sockets:
+        session = self.sessions.find(message[DESTINATION])
+        if session is not None and self.client_ready(session.sock):
             try:
-                send_message(self.names[message[DESTINATION]], message)
-                logger.info(
-                    f'Отправлено сообщение пользователю {message[DESTINATION]} от пользователя {message[SENDER]}.')
+                self.send(session.sock, message)
+                logger.debug(
+                    'Отправлено сообщение пользователю %s от пользователя %s.', message[DESTINATION], message[SENDER])
             except OSError:
-                self.remove_client(message[DESTINATION])
-        elif message[DESTINATION] in self.names and self.names[message[DESTINATION]] not in self.listen_sockets:
+                self.remove_client(session.sock)
+        elif session is not None:
             logger.error(
-                f'Связь с клиентом {message[DESTINATION]} была потеряна. Соединение закрыто, доставка невозможна.')
-            self.remove_client(self.names[message[DESTINATION]])
+                'Связь с клиентом %s была потеряна. Соединение закрыто, доставка невозможна.', message[DESTINATION])
+            self.remove_client(session.sock)
         else:
             logger.error(
-                f'Пользователь {message[DESTINATION]} не зарегистрирован на сервере, отправка сообщения невозможна.')
-
-    @login_required
-    def process_client_message(self, message, client):
-        """Метод-обработчик поступающих сообщений."""
-        logger.debug(f'Разбор сообщения от клиента : {message}')
-        # Если это сообщение о присутствии, принимаем и отвечаем
-        if ACTION in message and message[ACTION] == PRESENCE and TIME in message and USER in message:
-            # Если сообщение о присутствии, то вызываем функцию авторизации.
-            self.autorize_user(message, client)
-
-        # Если это сообщение, то отправляем его получателю.
-        elif ACTION in message and message[ACTION] == MESSAGE and DESTINATION in message and TIME in message \
-                and SENDER in message and MESSAGE_TEXT in message and self.names[message[SENDER]] == client:
-            if message[DESTINATION] in self.names:
+                'Пользователь %s не зарегистрирован на сервере, отправка сообщения невозможна.', message[DESTINATION])
+
+    def process_client_message(self, message, session):
+        """
+        Метод-обработчик поступающих сообщений.
+        Обработчик выбирается по полю action в реестре actions.
+        """
+        logger.debug('Разбор сообщения от клиента : %s', message)
+        # Идентификатор запроса не пересылается получателям сообщения,
+        # а возвращается клиенту в ответе.
+        session.request_id = message.pop(REQUEST_ID, None)
+        try:
+            # Если действие неизвестно или сообщение некорректно, отдаём Bad request.
+            if not self.dispatcher.dispatch(message, session):
+                response = RESPONSE_400.copy()
+                response[ERROR] = 'Запрос некорректен.'
+                self.send_response(session.sock, response)
+        finally:
+            session.request_id = None
+
+    def send_response(self, client, response):
+        """
+        Метод отправки ответа клиенту, при ошибке клиент отключается.
+        Если запрос содержал идентификатор, он добавляется в ответ.
+        """
+        session = self.sessions.get(client)
+        if session is not None and session.request_id is not None:
+            response = dict(response)
+            response[REQUEST_ID] = session.request_id
+        try:
+            self.send(client, response)
+        except OSError:
+            self.remove_client(client)
+
+    @actions.register(MESSAGE, DESTINATION, TIME, SENDER, MESSAGE_TEXT, owner=SENDER)
+    def route_message(self, message, client):
+        """
+        Обработчик сообщения пользователю: пересылает его получателю.
+        Если получатель не в сети или ещё получает накопленные сообщения,
+        сообщение сохраняется в очередь недоставленных.
+        """
+        recipient = self.sessions.find(message[DESTINATION])
+        if recipient is not None and not recipient.offline:
+            self.database.process_message(
+                message[SENDER], message[DESTINATION])
+            self.process_message(message)
+            metrics.messages.inc('live')
+            self.send_response(client, RESPONSE_200)
+        elif recipient is not None or self.database.check_user(message[DESTINATION]):
+            if self.database.store_offline(message[DESTINATION], message):
+                self.schedule_commit()
                 self.database.process_message(
                     message[SENDER], message[DESTINATION])
-                self.process_message(message)
-                try:
-                    send_message(client, RESPONSE_200)
-                except OSError:
-                    self.remove_client(client)
+                metrics.messages.inc('offline')
+                self.send_response(client, RESPONSE_200)
             else:
-                response = RESPONSE_400
-                response[ERROR] = 'Пользователь не зарегистрирован на сервере.'
-                try:
-                    send_message(client, response)
-                except OSError:
-                    pass
-            return
+                metrics.messages.inc('rejected')
+                response = RESPONSE_400.copy()
+                response[ERROR] = 'Очередь сообщений пользователя переполнена.'
+                self.send_response(client, response)
+        else:
+            metrics.messages.inc('rejected')
+            response = RESPONSE_400.copy()
+            response[ERROR] = 'Пользователь не зарегистрирован на сервере.'
+            self.send_response(client, response)
 
-        # Если клиент выходит
-        elif ACTION in message and message[ACTION] == EXIT and ACCOUNT_NAME in message \
-                and self.names[message[ACCOUNT_NAME]] == client:
-            self.remove_client(client)
+    @actions.register(EXIT, ACCOUNT_NAME, owner=ACCOUNT_NAME)
+    def client_exit(self, message, client):
+        """Обработчик выхода клиента."""
+        self.remove_client(client)
 
-        # Если это запрос контакт-листа
-        elif ACTION in message and message[ACTION] == GET_CONTACTS and USER in message and \
-                self.names[message[USER]] == client:
-            response = RESPONSE_202
-            response[LIST_INFO] = self.database.get_contacts(message[USER])
-            try:
-                send_message(client, response)
-            except OSError:
-                self.remove_client(client)
+    @actions.register(GET_CONTACTS, USER, owner=USER)
+    def contacts_request(self, message, client):
+        """Обработчик запроса контакт-листа."""
+        response = RESPONSE_202.copy()
+        response[LIST_INFO] = self.database.get_contacts(message[USER])
+        self.send_response(client, response)
 
-        # Если это добавление контакта
-        elif ACTION in message and message[ACTION] == ADD_CONTACT and ACCOUNT_NAME in message and USER in message \
-                and self.names[message[USER]] == client:
-            self.database.add_contact(message[USER], message[ACCOUNT_NAME])
-            try:
-                send_message(client, RESPONSE_200)
-            except OSError:
-                self.remove_client(client)
+    @actions.register(ADD_CONTACT, ACCOUNT_NAME, USER, owner=USER)
+    def add_contact(self, message, client):
+        """Обработчик добавления контакта."""
+        self.database.add_contact(message[USER], message[ACCOUNT_NAME])
+        self.send_response(client, RESPONSE_200)
 
-        # Если это удаление контакта
-        elif ACTION in message and message[ACTION] == REMOVE_CONTACT and ACCOUNT_NAME in message and USER in message \
-                and self.names[message[USER]] == client:
-            self.database.remove_contact(message[USER], message[ACCOUNT_NAME])
-            try:
-                send_message(client, RESPONSE_200)
-            except OSError:
-                self.remove_client(client)
-
-        # Если это запрос известных пользователей
-        elif ACTION in message and message[ACTION] == USERS_REQUEST and ACCOUNT_NAME in message \
-                and self.names[message[ACCOUNT_NAME]] == client:
-            response = RESPONSE_202
-            response[LIST_INFO] = [user[0]
-                                   for user in self.database.users_list()]
-            try:
-                send_message(client, response)
-            except OSError:
-                self.remove_client(client)
-
-        # Если это запрос публичного ключа пользователя
-        elif ACTION in message and message[ACTION] == PUBLIC_KEY_REQUEST and ACCOUNT_NAME in message:
-            response = RESPONSE_511
-            response[DATA] = self.database.get_pubkey(message[ACCOUNT_NAME])
-            # может быть, что ключа ещё нет (пользователь никогда не логинился,
-            # тогда шлём 400)
-            if response[DATA]:
-                try:
-                    send_message(client, response)
-                except OSError:
-                    self.remove_client(client)
-            else:
-                response = RESPONSE_400
-                response[ERROR] = 'Нет публичного ключа для данного пользователя.'
-                try:
-                    send_message(client, response)
-                except OSError:
-                    self.remove_client(client)
-
-        # Иначе отдаём Bad request.
-        else:
-            response = RESPONSE_400
-            response[ERROR] = 'Запрос некорректен.'
-            try:
-                send_message(client, response)
-            except OSError:
-                self.remove_client(client)
+    @actions.register(REMOVE_CONTACT, ACCOUNT_NAME, USER, owner=USER)
+    def remove_contact(self, message, client):
+        """Обработчик удаления контакта."""
+        self.database.remove_contact(message[USER], message[ACCOUNT_NAME])
+        self.send_response(client, RESPONSE_200)
+
+    @actions.register(USERS_REQUEST, ACCOUNT_NAME, owner=ACCOUNT_NAME)
+    def users_request(self, message, client):
+        """Обработчик запроса известных пользователей."""
+        response = RESPONSE_202.copy()
+        # Версия запоминается до чтения списка, поэтому список содержит
+        # все изменения этой версии.
+        response[DIRECTORY_VERSION] = self.directory_version
+        response[LIST_INFO] = [user[0]
+                               for user in self.database.users_list()]
+        # Отпечатки ключей позволяют клиенту использовать сохранённые ключи.
+        response[KEY_FINGERPRINTS] = self.database.key_fingerprints()
+        self.send_response(client, response)
 
+    @actions.register(PUBLIC_KEY_REQUEST, ACCOUNT_NAME)
+    def pubkey_request(self, message, client):
+        """Обработчик запроса публичного ключа пользователя."""
+        response = RESPONSE_511.copy()
+        response[DATA] = self.database.get_pubkey(message[ACCOUNT_NAME])
+        # может быть, что ключа ещё нет (пользователь никогда не логинился,
+        # тогда шлём 400)
+        if not response[DATA]:
+            response = RESPONSE_400.copy()
+            response[ERROR] = 'Нет публичного ключа для данного пользователя.'
+        self.send_response(client, response)
+
+    @actions.register(PRESENCE, TIME, USER, auth=False,
+                      nested={USER: (ACCOUNT_NAME, PUBLIC_KEY)})
     def autorize_user(self, message, sock):
-        """Метод реализующий авторизцию пользователей."""
+        """
+        Метод реализующий авторизцию пользователей.
+        Отправляет запрос 511 и сразу возвращает управление, ответ клиента
+        проверяется в auth_complete при его поступлении.
+        """
+        auth = self.sessions.get(sock)
+        if auth.state != AUTH_AWAIT_PRESENCE:
+            response = RESPONSE_400.copy()
+            response[ERROR] = 'Повторная авторизация невозможна.'
+            self.send(sock, response)
+            return
+        if not self.auth_check_user(message, sock):
+            return
+        message_auth, digest = self.auth_challenge(message)
+        auth.state = AUTH_CHALLENGE_SENT
+        auth.presence = message
+        auth.digest = digest
+        # Срок ожидания ответа отсчитываем заново, порядок в pending_auth
+        # соответствует порядку сроков.
+        auth.deadline = time.monotonic() + AUTH_TIMEOUT
+        self.pending_auth.pop(sock, None)
+        self.pending_auth[sock] = auth
+        try:
+            self.send_challenge(sock, message_auth)
+        except OSError as err:
+            logger.debug('Error in auth, data:', exc_info=err)
+            self.close_client(sock)
+
+    def start_auth(self, session):
+        """Метод регистрации нового соединения в автомате авторизации."""
+        session.deadline = time.monotonic() + AUTH_TIMEOUT
+        self.pending_auth[session.sock] = session
+
+    def expire_auth(self):
+        """
+        Метод закрытия соединений, не завершивших очередной шаг авторизации
+        за AUTH_TIMEOUT. Возвращает срок следующей проверки или None.
+        """
+        now = time.monotonic()
+        while self.pending_auth:
+            client, auth = next(iter(self.pending_auth.items()))
+            if auth.deadline > now:
+                return auth.deadline
+            logger.info('Клиент не завершил авторизацию вовремя, соединение закрыто.')
+            metrics.auths.inc('expired')
+            self.close_client(client)
+        return None
+
+    def handle_message(self, message, session):
+        """
+        Метод передачи принятого сообщения обработчику в соответствии
+        с состоянием авторизации соединения.
+        """
+        session.received += 1
+        if session.state == AUTH_CHALLENGE_SENT:
+            self.auth_complete(session.presence, session.sock, message, session.digest)
+        else:
+            self.process_client_message(message, session)
+
+    def auth_check_user(self, message, sock):
+        """
+        Метод проверки имени пользователя перед авторизацией.
+        Возвращает False, если клиенту отказано и соединение закрыто.
+        """
         # Если имя пользователя уже занято, то возвращаем 400.
-        logger.debug(f'Start auth process for {message[USER]}')
-        if message[USER][ACCOUNT_NAME] in self.names.keys():
-            response = RESPONSE_400
+        logger.debug('Start auth process for %s', message[USER])
+        if self.sessions.find(message[USER][ACCOUNT_NAME]) is not None:
+            response = RESPONSE_400.copy()
             response[ERROR] = 'Имя пользователя уже занято.'
+            metrics.auths.inc('failed')
             try:
-                logger.debug(f'Username busy, sending {response}')
-                send_message(sock, response)
+                logger.debug('Username busy, sending %s', response)
+                self.send(sock, response)
             except OSError:
                 logger.debug('OS Error')
                 pass
-            self.clients.remove(sock)
-            sock.close()
+            self.close_client(sock)
+            return False
         # Проверяем что пользователь зарегистрирован на сервере.
         elif not self.database.check_user(message[USER][ACCOUNT_NAME]):
-            response = RESPONSE_400
+            response = RESPONSE_400.copy()
             response[ERROR] = 'Пользователь не зарегистрирован.'
+            metrics.auths.inc('failed')
             try:
-                logger.debug(f'Unknown username, sending {response}')
-                send_message(sock, response)
+                logger.debug('Unknown username, sending %s', response)
+                self.send(sock, response)
             except OSError:
                 pass
-            self.clients.remove(sock)
-            sock.close()
+            self.close_client(sock)
+            return False
+        logger.debug('Correct username, starting passwd check.')
+        return True
+
+    def auth_challenge(self, message):
+        """
+        Метод формирующий запрос 511 для проверки пароля.
+        Возвращает словарь запроса и ожидаемый от клиента дайджест.
+        """
+        # Словарь - заготовка
+        message_auth = RESPONSE_511.copy()
+        # Если клиент поддерживает сообщения с заголовком длины, то
+        # подтверждаем переход на этот формат после запроса 511.
+        if message.get(FRAMING) == FRAMING_LENGTH_PREFIX:
+            message_auth[FRAMING] = FRAMING_LENGTH_PREFIX
+        # Набор байтов в hex представлении
+        random_str = binascii.hexlify(os.urandom(64))
+        # В словарь байты нельзя, декодируем (json.dumps -> TypeError)
+        message_auth[DATA] = random_str.decode('ascii')
+        # Создаём хэш пароля и связки с рандомной строкой, сохраняем
+        # серверную версию ключа
+        hash = hmac.new(self.database.get_hash(message[USER][ACCOUNT_NAME]), random_str, 'MD5')
+        digest = hash.digest()
+        logger.debug('Auth message = %s', message_auth)
+        return message_auth, digest
+
+    def send_challenge(self, sock, message_auth):
+        """Метод отправки запроса 511 и перехода на согласованный формат."""
+        self.send(sock, message_auth)
+        if FRAMING in message_auth:
+            self.sessions.get(sock).decoder.switch_to_framed()
+
+    def auth_complete(self, message, sock, ans, digest):
+        """Метод проверяющий ответ клиента на запрос 511."""
+        try:
+            client_digest = binascii.a2b_base64(ans[DATA])
+        except (KeyError, TypeError, ValueError):
+            client_digest = b''
+        # Если ответ клиента корректный, то сохраняем его в список
+        # пользователей.
+        if self.sessions.find(message[USER][ACCOUNT_NAME]) is not None:
+            # Пока шла проверка пароля, под этим именем вошло другое соединение.
+            metrics.auths.inc('failed')
+            response = RESPONSE_400.copy()
+            response[ERROR] = 'Имя пользователя уже занято.'
+            try:
+                self.send(sock, response)
+            except OSError:
+                pass
+            self.close_client(sock)
+        elif RESPONSE in ans and ans[RESPONSE] == 511 and hmac.compare_digest(
+                digest, client_digest):
+            session = self.sessions.get(sock)
+            self.sessions.bind(session, message[USER][ACCOUNT_NAME])
+            session.state = AUTH_AUTHENTICATED
+            session.login_time = datetime.datetime.now()
+            metrics.auths.inc('ok')
+            session.delta = message.get(DIRECTORY) == DIRECTORY_DELTA
+            session.presence = session.digest = None
+            self.pending_auth.pop(sock, None)
+            client_ip, client_port = session.peer[:2]
+            try:
+                self.send(sock, RESPONSE_200)
+            except OSError:
+                self.remove_client(sock)
+            # добавляем пользователя в список активных и если у него изменился открытый ключ
+            # сохраняем новый
+            key_changed = self.database.user_login(
+                message[USER][ACCOUNT_NAME],
+                client_ip,
+                client_port,
+                message[USER][PUBLIC_KEY])
+            # Клиенты сбрасывают сохранённый ключ пользователя по новому отпечатку.
+            if key_changed:
+                self.service_update_lists(keys={
+                    message[USER][ACCOUNT_NAME]: key_fingerprint(message[USER][PUBLIC_KEY])})
+            # Отправляем сообщения, поступившие, пока пользователь был не в сети.
+            self.deliver_offline(session)
         else:
-            logger.debug('Correct username, starting passwd check.')
-            # Иначе отвечаем 511 и проводим процедуру авторизации
-            # Словарь - заготовка
-            message_auth = RESPONSE_511
-            # Набор байтов в hex представлении
-            random_str = binascii.hexlify(os.urandom(64))
-            # В словарь байты нельзя, декодируем (json.dumps -> TypeError)
-            message_auth[DATA] = random_str.decode('ascii')
-            # Создаём хэш пароля и связки с рандомной строкой, сохраняем
-            # серверную версию ключа
-            hash = hmac.new(self.database.get_hash(message[USER][ACCOUNT_NAME]), random_str, 'MD5')
-            digest = hash.digest()
-            logger.debug(f'Auth message = {message_auth}')
+            response = RESPONSE_400.copy()
+            response[ERROR] = 'Неверный пароль.'
+            metrics.auths.inc('failed')
             try:
-                # Обмен с клиентом
-                send_message(sock, message_auth)
-                ans = get_message(sock)
-            except OSError as err:
-                logger.debug('Error in auth, data:', exc_info=err)
-                sock.close()
-                return
-            client_digest = binascii.a2b_base64(ans[DATA])
-            # Если ответ клиента корректный, то сохраняем его в список
-            # пользователей.
-            if RESPONSE in ans and ans[RESPONSE] == 511 and hmac.compare_digest(
-                    digest, client_digest):
-                self.names[message[USER][ACCOUNT_NAME]] = sock
-                client_ip, client_port = sock.getpeername()
-                try:
-                    send_message(sock, RESPONSE_200)
-                except OSError:
-                    self.remove_client(message[USER][ACCOUNT_NAME])
-                # добавляем пользователя в список активных и если у него изменился открытый ключ
-                # сохраняем новый
-                self.database.user_login(
-                    message[USER][ACCOUNT_NAME],
-                    client_ip,
-                    client_port,
-                    message[USER][PUBLIC_KEY])
-            else:
-                response = RESPONSE_400
-                response[ERROR] = 'Неверный пароль.'
-                try:
-                    send_message(sock, response)
-                except OSError:
-                    pass
-                self.clients.remove(sock)
-                sock.close()
-
-    def service_update_lists(self):
-        """Метод реализующий отправки сервисного сообщения 205 клиентам."""
-        for client in self.names:
+                self.send(sock, response)
+            except OSError:
+                pass
+            self.close_client(sock)
+
+    def schedule_commit(self):
+        """
+        Метод планирования фиксации очереди недоставленных сообщений.
+        Основной цикл фиксирует изменения в конце каждой итерации.
+        """
+        # Переопределяется в AsyncMessageProcessor, здесь фиксирует цикл select.
+        pass
+
+    def deliver_offline(self, session):
+        """
+        Метод доставки пользователю накопленных сообщений пачками по
+        OFFLINE_DELIVERY_BATCH. Доставка приостанавливается, когда очередь
+        отправки клиента заполнена, и продолжается по мере её освобождения.
+        """
+        session.offline = True
+        try:
+            while True:
+                batch = self.database.fetch_offline(session.username, OFFLINE_DELIVERY_BATCH)
+                delivered = 0
+                for message_id, message in batch:
+                    if self.outbound_size(session) >= OUTBOUND_HIGH_WATERMARK:
+                        break
+                    self.send(session.sock, message)
+                    # Клиент мог быть отключён при переполнении очереди.
+                    if session.sock not in self.sessions:
+                        return
+                    delivered += 1
+                if delivered:
+                    self.database.remove_offline(session.username, batch[delivered - 1][0])
+                # Очередь отправки заполнена, продолжим после её освобождения.
+                if delivered < len(batch):
+                    return
+                if len(batch) < OFFLINE_DELIVERY_BATCH:
+                    session.offline = False
+                    return
+        except OSError:
+            self.remove_client(session.sock)
+
+    def disconnect_user(self, username):
+        """
+        Метод отключения удалённого пользователя.
+        Может вызываться из GUI: поиск сессии в реестре, её отвязка
+        от имени и закрытие выполняются только в потоке сервера.
+        """
+        self.call_in_loop(self.drop_session, username)
+
+    def drop_session(self, username):
+        """Метод закрытия сессии удалённого пользователя, выполняется в потоке сервера."""
+        session = self.sessions.find(username)
+        if session is None:
+            return
+        # Пользователь уже удалён из базы, отвязываем имя от сессии,
+        # чтобы при отключении не отмечать выход в базе.
+        self.sessions.unbind(session)
+        self.remove_client(session.sock)
+
+    def service_update_lists(self, added=(), removed=(), keys=None):
+        """
+        Метод рассылки клиентам изменений справочника пользователей.
+        Клиенты, поддерживающие изменения, получают сообщение USERS_UPDATE
+        с добавленными и удалёнными именами, новыми отпечатками ключей
+        пользователей и новой версией справочника,
+        остальные - сервисное сообщение 205.
+        Может вызываться из GUI: версия справочника меняется и рассылка
+        выполняется только в потоке сервера.
+        """
+        self.call_in_loop(self.send_directory_update, list(added), list(removed), dict(keys or {}))
+
+    def send_directory_update(self, added, removed, keys):
+        """Метод рассылки изменений справочника, выполняется в потоке сервера."""
+        self.directory_version += 1
+        update = {
+            ACTION: USERS_UPDATE,
+            TIME: time.time(),
+            DIRECTORY_VERSION: self.directory_version,
+            USERS_ADDED: added,
+            USERS_REMOVED: removed,
+            KEY_FINGERPRINTS: keys
+        }
+        for session in self.sessions:
+            if session.username is None:
+                continue
             try:
-                send_message(self.names[client], RESPONSE_205)
+                self.send(session.sock, update if session.delta else RESPONSE_205)
             except OSError:
-                self.remove_client(self.names[client])
+                self.remove_client(session.sock)
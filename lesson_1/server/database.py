@@ -1,6 +1,16 @@
-from sqlalchemy import create_engine, Table, Column, Integer, String, MetaData, ForeignKey, DateTime, Text, func
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy import create_engine, Table, Column, Integer, String, MetaData, ForeignKey, DateTime, Text, func, \
+    select, update, event, inspect, Index
+from sqlalchemy.orm import sessionmaker, scoped_session, declarative_base
+from common.variables import OFFLINE_QUEUE_LIMIT, OFFLINE_MESSAGE_TTL, OFFLINE_COMMIT_BATCH, \
+    STATS_FLUSH_COUNT, STATS_FLUSH_INTERVAL, USER_CACHE_SIZE, SQLITE_SYNCHRONOUS, \
+    SQLITE_CACHE_SIZE, SQLITE_BUSY_TIMEOUT
+from common.utils import key_fingerprint
+from server.user_cache import CachedUser, UserCache
+from server.metrics import db_timed, db_latency
 import datetime
+import json
+import threading
+import time
 
 
 class ServerStorage:
@@ -19,12 +29,15 @@ class ServerStorage:
         last_login = Column(DateTime(timezone=True))
         passwd_hash = Column(String)
         pubkey = Column(Text)
+        # Отпечаток открытого ключа, вычисляется при его сохранении.
+        fingerprint = Column(String)
 
         def __init__(self, username, passwd_hash):
             self.name = username
             self.last_login = datetime.datetime.now()
             self.passwd_hash = passwd_hash
             self.pubkey = None
+            self.fingerprint = None
             self.id = None
 
     class ActiveUsers(Base):
@@ -46,6 +59,9 @@ class ServerStorage:
     class LoginHistory(Base):
         """Класс - отображение таблицы истории входов."""
         __tablename__ = 'Login_history'
+        __table_args__ = (
+            Index('ix_login_history_name_date', 'name', 'date_time'),
+        )
         id = Column(Integer, primary_key=True)
         name = Column(ForeignKey('Users.id'))
         date_time = Column(DateTime(timezone=True), server_default=func.now())
@@ -62,6 +78,10 @@ class ServerStorage:
     class UsersContacts(Base):
         """Класс - отображение таблицы контактов пользователей."""
         __tablename__ = 'Contacts'
+        __table_args__ = (
+            Index('ix_contacts_user_contact', 'user', 'contact', unique=True),
+            Index('ix_contacts_contact', 'contact'),
+        )
         id = Column(Integer, primary_key=True)
         user = Column(ForeignKey('Users.id'))
         contact = Column(ForeignKey('Users.id'))
@@ -74,6 +94,9 @@ class ServerStorage:
     class UsersHistory(Base):
         """Класс - отображение таблицы истории действий."""
         __tablename__ = 'History'
+        __table_args__ = (
+            Index('ix_history_user', 'user'),
+        )
         id = Column(Integer, primary_key=True)
         user = Column(ForeignKey('Users.id'))
         sent = Column(Integer)
@@ -85,43 +108,170 @@ class ServerStorage:
             self.sent = 0
             self.accepted = 0
 
+    class OfflineMessages(Base):
+        """Класс - отображение таблицы сообщений, ожидающих доставки."""
+        __tablename__ = 'Offline_messages'
+        id = Column(Integer, primary_key=True)
+        recipient = Column(ForeignKey('Users.id'), index=True)
+        date_time = Column(DateTime(timezone=True))
+        message = Column(Text)
+
+        def __init__(self, recipient, date, message):
+            self.id = None
+            self.recipient = recipient
+            self.date_time = date
+            self.message = message
+
     def __init__(self, path):
         # Создаём движок базы данных
         self.database_engine = create_engine(
             f'sqlite:///{path}',
-            echo=False,pool_recycle=7200,
-            connect_args={'check_same_thread': False})
+            echo=False, pool_recycle=7200,
+            connect_args={'check_same_thread': False, 'timeout': SQLITE_BUSY_TIMEOUT})
+        event.listen(self.database_engine, 'connect', self.set_pragmas)
 
-        # Создаём сессию
+        # Создаём таблицы и фабрику сессий: каждый поток (сервер, GUI)
+        # работает со своей сессией.
         self.Base.metadata.create_all(self.database_engine)
-        Session = sessionmaker(bind=self.database_engine)
-        self.session = Session()
+        self.migrate()
+        self.sessions = scoped_session(sessionmaker(bind=self.database_engine))
+
+        # Движок только для чтения для окон GUI. В режиме WAL чтение не
+        # блокирует запись, поэтому обновление окон не задерживает сервер.
+        self.reader_engine = create_engine(
+            f'sqlite:///file:{path}?mode=ro&uri=true',
+            echo=False, pool_recycle=7200,
+            connect_args={'check_same_thread': False, 'timeout': SQLITE_BUSY_TIMEOUT})
+        event.listen(self.reader_engine, 'connect', self.set_reader_pragmas)
+        self.readers = scoped_session(sessionmaker(bind=self.reader_engine))
 
         # Если в таблице активных пользователей есть записи, то их необходимо
         # удалить
         self.session.query(self.ActiveUsers).delete()
+        # Удаляем недоставленные сообщения с истёкшим сроком хранения.
+        self.session.query(self.OfflineMessages).filter(
+            self.OfflineMessages.date_time < self.offline_expiry()).delete()
         self.session.commit()
 
+        # Количество сообщений очереди недоставленных, ещё не
+        # зафиксированных в базе.
+        self.offline_pending = 0
+
+        # Накопленная, но ещё не записанная статистика сообщений:
+        # имя пользователя -> [отправлено, принято].
+        self.stats_pending = dict()
+        self.stats_count = 0
+        self.stats_flushed = time.monotonic()
+        self.stats_lock = threading.Lock()
+
+        # Кэш справочника пользователей: имя -> id, хэш пароля, ключ, контакты.
+        self.users_cache = UserCache(USER_CACHE_SIZE)
+
+    def migrate(self):
+        """
+        Метод обновления схемы существующей базы: добавляет столбцы
+        и создаёт индексы, объявленные в описании таблиц, но отсутствующие
+        в файле базы. Перед созданием уникального индекса удаляются дубли
+        строк, для добавленного столбца отпечатков вычисляются отпечатки
+        уже сохранённых ключей.
+        """
+        with self.database_engine.begin() as connection:
+            inspector = inspect(connection)
+            for table in self.Base.metadata.sorted_tables:
+                columns = {column['name'] for column in inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name not in columns:
+                        connection.exec_driver_sql(
+                            f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" '
+                            f'{column.type.compile(connection.dialect)}')
+                existing = {index['name'] for index in inspector.get_indexes(table.name)}
+                for index in table.indexes:
+                    if index.name in existing:
+                        continue
+                    if index.unique:
+                        first_rows = select(func.min(table.c.id)).group_by(*index.columns)
+                        connection.execute(table.delete().where(table.c.id.not_in(first_rows)))
+                    index.create(connection)
+            users = self.AllUsers.__table__
+            rows = connection.execute(select(users.c.id, users.c.pubkey).where(
+                users.c.pubkey.isnot(None), users.c.fingerprint.is_(None))).all()
+            for user_id, pubkey in rows:
+                connection.execute(users.update().where(users.c.id == user_id).values(
+                    fingerprint=key_fingerprint(pubkey)))
+
+    @property
+    def session(self):
+        """Сессия базы данных текущего потока."""
+        return self.sessions()
+
+    @property
+    def reader(self):
+        """Сессия базы данных только для чтения текущего потока."""
+        return self.readers()
+
+    @staticmethod
+    def set_pragmas(connection, record):
+        """Обработчик подключения к базе: включает журнал WAL и настройки кэша."""
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute(f'PRAGMA synchronous={SQLITE_SYNCHRONOUS}')
+        cursor.execute(f'PRAGMA cache_size={SQLITE_CACHE_SIZE}')
+        cursor.close()
+
+    @staticmethod
+    def set_reader_pragmas(connection, record):
+        """Обработчик подключения только для чтения."""
+        cursor = connection.cursor()
+        cursor.execute('PRAGMA query_only=ON')
+        cursor.execute(f'PRAGMA cache_size={SQLITE_CACHE_SIZE}')
+        cursor.close()
+
+    def get_user(self, name):
+        """
+        Метод получения записи пользователя из кэша справочника.
+        При промахе запись загружается из базы. Возвращает None, если
+        пользователь не зарегистрирован.
+        """
+        entry = self.users_cache.get(name)
+        if entry is None:
+            entry = self.load_user(name)
+            if entry is None:
+                return None
+            self.users_cache.put(name, entry)
+        return entry
+
+    @db_timed
+    def load_user(self, name):
+        """Метод загрузки записи пользователя из базы."""
+        row = self.session.query(
+            self.AllUsers.id,
+            self.AllUsers.passwd_hash,
+            self.AllUsers.pubkey
+        ).filter_by(name=name).first()
+        return CachedUser(*row) if row else None
+
+    @db_timed
     def user_login(self, username, ip_address, port, key):
         """
         Метод выполняющийся при входе пользователя, записывает в базу факт входа
         Обновляет открытый ключ пользователя при его изменении.
+        Возвращает True, если ключ изменился.
         """
-        # Запрос в таблицу пользователей на наличие там пользователя с таким
-        # именем
-        rez = self.session.query(self.AllUsers).filter_by(name=username)
+        # Ищем пользователя в справочнике, если его нет - генерируем исключение.
+        user = self.get_user(username)
+        if user is None:
+            raise ValueError('Пользователь не зарегистрирован.')
 
-        # Если имя пользователя уже присутствует в таблице, обновляем время последнего входа
-        # и проверяем корректность ключа. Если клиент прислал новый ключ,
+        # Обновляем время последнего входа. Если клиент прислал новый ключ,
         # сохраняем его.
-        if rez.count():
-            user = rez.first()
-            user.last_login = datetime.datetime.now()
-            if user.pubkey != key:
-                user.pubkey = key
-        # Если нет, то генерируем исключение.
-        else:
-            raise ValueError('Пользователь не зарегистрирован.')
+        values = {'last_login': datetime.datetime.now()}
+        key_changed = user.pubkey != key
+        if key_changed:
+            values['pubkey'] = key
+            values['fingerprint'] = key_fingerprint(key)
+        self.session.execute(
+            update(self.AllUsers).where(self.AllUsers.id == user.id).values(**values))
+        user.pubkey = key
 
         # Запись в таблицу активных пользователей о факте входа.
         new_active_user = self.ActiveUsers(
@@ -135,7 +285,9 @@ class ServerStorage:
 
         # Сохраняем изменения.
         self.session.commit()
+        return key_changed
 
+    @db_timed
     def add_user(self, name, passwd_hash):
         """
         Метод регистрации пользователя.
@@ -147,7 +299,9 @@ class ServerStorage:
         history_row = self.UsersHistory(user_row.id)
         self.session.add(history_row)
         self.session.commit()
+        self.users_cache.invalidate(name)
 
+    @db_timed
     def remove_user(self, name):
         """Метод удаляющий пользователя из базы."""
         user = self.session.query(self.AllUsers).filter_by(name=name).first()
@@ -158,32 +312,31 @@ class ServerStorage:
             self.UsersContacts).filter_by(
             contact=user.id).delete()
         self.session.query(self.UsersHistory).filter_by(user=user.id).delete()
+        self.session.query(self.OfflineMessages).filter_by(recipient=user.id).delete()
         self.session.query(self.AllUsers).filter_by(name=name).delete()
         self.session.commit()
+        # Пользователь мог быть в контактах у других - сбрасываем кэш целиком.
+        self.users_cache.clear()
+        with self.stats_lock:
+            self.stats_pending.pop(name, None)
 
     def get_hash(self, name):
         """Метод получения хэша пароля пользователя."""
-        user = self.session.query(self.AllUsers).filter_by(name=name).first()
-        return user.passwd_hash
+        return self.get_user(name).passwd_hash
 
     def get_pubkey(self, name):
         """Метод получения публичного ключа пользователя."""
-        user = self.session.query(self.AllUsers).filter_by(name=name).first()
-        return user.pubkey
+        return self.get_user(name).pubkey
 
     def check_user(self, name):
         """Метод проверяющий существование пользователя."""
-        if self.session.query(self.AllUsers).filter_by(name=name).count():
-            return True
-        else:
-            return False
+        return self.get_user(name) is not None
 
+    @db_timed
     def user_logout(self, username):
         """Метод фиксирующий отключения пользователя."""
         # Запрашиваем пользователя, что покидает нас
-        user = self.session.query(
-            self.AllUsers).filter_by(
-            name=username).first()
+        user = self.get_user(username)
 
         # Удаляем его из таблицы активных пользователей.
         self.session.query(self.ActiveUsers).filter_by(user=user.id).delete()
@@ -192,33 +345,118 @@ class ServerStorage:
         self.session.commit()
 
     def process_message(self, sender, recipient):
-        """Метод записывающий в таблицу статистики факт передачи сообщения."""
-        # Получаем ID отправителя и получателя
-        sender = self.session.query(
-            self.AllUsers).filter_by(
-            name=sender).first().id
-        recipient = self.session.query(
-            self.AllUsers).filter_by(
-            name=recipient).first().id
-        # Запрашиваем строки из истории и увеличиваем счётчики
-        sender_row = self.session.query(
-            self.UsersHistory).filter_by(
-            user=sender).first()
-        sender_row.sent += 1
-        recipient_row = self.session.query(
-            self.UsersHistory).filter_by(
-            user=recipient).first()
-        recipient_row.accepted += 1
+        """
+        Метод учёта факта передачи сообщения в статистике.
+        Счётчики накапливаются в памяти и записываются в базу одной
+        транзакцией каждые STATS_FLUSH_COUNT сообщений или по таймеру.
+        """
+        with self.stats_lock:
+            self.stats_pending.setdefault(sender, [0, 0])[0] += 1
+            self.stats_pending.setdefault(recipient, [0, 0])[1] += 1
+            self.stats_count += 1
+            if self.stats_count < STATS_FLUSH_COUNT:
+                return
+        self.flush_stats()
+
+    @db_timed
+    def flush_stats(self):
+        """Метод записи накопленной статистики сообщений в базу."""
+        with self.stats_lock:
+            pending = self.stats_pending
+            self.stats_pending = dict()
+            self.stats_count = 0
+            self.stats_flushed = time.monotonic()
+        if not pending:
+            return
+        for name, (sent, accepted) in pending.items():
+            user_id = select(self.AllUsers.id).where(
+                self.AllUsers.name == name).scalar_subquery()
+            self.session.execute(
+                update(self.UsersHistory).where(
+                    self.UsersHistory.user == user_id).values(
+                    sent=self.UsersHistory.sent + sent,
+                    accepted=self.UsersHistory.accepted + accepted))
+        self.session.commit()
+
+    def flush_stats_if_due(self):
+        """Метод записи статистики, если истёк интервал STATS_FLUSH_INTERVAL."""
+        if self.stats_pending and \
+                time.monotonic() - self.stats_flushed >= STATS_FLUSH_INTERVAL:
+            self.flush_stats()
 
+    @staticmethod
+    def offline_expiry():
+        """Метод возвращающий время, раньше которого сообщения устарели."""
+        return datetime.datetime.now() - datetime.timedelta(seconds=OFFLINE_MESSAGE_TTL)
+
+    @db_timed
+    def store_offline(self, recipient, message):
+        """
+        Метод сохранения сообщения для пользователя не в сети.
+        Изменения фиксируются группой: при накоплении OFFLINE_COMMIT_BATCH
+        сообщений или вызовом commit_offline. Возвращает False, если
+        очередь получателя переполнена. Устаревшие сообщения в размере
+        очереди не учитываются.
+        """
+        user = self.get_user(recipient)
+        if self.session.query(self.OfflineMessages).filter(
+                self.OfflineMessages.recipient == user.id,
+                self.OfflineMessages.date_time >= self.offline_expiry()
+        ).count() >= OFFLINE_QUEUE_LIMIT:
+            return False
+        self.session.add(self.OfflineMessages(
+            user.id, datetime.datetime.now(), json.dumps(message)))
+        self.offline_pending += 1
+        if self.offline_pending >= OFFLINE_COMMIT_BATCH:
+            self.commit_offline()
+        return True
+
+    def commit_offline(self):
+        """Метод фиксации накопленных сообщений очереди недоставленных."""
+        if self.offline_pending:
+            # Вызывается на каждой итерации цикла сервера, поэтому время
+            # учитывается только для действительных записей.
+            start = time.perf_counter()
+            self.session.commit()
+            self.offline_pending = 0
+            db_latency.observe(time.perf_counter() - start, 'commit_offline')
+
+    @db_timed
+    def fetch_offline(self, username, limit):
+        """
+        Метод получения первых limit недоставленных пользователю сообщений.
+        Возвращает список кортежей (id, словарь сообщения).
+        """
+        user = self.get_user(username)
+        query = self.session.query(
+            self.OfflineMessages.id,
+            self.OfflineMessages.message
+        ).filter(
+            self.OfflineMessages.recipient == user.id,
+            self.OfflineMessages.date_time >= self.offline_expiry()
+        ).order_by(self.OfflineMessages.id).limit(limit)
+        return [(row[0], json.loads(row[1])) for row in query.all()]
+
+    @db_timed
+    def remove_offline(self, username, last_id):
+        """
+        Метод удаления доставленных сообщений пользователя с id не больше
+        last_id и сообщений с истёкшим сроком хранения.
+        """
+        user = self.get_user(username)
+        self.session.query(self.OfflineMessages).filter(
+            self.OfflineMessages.recipient == user.id,
+            (self.OfflineMessages.id <= last_id) |
+            (self.OfflineMessages.date_time < self.offline_expiry())).delete()
         self.session.commit()
+        self.offline_pending = 0
 
+    @db_timed
     def add_contact(self, user, contact):
         """Метод добавления контакта для пользователя."""
         # Получаем ID пользователей
-        user = self.session.query(self.AllUsers).filter_by(name=user).first()
-        contact = self.session.query(
-            self.AllUsers).filter_by(
-            name=contact).first()
+        user = self.get_user(user)
+        contact = self.get_user(contact)
 
         # Проверяем что не дубль и что контакт может существовать (полю
         # пользователь мы доверяем)
@@ -232,15 +470,15 @@ class ServerStorage:
         contact_row = self.UsersContacts(user.id, contact.id)
         self.session.add(contact_row)
         self.session.commit()
+        user.contacts = None
 
     # Функция удаляет контакт из базы данных
+    @db_timed
     def remove_contact(self, user, contact):
         """Метод удаления контакта пользователя."""
         # Получаем ID пользователей
-        user = self.session.query(self.AllUsers).filter_by(name=user).first()
-        contact = self.session.query(
-            self.AllUsers).filter_by(
-            name=contact).first()
+        user = self.get_user(user)
+        contact = self.get_user(contact)
 
         # Проверяем что контакт может существовать (полю пользователь мы
         # доверяем)
@@ -253,22 +491,34 @@ class ServerStorage:
             self.UsersContacts.contact == contact.id
         ).delete()
         self.session.commit()
+        user.contacts = None
 
+    @db_timed
     def users_list(self):
         """Метод возвращающий список известных пользователей со временем последнего входа."""
         # Запрос строк таблицы пользователей.
-        query = self.session.query(
+        query = self.reader.query(
             self.AllUsers.name,
             self.AllUsers.last_login
         )
         # Возвращаем список кортежей
         return query.all()
 
+    @db_timed
+    def key_fingerprints(self):
+        """Метод возвращающий словарь отпечатков открытых ключей пользователей."""
+        query = self.reader.query(
+            self.AllUsers.name,
+            self.AllUsers.fingerprint
+        ).filter(self.AllUsers.fingerprint.isnot(None))
+        return dict(query.all())
+
+    @db_timed
     def active_users_list(self):
         """Метод возвращающий список активных пользователей."""
         # Запрашиваем соединение таблиц и собираем кортежи имя, адрес, порт,
         # время.
-        query = self.session.query(
+        query = self.reader.query(
             self.AllUsers.name,
             self.ActiveUsers.ip_address,
             self.ActiveUsers.port,
@@ -277,43 +527,60 @@ class ServerStorage:
         # Возвращаем список кортежей
         return query.all()
 
+    @db_timed
     def login_history(self, username=None):
         """Метод возвращающий историю входов."""
         # Запрашиваем историю входа
-        query = self.session.query(self.AllUsers.name,
-                                   self.LoginHistory.date_time,
-                                   self.LoginHistory.ip,
-                                   self.LoginHistory.port
-                                   ).join(self.AllUsers)
+        query = self.reader.query(self.AllUsers.name,
+                                  self.LoginHistory.date_time,
+                                  self.LoginHistory.ip,
+                                  self.LoginHistory.port
+                                  ).join(self.AllUsers)
         # Если было указано имя пользователя, то фильтруем по нему
         if username:
             query = query.filter(self.AllUsers.name == username)
         # Возвращаем список кортежей
         return query.all()
 
+    @db_timed
     def get_contacts(self, username):
-        """Метод возвращающий список контактов пользователя."""
+        """
+        Метод возвращающий список контактов пользователя.
+        Список загружается из базы при первом запросе и хранится в кэше.
+        """
         # Запрашивааем указанного пользователя
-        user = self.session.query(self.AllUsers).filter_by(name=username).one()
+        user = self.get_user(username)
 
-        # Запрашиваем его список контактов
-        query = self.session.query(self.UsersContacts, self.AllUsers.name). \
-            filter_by(user=user.id). \
-            join(self.AllUsers, self.UsersContacts.contact == self.AllUsers.id)
+        if user.contacts is None:
+            # Запрашиваем его список контактов
+            query = self.session.query(self.UsersContacts, self.AllUsers.name). \
+                filter_by(user=user.id). \
+                join(self.AllUsers, self.UsersContacts.contact == self.AllUsers.id)
 
-        # выбираем только имена пользователей и возвращаем их.
-        return [contact[1] for contact in query.all()]
+            # выбираем только имена пользователей.
+            user.contacts = tuple(contact[1] for contact in query.all())
+        return list(user.contacts)
 
+    @db_timed
     def message_history(self):
-        """Метод возвращающий статистику сообщений."""
-        query = self.session.query(
+        """
+        Метод возвращающий статистику сообщений с учётом ещё не
+        записанных в базу счётчиков.
+        """
+        query = self.reader.query(
             self.AllUsers.name,
             self.AllUsers.last_login,
             self.UsersHistory.sent,
             self.UsersHistory.accepted
         ).join(self.AllUsers)
+        with self.stats_lock:
+            pending = {name: tuple(counters) for name, counters in self.stats_pending.items()}
         # Возвращаем список кортежей
-        return query.all()
+        result = []
+        for name, last_login, sent, accepted in query.all():
+            pending_sent, pending_accepted = pending.get(name, (0, 0))
+            result.append((name, last_login, sent + pending_sent, accepted + pending_accepted))
+        return result
 
 
 # Отладка
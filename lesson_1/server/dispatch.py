@@ -0,0 +1,106 @@
+import time
+from common.variables import ACTION, AUTH_AUTHENTICATED
+from server import metrics
+
+
+class Action:
+    """
+    Класс - описание действия протокола JIM: обработчик, набор
+    обязательных полей и правила проверки отправителя.
+    Набор полей хранится как frozenset, поэтому проверка сообщения -
+    одна операция над множествами. Для полей-словарей (nested)
+    так же проверяются обязательные вложенные поля.
+    """
+    __slots__ = ('name', 'handler', 'fields', 'nested', 'owner', 'auth')
+
+    def __init__(self, name, handler, fields, owner=None, auth=True, nested=None):
+        self.name = name
+        # Имя метода MessageProcessor, обрабатывающего действие.
+        self.handler = handler
+        self.fields = frozenset((ACTION, *fields))
+        self.nested = tuple((field, frozenset(subfields))
+                            for field, subfields in (nested or {}).items())
+        # Поле сообщения с именем пользователя, которое должно
+        # соответствовать соединению, отправившему запрос.
+        self.owner = owner
+        # Требуется ли завершённая авторизация соединения.
+        self.auth = auth
+
+
+class ActionRegistry:
+    """
+    Класс - реестр действий протокола.
+    Методы-обработчики регистрируются декоратором register, новое
+    действие добавляется без изменения кода разбора сообщений.
+    """
+
+    def __init__(self):
+        self.actions = dict()
+
+    def register(self, name, *fields, owner=None, auth=True, nested=None):
+        """
+        Декоратор регистрации метода-обработчика действия name.
+        nested - словарь {поле: вложенные поля} для полей-словарей.
+        """
+
+        def decorator(func):
+            self.actions[name] = Action(name, func.__name__, fields, owner, auth, nested)
+            return func
+
+        return decorator
+
+    def copy(self):
+        """Метод создания копии реестра для расширения в наследниках."""
+        registry = ActionRegistry()
+        registry.actions.update(self.actions)
+        return registry
+
+
+class ActionDispatcher:
+    """
+    Класс - диспетчер сообщений одного сервера.
+    Находит обработчик по значению поля action одним обращением к словарю,
+    проверяет сообщение и ведёт счётчики вызовов и отказов по действиям.
+    """
+
+    def __init__(self, processor, registry):
+        self.processor = processor
+        self.handlers = {
+            name: (action, getattr(processor, action.handler))
+            for name, action in registry.actions.items()}
+        # Счётчики [вызовы, отказы] по действиям, неизвестные действия
+        # учитываются под ключом None.
+        self.counters = {name: [0, 0] for name in self.handlers}
+        self.counters[None] = [0, 0]
+
+    def dispatch(self, message, session):
+        """
+        Метод передачи сообщения обработчику.
+        Возвращает False, если сообщение некорректно. Для неавторизованного
+        соединения генерирует исключение TypeError.
+        """
+        name = message.get(ACTION)
+        entry = self.handlers.get(name) if isinstance(name, str) else None
+        if entry is None:
+            self.counters[None][1] += 1
+            return False
+        action, handler = entry
+        counter = self.counters[name]
+        if action.auth and session.state != AUTH_AUTHENTICATED:
+            counter[1] += 1
+            raise TypeError
+        if not action.fields.issubset(message) or (
+                action.owner and message[action.owner] != session.username) or any(
+                not isinstance(message[field], dict) or not subfields.issubset(message[field])
+                for field, subfields in action.nested):
+            counter[1] += 1
+            return False
+        counter[0] += 1
+        start = time.perf_counter()
+        handler(message, session.sock)
+        metrics.action_latency.observe(time.perf_counter() - start, name)
+        return True
+
+    def stats(self):
+        """Метод возвращающий словарь {действие: (вызовы, отказы)}."""
+        return {name: tuple(counter) for name, counter in self.counters.items()}
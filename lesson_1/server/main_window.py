@@ -6,6 +6,7 @@ from server.stat_window import StatWindow
 from server.config_window import ConfigWindow
 from server.add_user import RegisterUser
 from server.remove_user import DelUserDialog
+from server import metrics
 
 
 class MainWindow(QMainWindow):
@@ -70,9 +71,10 @@ class MainWindow(QMainWindow):
         self.active_clients_table.move(10, 45)
         self.active_clients_table.setFixedSize(780, 400)
 
-        # Таймер, обновляющий список клиентов 1 раз в секунду
+        # Таймер, обновляющий список клиентов и метрики 1 раз в секунду
         self.timer = QTimer()
         self.timer.timeout.connect(self.create_users_model)
+        self.timer.timeout.connect(self.show_metrics)
         self.timer.start(1000)
 
         # Связываем кнопки с процедурами
@@ -85,6 +87,10 @@ class MainWindow(QMainWindow):
         # Последним параметром отображаем окно.
         self.show()
 
+    def show_metrics(self):
+        """Метод вывода метрик сервера в строку состояния."""
+        self.statusBar().showMessage(metrics.summary())
+
     def create_users_model(self):
         """Метод заполняющий таблицу активных пользователей."""
         list_users = self.database.active_users_list()
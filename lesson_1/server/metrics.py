@@ -0,0 +1,220 @@
+import bisect
+import threading
+import time
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Границы интервалов гистограмм времени (секунд).
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def format_labels(names, values):
+    """Функция формирования строки меток метрики в формате Prometheus."""
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{value}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Counter:
+    """
+    Класс - счётчик с необязательными метками.
+    Значения хранятся по кортежу значений меток.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        """Метод увеличения счётчика для заданных значений меток."""
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def total(self, *labels):
+        """Метод возвращающий значение счётчика, без меток - сумму по всем."""
+        with self.lock:
+            if labels:
+                return self.values.get(labels, 0)
+            return sum(self.values.values())
+
+    def render(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return [f'{self.name}{format_labels(self.labels, labels)} {value}'
+                for labels, value in values]
+
+
+class Gauge:
+    """
+    Класс - показатель, значение которого вычисляется функцией
+    в момент запроса метрик.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, callback=None):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+
+    def value(self):
+        return self.callback() if self.callback else 0
+
+    def render(self):
+        return [f'{self.name} {self.value()}']
+
+
+class Histogram:
+    """
+    Класс - гистограмма времени выполнения с метками.
+    Для каждой метки хранит счётчики по интервалам LATENCY_BUCKETS,
+    количество и сумму наблюдений.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        """Метод учёта одного наблюдения."""
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                # [счётчики интервалов (+Inf последним), количество, сумма]
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += 1
+            series[2] += value
+
+    def time(self, *labels):
+        """Метод-декоратор замера времени выполнения функции."""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start, *(labels or (func.__name__,)))
+            return wrapper
+        return decorator
+
+    def quantile(self, rank):
+        """
+        Метод оценки квантиля по всем меткам - возвращает верхнюю
+        границу интервала, в который попадает квантиль.
+        """
+        with self.lock:
+            counts = [sum(column) for column in zip(*(series[0] for series in self.series.values()))]
+        total = sum(counts)
+        if not total:
+            return 0.0
+        position = 0
+        for index, count in enumerate(counts):
+            position += count
+            if position >= total * rank:
+                return self.buckets[index] if index < len(self.buckets) else float('inf')
+        return float('inf')
+
+    def render(self):
+        lines = []
+        with self.lock:
+            series = sorted((labels, list(data[0]), data[1], data[2])
+                            for labels, data in self.series.items())
+        for labels, counts, count, total in series:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket
+                lines.append(f'{self.name}_bucket'
+                             f'{format_labels(self.labels + ("le",), labels + (bound,))} {cumulative}')
+            lines.append(f'{self.name}_count{format_labels(self.labels, labels)} {count}')
+            lines.append(f'{self.name}_sum{format_labels(self.labels, labels)} {total}')
+        return lines
+
+
+class MetricsRegistry:
+    """Класс - реестр метрик сервера, формирует ответ в текстовом формате Prometheus."""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, metric):
+        """Метод регистрации метрики, метрика с тем же именем заменяется."""
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        """Метод формирования текста со всеми метриками."""
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# Метрики сервера.
+registry = MetricsRegistry()
+connections = registry.add(Counter('jim_connections_total', 'Принятые подключения.'))
+auths = registry.add(Counter('jim_auth_total', 'Завершённые попытки авторизации.', ('result',)))
+messages = registry.add(Counter('jim_messages_routed_total', 'Сообщения пользователям.', ('delivery',)))
+bytes_in = registry.add(Counter('jim_bytes_received_total', 'Принято байтов от клиентов.'))
+bytes_out = registry.add(Counter('jim_bytes_sent_total', 'Поставлено в очередь отправки байтов.'))
+action_latency = registry.add(Histogram('jim_action_seconds', 'Время обработки запроса.', ('action',)))
+db_latency = registry.add(Histogram('jim_db_seconds', 'Время обращения к базе данных.', ('call',)))
+sessions = registry.add(Gauge('jim_sessions', 'Открытые соединения.'))
+outbound_bytes = registry.add(Gauge('jim_outbound_queue_bytes', 'Неотправленные данные всех клиентов.'))
+outbound_max = registry.add(Gauge('jim_outbound_queue_max_bytes', 'Наибольшая очередь отправки клиента.'))
+
+
+def db_timed(func):
+    """Декоратор замера времени обращения к базе данных."""
+    return db_latency.time()(func)
+
+
+def summary():
+    """Функция формирования краткой строки метрик для GUI и консоли."""
+    return (f'Сессий: {sessions.value()}  '
+            f'Авторизаций: {auths.total("ok")} / ошибок {auths.total("failed") + auths.total("expired")}  '
+            f'Сообщений: {messages.total()}  '
+            f'Принято / отправлено: {bytes_in.total() / 1024:.1f} / {bytes_out.total() / 1024:.1f} Кб  '
+            f'Очередь: {outbound_bytes.value()} б  '
+            f'p95 запроса: {action_latency.quantile(0.95) * 1000:g} мс  '
+            f'p95 БД: {db_latency.quantile(0.95) * 1000:g} мс')
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Класс - обработчик HTTP запросов метрик."""
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(address, port):
+    """Функция запуска HTTP сервера метрик в отдельном потоке."""
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
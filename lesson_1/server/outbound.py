@@ -0,0 +1,51 @@
+from collections import deque
+from common.variables import OUTBOUND_HIGH_WATERMARK, OUTBOUND_LOW_WATERMARK
+
+
+class OutboundBuffer:
+    """
+    Класс - очередь исходящих данных одного клиента.
+    Данные ставятся в очередь без обращения к сокету и отправляются,
+    только когда сокет готов к записи. При превышении верхней границы
+    (high watermark) очередь помечается как переполненная, приём новых
+    запросов от клиента приостанавливается до тех пор, пока очередь не
+    опустится ниже нижней границы (low watermark).
+    """
+    __slots__ = ('chunks', 'size', 'paused', 'high', 'low')
+
+    def __init__(self, high=OUTBOUND_HIGH_WATERMARK, low=OUTBOUND_LOW_WATERMARK):
+        self.chunks = deque()
+        self.size = 0
+        self.paused = False
+        self.high = high
+        self.low = low
+
+    def __len__(self):
+        return self.size
+
+    def append(self, data):
+        """Метод постановки байтов в очередь."""
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.size >= self.high:
+            self.paused = True
+
+    def flush(self, sock):
+        """
+        Метод отправки накопленных данных в неблокирующий сокет.
+        Отправляет столько, сколько принимает сокет, остаток сохраняется.
+        """
+        chunks = self.chunks
+        while chunks:
+            chunk = chunks[0]
+            try:
+                sent = sock.send(chunk)
+            except (BlockingIOError, InterruptedError):
+                break
+            self.size -= sent
+            if sent < len(chunk):
+                chunks[0] = chunk[sent:]
+                break
+            chunks.popleft()
+        if self.paused and self.size <= self.low:
+            self.paused = False
@@ -46,11 +46,9 @@ class DelUserDialog(QDialog):
 
     def remove_user(self):
         """Метод - обработчик удаления пользователя."""
-        self.database.remove_user(self.selector.currentText())
-        if self.selector.currentText() in self.server.names:
-            sock = self.server.names[self.selector.currentText()]
-            del self.server.names[self.selector.currentText()]
-            self.server.remove_client(sock)
-        # Рассылаем клиентам сообщение о необходимости обновить справочники
-        self.server.service_update_lists()
+        name = self.selector.currentText()
+        self.database.remove_user(name)
+        self.server.disconnect_user(name)
+        # Рассылаем клиентам изменения справочника пользователей
+        self.server.service_update_lists(removed=[name])
         self.close()
@@ -0,0 +1,99 @@
+from common.variables import AUTH_AWAIT_PRESENCE
+
+
+class Session:
+    """
+    Класс - сессия одного соединения с сервером.
+    Хранит сокет, адрес клиента, имя пользователя, декодер и очередь
+    исходящих данных, состояние авторизации и счётчики сообщений.
+    Соединение проходит состояния AUTH_AWAIT_PRESENCE -> AUTH_CHALLENGE_SENT
+    -> AUTH_AUTHENTICATED. Переходы выполняет основной цикл сервера по мере
+    поступления сообщений, поэтому ожидание ответа одного клиента не
+    блокирует обработку остальных.
+    """
+    __slots__ = ('sock', 'peer', 'username', 'login_time', 'decoder', 'outbox',
+                 'state', 'deadline', 'presence', 'digest', 'offline', 'delta',
+                 'request_id', 'received', 'sent')
+
+    def __init__(self, sock, peer, decoder, outbox=None):
+        self.sock = sock
+        # Адрес сохраняется при подключении, чтобы не обращаться к
+        # сокету, который может быть уже закрыт.
+        self.peer = peer
+        self.username = None
+        self.login_time = None
+        self.decoder = decoder
+        self.outbox = outbox
+        self.state = AUTH_AWAIT_PRESENCE
+        # Момент (time.monotonic), до которого должен завершиться текущий
+        # шаг авторизации.
+        self.deadline = None
+        # Сообщение presence и ожидаемый ответ на запрос 511.
+        self.presence = None
+        self.digest = None
+        # Идёт доставка сообщений, накопленных пока пользователь был не в сети.
+        self.offline = False
+        # Клиент принимает изменения справочника пользователей.
+        self.delta = False
+        # Идентификатор обрабатываемого запроса, возвращается в ответе.
+        self.request_id = None
+        # Счётчики принятых от клиента и отправленных ему сообщений.
+        self.received = 0
+        self.sent = 0
+
+
+class SessionRegistry:
+    """
+    Класс - реестр сессий сервера.
+    Индексирует сессии по сокету и по имени пользователя, поэтому поиск
+    сессии, проверка авторизации и отключение выполняются за O(1).
+    """
+
+    def __init__(self):
+        self.by_socket = dict()
+        self.by_name = dict()
+
+    def __len__(self):
+        return len(self.by_socket)
+
+    def __contains__(self, sock):
+        return sock in self.by_socket
+
+    def __iter__(self):
+        return iter(list(self.by_socket.values()))
+
+    def add(self, session):
+        """Метод регистрации сессии нового соединения."""
+        self.by_socket[session.sock] = session
+        return session
+
+    def get(self, sock):
+        """Метод поиска сессии по сокету, возвращает None если её нет."""
+        return self.by_socket.get(sock)
+
+    def find(self, username):
+        """Метод поиска сессии по имени пользователя."""
+        return self.by_name.get(username)
+
+    def bind(self, session, username):
+        """Метод привязки авторизованного пользователя к сессии."""
+        session.username = username
+        self.by_name[username] = session
+
+    def unbind(self, session):
+        """Метод отвязки пользователя от сессии."""
+        if session.username is not None and self.by_name.get(session.username) is session:
+            del self.by_name[session.username]
+        session.username = None
+
+    def remove(self, sock):
+        """Метод удаления сессии соединения, возвращает удалённую сессию."""
+        session = self.by_socket.pop(sock, None)
+        if session is not None and session.username is not None and \
+                self.by_name.get(session.username) is session:
+            del self.by_name[session.username]
+        return session
+
+    def users(self):
+        """Метод возвращающий список имён авторизованных пользователей."""
+        return list(self.by_name)
@@ -0,0 +1,78 @@
+import threading
+from collections import OrderedDict
+
+
+class CachedUser:
+    """
+    Класс - запись кэша справочника пользователей.
+    Список контактов загружается при первом обращении (None - не загружен).
+    """
+    __slots__ = ('id', 'passwd_hash', 'pubkey', 'contacts')
+
+    def __init__(self, user_id, passwd_hash, pubkey):
+        self.id = user_id
+        self.passwd_hash = passwd_hash
+        self.pubkey = pubkey
+        self.contacts = None
+
+
+class UserCache:
+    """
+    Класс - кэш справочника пользователей с вытеснением давно не
+    использованных записей (LRU). Хранит не более size записей
+    и ведёт счётчики попаданий, промахов и вытеснений.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, name):
+        """Метод поиска записи, возвращает None при промахе."""
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(name)
+            self.hits += 1
+            return entry
+
+    def put(self, name, entry):
+        """Метод добавления записи с вытеснением самой старой."""
+        with self.lock:
+            self.entries[name] = entry
+            self.entries.move_to_end(name)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, name):
+        """Метод удаления записи пользователя из кэша."""
+        with self.lock:
+            self.entries.pop(name, None)
+
+    def clear(self):
+        """Метод очистки кэша."""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """Метод возвращающий словарь со статистикой работы кэша."""
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'capacity': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / requests if requests else 0.0,
+            }
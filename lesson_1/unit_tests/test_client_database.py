@@ -0,0 +1,94 @@
+"""Unit-тесты базы данных клиента"""
+
+import sys
+import os
+import datetime
+import tempfile
+import unittest
+
+from sqlalchemy import inspect
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from client.database import ClientDatabase
+
+
+class TestClientDatabase(unittest.TestCase):
+    """Тесты постраничной выборки, поиска по истории, синхронизации справочников и ключей"""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        os.chdir(self.directory.name)
+        self.database = ClientDatabase('test1')
+        now = datetime.datetime.now()
+        # Сообщения с одинаковым временем различаются по id.
+        self.database.save_messages(
+            [('test2', 'in', str(number), now + datetime.timedelta(seconds=number // 2))
+             for number in range(125)] + [('test3', 'out', 'другой', now)])
+
+    def tearDown(self):
+        self.database.database_engine.dispose()
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def test_index(self):
+        indexes = inspect(self.database.database_engine).get_indexes('message_history')
+        self.assertIn('ix_message_history_contact_date', [index['name'] for index in indexes])
+
+    def test_pages(self):
+        pages = []
+        before = None
+        while True:
+            page = self.database.get_history_page('test2', 50, before)
+            if not page:
+                break
+            pages.append(page)
+            before = page[0][3], page[0][4]
+        self.assertEqual([len(page) for page in pages], [50, 50, 25])
+        texts = [item[2] for page in reversed(pages) for item in page]
+        self.assertEqual(texts, [str(number) for number in range(125)])
+
+    def test_page_after(self):
+        first = self.database.get_history_page('test2', 10)[0]
+        page = self.database.get_history_page('test2', 3, after=(first[3], first[4]))
+        self.assertEqual([item[2] for item in page], ['116', '117', '118'])
+
+    def test_search(self):
+        self.database.save_messages([('test3', 'in', 'Встреча завтра в офисе', datetime.datetime.now())])
+        found = self.database.search_history('встр офис')
+        self.assertEqual(len(found), 1)
+        self.assertEqual(found[0][0], 'test3')
+        self.assertIn('[офисе]', found[0][2])
+        self.assertEqual(self.database.search_history('встреча', contact='test2'), [])
+        self.assertEqual(self.database.search_history('" *'), [])
+
+    def test_sync_users(self):
+        self.assertEqual(self.database.sync_users(['test1', 'test2', 'test3']), (3, 0))
+        self.assertEqual(self.database.sync_users(['test2', 'test3', 'test4']), (1, 1))
+        self.assertEqual(self.database.sync_users(['test2', 'test3', 'test4']), (0, 0))
+        self.assertEqual(sorted(self.database.get_users()), ['test2', 'test3', 'test4'])
+        indexes = inspect(self.database.database_engine).get_indexes('known_users')
+        self.assertIn(('ix_known_users_username', 1),
+                      [(index['name'], index['unique']) for index in indexes])
+
+    def test_update_users(self):
+        self.database.sync_users(['test2', 'test3'])
+        self.database.sync_contacts(['test3'])
+        self.database.update_users(['test2', 'test4'], ['test3'])
+        self.assertEqual(sorted(self.database.get_users()), ['test2', 'test4'])
+        self.assertEqual(self.database.get_contacts(), [])
+
+    def test_pubkeys(self):
+        self.database.save_pubkey('test2', 'a', 'ключ2')
+        self.database.save_pubkey('test3', 'b', 'ключ3')
+        self.database.save_pubkey('test3', 'c', 'ключ3 новый')
+        self.assertEqual(self.database.get_pubkey('test3'), ('c', 'ключ3 новый'))
+        self.database.prune_pubkeys({'test3': 'd'})
+        self.assertIsNone(self.database.get_pubkey('test3'))
+        self.assertEqual(self.database.get_pubkey('test2'), ('a', 'ключ2'))
+        self.database.prune_pubkeys({}, replace=True)
+        self.assertIsNone(self.database.get_pubkey('test2'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+"""Unit-тесты гибридного шифрования сообщений и кэша открытых ключей клиента"""
+
+import sys
+import os
+import base64
+import tempfile
+import unittest
+
+from Cryptodome.Cipher import PKCS1_OAEP
+from Cryptodome.PublicKey import RSA
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from client.crypto import SessionCipher, PublicKey, PublicKeyCache, load_keys
+from client.database import ClientDatabase
+from common.utils import key_fingerprint
+from common.variables import SESSION_PREFIX
+
+
+class TestSessionCipher(unittest.TestCase):
+    """Тесты шифрования сеансовыми ключами AES-GCM"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.keys = RSA.generate(2048, os.urandom)
+        cls.public_key = PublicKey(cls.keys.publickey().export_key().decode('ascii'))
+
+    def setUp(self):
+        self.sender = SessionCipher(self.keys, max_messages=3)
+        self.recipient = SessionCipher(self.keys)
+
+    def test_round_trip_long(self):
+        text = 'Привет! ' * 5000
+        payload = self.sender.encrypt('test1', 'test2', self.public_key, text)
+        self.assertTrue(payload.startswith(SESSION_PREFIX))
+        self.assertEqual(self.recipient.decrypt('test1', 'test2', payload), text)
+
+    def test_key_reuse_and_rotation(self):
+        for _ in range(3):
+            self.sender.encrypt('test1', 'test2', self.public_key, 'текст')
+        first = self.sender.outbound['test2']
+        self.assertEqual(first.messages, 3)
+        self.sender.encrypt('test1', 'test2', self.public_key, 'текст')
+        self.assertIsNot(self.sender.outbound['test2'], first)
+
+    def test_inbound_cache(self):
+        for text in ('раз', 'два'):
+            payload = self.sender.encrypt('test1', 'test2', self.public_key, text)
+            self.assertEqual(self.recipient.decrypt('test1', 'test2', payload), text)
+        self.assertEqual(len(self.recipient.inbound), 1)
+
+    def test_wrong_participants(self):
+        payload = self.sender.encrypt('test1', 'test2', self.public_key, 'текст')
+        with self.assertRaises(ValueError):
+            self.recipient.decrypt('test3', 'test2', payload)
+
+    def test_legacy_rsa(self):
+        encrypted = PKCS1_OAEP.new(self.keys.publickey()).encrypt('текст'.encode('utf8'))
+        payload = base64.b64encode(encrypted).decode('ascii')
+        self.assertEqual(self.recipient.decrypt('test1', 'test2', payload), 'текст')
+
+    def test_late_keys(self):
+        recipient = SessionCipher()
+        payload = self.sender.encrypt('test1', 'test2', self.public_key, 'текст')
+        recipient.set_keys(self.keys)
+        self.assertEqual(recipient.decrypt('test1', 'test2', payload), 'текст')
+
+    def test_load_keys(self):
+        with tempfile.TemporaryDirectory() as directory:
+            key_file = os.path.join(directory, 'test1.key')
+            keys = load_keys(key_file)
+            self.assertEqual(load_keys(key_file), keys)
+
+
+class TestPublicKeyCache(unittest.TestCase):
+    """Тесты кэша открытых ключей собеседников"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pems = [RSA.generate(2048, os.urandom).publickey().export_key().decode('ascii')
+                    for _ in range(2)]
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        os.chdir(self.directory.name)
+        self.database = ClientDatabase('test1')
+        self.server_keys = {'test2': self.pems[0]}
+        self.requests = []
+        self.cache = PublicKeyCache(self.database, self.fetch)
+        self.cache.update({'test2': key_fingerprint(self.pems[0])}, replace=True)
+
+    def tearDown(self):
+        self.database.database_engine.dispose()
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def fetch(self, user):
+        self.requests.append(user)
+        return self.server_keys.get(user)
+
+    def test_cached(self):
+        key = self.cache.get('test2')
+        self.assertEqual(key.pem, self.pems[0])
+        self.assertIs(self.cache.get('test2'), key)
+        # Новый экземпляр кэша (перезапуск клиента) берёт ключ из базы.
+        cache = PublicKeyCache(self.database, self.fetch)
+        cache.update({'test2': key_fingerprint(self.pems[0])}, replace=True)
+        self.assertEqual(cache.get('test2').pem, self.pems[0])
+        self.assertEqual(self.requests, ['test2'])
+
+    def test_key_change(self):
+        self.cache.get('test2')
+        self.server_keys['test2'] = self.pems[1]
+        self.cache.update({'test2': key_fingerprint(self.pems[1])})
+        self.assertIsNone(self.database.get_pubkey('test2'))
+        self.assertEqual(self.cache.get('test2').pem, self.pems[1])
+        self.assertEqual(self.requests, ['test2', 'test2'])
+
+    def test_unknown_fingerprint(self):
+        self.server_keys['test3'] = self.pems[1]
+        self.cache.get('test3')
+        self.cache.get('test3')
+        self.assertIsNone(self.cache.get('test4'))
+        self.assertEqual(self.requests, ['test3', 'test3', 'test4'])
+        self.assertIsNone(self.database.get_pubkey('test3'))
+
+
+if __name__ == '__main__':
+    unittest.main()
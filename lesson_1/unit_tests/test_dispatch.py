@@ -0,0 +1,73 @@
+"""Unit-тесты диспетчера действий сервера"""
+
+import sys
+import os
+import unittest
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from common.variables import *
+from server.dispatch import ActionRegistry, ActionDispatcher
+from server.session import Session
+
+
+class FakeProcessor:
+    """Тестовый обработчик сообщений"""
+    actions = ActionRegistry()
+
+    def __init__(self):
+        self.handled = []
+
+    @actions.register(GET_CONTACTS, USER, owner=USER)
+    def contacts_request(self, message, client):
+        self.handled.append(message)
+
+    @actions.register(PRESENCE, TIME, USER, auth=False, nested={USER: (ACCOUNT_NAME, PUBLIC_KEY)})
+    def autorize_user(self, message, client):
+        self.handled.append(message)
+
+
+class TestActionDispatcher(unittest.TestCase):
+    """Тесты диспетчера действий"""
+
+    def setUp(self):
+        self.processor = FakeProcessor()
+        self.dispatcher = ActionDispatcher(self.processor, self.processor.actions)
+        self.session = Session('sock', ('127.0.0.1', 7777), None)
+        self.session.username = 'test'
+        self.session.state = AUTH_AUTHENTICATED
+
+    def test_dispatch_ok(self):
+        message = {ACTION: GET_CONTACTS, USER: 'test'}
+        self.assertTrue(self.dispatcher.dispatch(message, self.session))
+        self.assertEqual(self.processor.handled, [message])
+        self.assertEqual(self.dispatcher.stats()[GET_CONTACTS], (1, 0))
+
+    def test_missing_field(self):
+        self.assertFalse(self.dispatcher.dispatch({ACTION: GET_CONTACTS}, self.session))
+        self.assertEqual(self.dispatcher.stats()[GET_CONTACTS], (0, 1))
+
+    def test_wrong_owner(self):
+        message = {ACTION: GET_CONTACTS, USER: 'other'}
+        self.assertFalse(self.dispatcher.dispatch(message, self.session))
+        self.assertEqual(self.processor.handled, [])
+
+    def test_unknown_action(self):
+        self.assertFalse(self.dispatcher.dispatch({ACTION: 'unknown'}, self.session))
+        self.assertEqual(self.dispatcher.stats()[None], (0, 1))
+
+    def test_nested_fields(self):
+        for user in ({}, {ACCOUNT_NAME: 'test'}, 'test'):
+            self.assertFalse(self.dispatcher.dispatch(
+                {ACTION: PRESENCE, TIME: 1, USER: user}, self.session))
+        message = {ACTION: PRESENCE, TIME: 1, USER: {ACCOUNT_NAME: 'test', PUBLIC_KEY: 'key'}}
+        self.assertTrue(self.dispatcher.dispatch(message, self.session))
+        self.assertEqual(self.dispatcher.stats()[PRESENCE], (1, 3))
+
+    def test_not_authorized(self):
+        message = {ACTION: GET_CONTACTS, USER: 'test'}
+        session = Session('other_sock', ('127.0.0.1', 7778), None)
+        self.assertRaises(TypeError, self.dispatcher.dispatch, message, session)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+"""Unit-тесты модели истории переписки клиента"""
+
+import sys
+import os
+import datetime
+import unittest
+
+from PyQt5.QtCore import Qt
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from client.history_model import HistoryModel
+
+
+class FakeDatabase:
+    """База данных с историей из 120 сообщений собеседника test2"""
+
+    def __init__(self):
+        now = datetime.datetime.now()
+        self.history = [('test2', 'in' if number % 2 else 'out', str(number),
+                         now + datetime.timedelta(seconds=number), number)
+                        for number in range(120)]
+
+    def get_history_page(self, contact, limit, before=None, after=None):
+        rows = [row for row in self.history if row[0] == contact]
+        if after is not None:
+            return [row for row in rows if (row[3], row[4]) > after][:limit]
+        return [row for row in rows if before is None or (row[3], row[4]) < before][-limit:]
+
+
+class TestHistoryModel(unittest.TestCase):
+    """Тесты постраничной модели HistoryModel"""
+
+    def setUp(self):
+        self.model = HistoryModel(FakeDatabase(), page_size=50)
+        self.model.set_contact('test2')
+
+    def text(self, row):
+        return self.model.data(self.model.index(row, 0)).split('\n ')[1]
+
+    def test_last_page(self):
+        self.assertEqual(self.model.rowCount(), 50)
+        self.assertEqual(self.text(0), '70')
+        self.assertEqual(self.model.data(self.model.index(0, 0), Qt.TextAlignmentRole),
+                         int(Qt.AlignRight | Qt.AlignVCenter))
+
+    def test_fetch_more(self):
+        while self.model.canFetchMore():
+            self.model.fetchMore()
+        self.assertEqual(self.model.rowCount(), 120)
+        self.assertEqual([self.text(row) for row in range(120)],
+                         [str(number) for number in range(120)])
+
+    def test_around(self):
+        date = self.model.database.history[30][3]
+        row = self.model.set_contact('test2', around=(date, 30))
+        self.assertEqual(self.text(row), '30')
+        self.assertEqual(self.model.append_records(
+            [('test2', 'in', 'новое', datetime.datetime.now())]), 0)
+        while self.model.canFetchMore():
+            self.model.fetchMore()
+        self.assertEqual([self.text(row) for row in range(self.model.rowCount())],
+                         [str(number) for number in range(120)])
+
+    def test_append_records(self):
+        now = datetime.datetime.now()
+        added = self.model.append_records([('test2', 'in', 'новое', now),
+                                           ('test3', 'in', 'другой', now),
+                                           ('test2', 'in', None, now)])
+        self.assertEqual(added, 1)
+        self.assertEqual(self.text(50), 'новое')
+        # Общая кисть фона для всех входящих сообщений.
+        self.assertIs(self.model.data(self.model.index(50, 0), Qt.BackgroundRole),
+                      self.model.data(self.model.index(1, 0), Qt.BackgroundRole))
+
+
+if __name__ == '__main__':
+    unittest.main()
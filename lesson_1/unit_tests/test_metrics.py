@@ -0,0 +1,44 @@
+"""Unit-тесты метрик сервера"""
+
+import sys
+import os
+import unittest
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from server.metrics import Counter, Histogram, MetricsRegistry
+
+
+class TestMetrics(unittest.TestCase):
+    """Тесты счётчиков, гистограмм и формата Prometheus"""
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+        self.counter = self.registry.add(Counter('test_total', 'Счётчик.', ('result',)))
+        self.histogram = self.registry.add(Histogram('test_seconds', 'Время.', ('action',), (0.1, 1.0)))
+
+    def test_counter(self):
+        self.counter.inc('ok')
+        self.counter.inc('ok', amount=2)
+        self.counter.inc('failed')
+        self.assertEqual(self.counter.total('ok'), 3)
+        self.assertEqual(self.counter.total(), 4)
+
+    def test_histogram_quantile(self):
+        for value in (0.05, 0.05, 0.05, 0.5):
+            self.histogram.observe(value, 'message')
+        self.assertEqual(self.histogram.quantile(0.5), 0.1)
+        self.assertEqual(self.histogram.quantile(0.95), 1.0)
+
+    def test_render(self):
+        self.counter.inc('ok')
+        self.histogram.observe(2.0, 'message')
+        text = self.registry.render()
+        self.assertIn('# TYPE test_total counter', text)
+        self.assertIn('test_total{result="ok"} 1', text)
+        self.assertIn('test_seconds_bucket{action="message",le="1.0"} 0', text)
+        self.assertIn('test_seconds_bucket{action="message",le="+Inf"} 1', text)
+        self.assertIn('test_seconds_count{action="message"} 1', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+"""Unit-тесты очереди сообщений для пользователей не в сети"""
+
+import sys
+import os
+import datetime
+import json
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from common.variables import *
+from server.core import MessageProcessor
+from server.database import ServerStorage
+from server.session import Session
+
+
+class FakeProcessor(MessageProcessor):
+    """Сервер без сети: отправленные клиентам сообщения запоминаются"""
+
+    def __init__(self, database):
+        super().__init__('127.0.0.1', 7777, database)
+        self.sent = []
+
+    def send(self, client, message):
+        self.sent.append(message)
+
+    def outbound_size(self, session):
+        return 0
+
+
+def message(number):
+    """Функция создания сообщения пользователю test2 с номером в тексте"""
+    return {ACTION: MESSAGE, SENDER: 'test1', DESTINATION: 'test2',
+            TIME: number, MESSAGE_TEXT: f'message {number}'}
+
+
+class TestOfflineQueue(unittest.TestCase):
+    """Тесты сохранения, ограничения и доставки недоставленных сообщений"""
+
+    def setUp(self):
+        self.database = ServerStorage(':memory:')
+        self.database.add_user('test1', b'hash1')
+        self.database.add_user('test2', b'hash2')
+
+    def tearDown(self):
+        self.database.sessions.remove()
+        self.database.readers.remove()
+        self.database.database_engine.dispose()
+        self.database.reader_engine.dispose()
+
+    def store_expired(self, number):
+        """Метод записи в очередь сообщения с истёкшим сроком хранения"""
+        user = self.database.get_user('test2')
+        date = self.database.offline_expiry() - datetime.timedelta(minutes=1)
+        self.database.session.add(self.database.OfflineMessages(
+            user.id, date, json.dumps(message(number))))
+        self.database.session.commit()
+
+    def test_store_and_fetch(self):
+        for number in range(3):
+            self.assertTrue(self.database.store_offline('test2', message(number)))
+        self.database.commit_offline()
+        rows = self.database.fetch_offline('test2', 10)
+        self.assertEqual([row[1] for row in rows], [message(number) for number in range(3)])
+        self.assertEqual(self.database.fetch_offline('test1', 10), [])
+
+    def test_queue_limit(self):
+        with mock.patch('server.database.OFFLINE_QUEUE_LIMIT', 2):
+            self.assertTrue(self.database.store_offline('test2', message(1)))
+            self.assertTrue(self.database.store_offline('test2', message(2)))
+            self.assertFalse(self.database.store_offline('test2', message(3)))
+            # Ограничение действует для каждого получателя отдельно.
+            self.assertTrue(self.database.store_offline('test1', message(4)))
+
+    def test_expired_ignored(self):
+        self.store_expired(0)
+        self.store_expired(1)
+        with mock.patch('server.database.OFFLINE_QUEUE_LIMIT', 2):
+            self.assertTrue(self.database.store_offline('test2', message(2)))
+            self.assertTrue(self.database.store_offline('test2', message(3)))
+            self.assertFalse(self.database.store_offline('test2', message(4)))
+        self.database.commit_offline()
+        rows = self.database.fetch_offline('test2', 10)
+        self.assertEqual([row[1] for row in rows], [message(2), message(3)])
+
+    def test_remove_delivered(self):
+        for number in range(3):
+            self.database.store_offline('test2', message(number))
+        self.database.commit_offline()
+        rows = self.database.fetch_offline('test2', 2)
+        self.database.remove_offline('test2', rows[-1][0])
+        rows = self.database.fetch_offline('test2', 10)
+        self.assertEqual([row[1] for row in rows], [message(2)])
+
+    @mock.patch('server.core.OFFLINE_DELIVERY_BATCH', 2)
+    def test_deliver_on_login(self):
+        self.store_expired(0)
+        for number in range(1, 6):
+            self.database.store_offline('test2', message(number))
+        self.database.commit_offline()
+        server = FakeProcessor(self.database)
+        session = server.sessions.add(Session(object(), ('127.0.0.1', 7777), None))
+        server.sessions.bind(session, 'test2')
+        server.deliver_offline(session)
+        # Сообщения доставлены пачками в порядке поступления и удалены из очереди.
+        self.assertEqual(server.sent, [message(number) for number in range(1, 6)])
+        self.assertFalse(session.offline)
+        self.assertEqual(self.database.fetch_offline('test2', 10), [])
+        self.assertEqual(self.database.session.query(self.database.OfflineMessages).count(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+"""Unit-тесты очереди исходящих данных сервера"""
+
+import sys
+import os
+import unittest
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from server.outbound import OutboundBuffer
+
+
+class FakeSocket:
+    """Тестовый неблокирующий сокет, в буфер которого помещается capacity байт"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.sent = b''
+
+    def send(self, data):
+        if not self.capacity:
+            raise BlockingIOError
+        part = bytes(data[:self.capacity])
+        self.capacity -= len(part)
+        self.sent += part
+        return len(part)
+
+
+class TestOutboundBuffer(unittest.TestCase):
+    """Тесты очереди исходящих данных"""
+
+    def test_partial_flush(self):
+        """Неотправленный остаток сохраняется и уходит следующим вызовом"""
+        buffer = OutboundBuffer()
+        buffer.append(b'abc')
+        buffer.append(b'def')
+        sock = FakeSocket(4)
+        buffer.flush(sock)
+        self.assertEqual(len(buffer), 2)
+        sock.capacity = 10
+        buffer.flush(sock)
+        self.assertEqual(sock.sent, b'abcdef')
+        self.assertEqual(len(buffer), 0)
+
+    def test_would_block(self):
+        """Сокет не готов к записи - данные остаются в очереди"""
+        buffer = OutboundBuffer()
+        buffer.append(b'abc')
+        buffer.flush(FakeSocket(0))
+        self.assertEqual(len(buffer), 3)
+
+    def test_watermarks(self):
+        """Пауза при превышении верхней границы, снятие ниже нижней"""
+        buffer = OutboundBuffer(high=10, low=4)
+        buffer.append(b'x' * 12)
+        self.assertTrue(buffer.paused)
+        buffer.flush(FakeSocket(6))
+        self.assertTrue(buffer.paused)
+        buffer.flush(FakeSocket(2))
+        self.assertFalse(buffer.paused)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+"""Unit-тесты конвейера расшифровки и записи истории клиента"""
+
+import sys
+import os
+import unittest
+
+from Cryptodome.PublicKey import RSA
+from PyQt5.QtCore import Qt
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from client.crypto import SessionCipher, PublicKey
+from client.pipeline import MessagePipeline
+from common.variables import SENDER, DESTINATION, MESSAGE_TEXT
+
+
+class FakeDatabase:
+    """База данных, запоминающая пачки сохранённых сообщений"""
+
+    def __init__(self):
+        self.batches = []
+
+    def save_messages(self, messages):
+        self.batches.append(messages)
+
+
+class FailingCipher:
+    """Шифр, расшифровка которым завершается непредвиденной ошибкой"""
+
+    def decrypt(self, sender, recipient, text):
+        if text == 'fail':
+            raise RuntimeError('cipher failure')
+        return text
+
+
+class TestMessagePipeline(unittest.TestCase):
+    """Тесты конвейера MessagePipeline"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.keys = RSA.generate(2048, os.urandom)
+        cls.public_key = PublicKey(cls.keys.publickey().export_key().decode('ascii'))
+
+    def setUp(self):
+        self.database = FakeDatabase()
+        self.received = []
+        self.pipeline = MessagePipeline(
+            self.database, SessionCipher(self.keys), 'test1', workers=2, batch_size=50)
+        # Цикла событий нет, поэтому пачки принимаются в потоке записи.
+        self.pipeline.messages_ready.connect(self.received.extend, Qt.DirectConnection)
+
+    def test_order_and_batches(self):
+        sender = SessionCipher(self.keys)
+        for number in range(300):
+            self.pipeline.submit({
+                SENDER: 'test2',
+                DESTINATION: 'test1',
+                MESSAGE_TEXT: sender.encrypt('test2', 'test1', self.public_key, str(number))})
+        self.pipeline.store('test2', 'out', 'ответ')
+        self.pipeline.close()
+        saved = [message for batch in self.database.batches for message in batch]
+        self.assertEqual([text for _, _, text, _ in saved],
+                         [str(number) for number in range(300)] + ['ответ'])
+        self.assertTrue(all(len(batch) <= 50 for batch in self.database.batches))
+        self.assertEqual(len(self.received), 301)
+
+    def test_broken_message(self):
+        self.pipeline.submit({SENDER: 'test2', DESTINATION: 'test1', MESSAGE_TEXT: 'aes:AAAA'})
+        self.pipeline.close()
+        self.assertEqual(self.database.batches, [[]])
+        self.assertEqual(self.received[0][:3], ('test2', 'in', None))
+
+    def test_cipher_failure(self):
+        pipeline = MessagePipeline(self.database, FailingCipher(), 'test1')
+        pipeline.messages_ready.connect(self.received.extend, Qt.DirectConnection)
+        for text in ('first', 'fail', 'last'):
+            pipeline.submit({SENDER: 'test2', DESTINATION: 'test1', MESSAGE_TEXT: text})
+        pipeline.close()
+        self.pipeline.close()
+        # Поток записи не остановлен ошибкой и сохранил остальные сообщения.
+        saved = [message for batch in self.database.batches for message in batch]
+        self.assertEqual([text for _, _, text, _ in saved], ['first', 'last'])
+        self.assertEqual([record[:3] for record in self.received],
+                         [('test2', 'in', 'first'), ('test2', 'in', None), ('test2', 'in', 'last')])
+
+
+if __name__ == '__main__':
+    unittest.main()
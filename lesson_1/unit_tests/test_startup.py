@@ -0,0 +1,20 @@
+"""Unit-тесты запуска сервера без графической оболочки"""
+
+import sys
+import os
+import unittest
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from benchmarks.startup_imports import import_profile, FORBIDDEN
+
+
+class TestStartupImports(unittest.TestCase):
+    """Тест: загрузка server.py не импортирует модули GUI"""
+
+    def test_no_gui_modules(self):
+        loaded = [name for _, _, _, name in import_profile() if name.split('.')[0] in FORBIDDEN]
+        self.assertEqual(loaded, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+"""Unit-тесты ожидания ответов сервера транспортом клиента"""
+
+import sys
+import os
+import socket
+import time
+import unittest
+from unittest import mock
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from client.transport import ClientTransport
+from common.variables import *
+
+
+class FakeTransport(ClientTransport):
+    """Транспорт без соединения: отправленные запросы запоминаются, ответов нет"""
+
+    def __init__(self):
+        super().__init__(7777, '127.0.0.1', None, 'test1', '123')
+        self.sent = []
+
+    def write_message(self, message):
+        self.sent.append(message)
+
+    def read_message(self):
+        raise socket.timeout
+
+    def run(self):
+        # Поток транспорта, не получающий ответов до завершения работы.
+        while self.running:
+            time.sleep(0.01)
+
+
+class TestWaitResponse(unittest.TestCase):
+    """Тесты таймаута ожидания ответа"""
+
+    def test_timeout_forgets_request(self):
+        transport = FakeTransport()
+        with mock.patch('client.transport.RESPONSE_TIMEOUT', 0):
+            self.assertRaises(socket.timeout, transport.request, {ACTION: USERS_REQUEST})
+        self.assertFalse(transport.pending)
+        # Ответ сервера без идентификаторов запросов достаётся новому запросу.
+        future = transport.submit({ACTION: GET_CONTACTS})
+        transport.dispatch_message({RESPONSE: 202, LIST_INFO: []})
+        self.assertEqual(future.result(0), {RESPONSE: 202, LIST_INFO: []})
+
+    def test_thread_timeout(self):
+        transport = FakeTransport()
+        transport.start()
+        try:
+            with mock.patch('client.transport.RESPONSE_TIMEOUT', 0.05):
+                # Ожидание из другого потока - таймаут Future приводится к OSError.
+                self.assertRaises(OSError, transport.request, {ACTION: USERS_REQUEST})
+            self.assertFalse(transport.pending)
+        finally:
+            transport.running = False
+            transport.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
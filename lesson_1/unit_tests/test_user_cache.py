@@ -0,0 +1,39 @@
+"""Unit-тесты кэша справочника пользователей сервера"""
+
+import sys
+import os
+import unittest
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+from server.user_cache import CachedUser, UserCache
+
+
+class TestUserCache(unittest.TestCase):
+    """Тесты LRU кэша пользователей"""
+
+    def setUp(self):
+        self.cache = UserCache(2)
+        self.cache.put('test1', CachedUser(1, b'hash1', None))
+        self.cache.put('test2', CachedUser(2, b'hash2', None))
+
+    def test_hit_miss(self):
+        self.assertEqual(self.cache.get('test1').id, 1)
+        self.assertIsNone(self.cache.get('test3'))
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+    def test_lru_eviction(self):
+        self.cache.get('test1')
+        self.cache.put('test3', CachedUser(3, b'hash3', None))
+        self.assertIsNone(self.cache.get('test2'))
+        self.assertEqual(self.cache.get('test1').id, 1)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_invalidate(self):
+        self.cache.invalidate('test1')
+        self.assertIsNone(self.cache.get('test1'))
+        self.assertEqual(len(self.cache), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
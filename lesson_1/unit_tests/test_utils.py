@@ -7,7 +7,8 @@ import json
 
 sys.path.insert(0, os.path.join(os.getcwd(), '..'))
 from common.variables import RESPONSE, ERROR, USER, ACCOUNT_NAME, TIME, ACTION, PRESENCE, ENCODING
-from common.utils import get_message, send_message
+from common.errors import IncorrectDataReceivedError
+from common.utils import get_message, send_message, encode_message, MessageDecoder
 
 
 class TestSocket:
@@ -92,5 +93,43 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(get_message(test_sock_err), self.test_dict_recv_err)
 
 
+class TestMessageDecoder(unittest.TestCase):
+    """Тесты потокового декодера сообщений"""
+
+    messages = [
+        {ACTION: PRESENCE, TIME: 1.1, USER: {ACCOUNT_NAME: 'Гость "1"'}},
+        {RESPONSE: 200},
+    ]
+
+    def check_all_splits(self, framed):
+        """Сообщения, разрезанные в любом месте, собираются без потерь"""
+        stream = b''.join(encode_message(message, framed) for message in self.messages)
+        for position in range(len(stream) + 1):
+            decoder = MessageDecoder(framed)
+            result = decoder.feed(stream[:position]) + decoder.feed(stream[position:])
+            self.assertEqual(result, self.messages)
+
+    def test_framed_split(self):
+        """Разбор сообщений с заголовком длины"""
+        self.check_all_splits(True)
+
+    def test_legacy_split(self):
+        """Разбор идущих подряд JSON-объектов (старые клиенты)"""
+        self.check_all_splits(False)
+
+    def test_framed_long_message(self):
+        """Сообщение длиннее MAX_PACKAGE_LENGTH передаётся целиком"""
+        message = {ACTION: PRESENCE, TIME: 1.1, USER: {ACCOUNT_NAME: 'x' * 10000}}
+        self.assertEqual(MessageDecoder(True).feed(encode_message(message, True)), [message])
+
+    def test_framed_too_long(self):
+        """Ошибка при превышении максимальной длины кадра"""
+        self.assertRaises(IncorrectDataReceivedError, MessageDecoder(True).feed, b'\xff\xff\xff\xff{}')
+
+    def test_legacy_garbage(self):
+        """Ошибка при получении не JSON-объекта"""
+        self.assertRaises(json.JSONDecodeError, MessageDecoder().feed, b'garbage')
+
+
 if __name__ == '__main__':
     unittest.main()